@@ -2,7 +2,6 @@ from plmfit.logger import Logger
 import os
 from plmfit.args_parser import parse_args
 import traceback
-from plmfit.shared_utils.random_state import set_seed
 
 NUM_WORKERS = 0
 
@@ -36,13 +35,18 @@ def run_predict(args, logger):
     from plmfit.functions import predict
     predict(args, logger)
 
+def run_zero_shot(args, logger):
+    from plmfit.functions import zero_shot
+    zero_shot(args, logger)
+
 def main():
     args = parse_args()
     experiment_dir = args.experiment_dir
     if not os.path.exists(experiment_dir):
         os.makedirs(experiment_dir, exist_ok=True)
 
-    # Set global seed
+    # Set global seed, torch is only imported once arguments are parsed
+    from plmfit.shared_utils.random_state import set_seed
     set_seed(args.seed)
         
     # Removing the output_dir prefix from experiment_dir
@@ -61,6 +65,7 @@ def main():
         elif args.function == 'one_hot': run_onehot(args, logger)
         elif args.function == 'blosum': run_blosum(args, logger)
         elif args.function == 'predict' or args.function == 'generate': run_predict(args, logger)
+        elif args.function == 'zero_shot': run_zero_shot(args, logger)
         else: raise NotImplementedError('Function not supported (yet)')
         logger.log("\n\nEnd of process", force_send=True)
     except:
@@ -15,9 +15,9 @@ def parse_args():
     parser.add_argument('--split', default='sampled')
     parser.add_argument('--function', type=str, default='extract_embeddings')
     parser.add_argument('--reduction', type=str, default='mean',
-                        help='Reduction technique')
+                        help='Reduction technique, or a comma separated list of them (mean, bos, eos, sum or a token position)')
     parser.add_argument('--layer', type=str, default='last',
-                        help='PLM layer to be used')
+                        help='PLM layer to be used, or a comma separated list of layers extracted in a single pass')
     parser.add_argument('--output_dir', type=str, default='./output',
                         help='Output directory for created files')
     parser.add_argument('--experiment_name', type=str, default='default',
@@ -38,6 +38,8 @@ def parse_args():
     parser.add_argument('--weights', default=None)
     parser.add_argument('--sampler', default="False")
     parser.add_argument('--split_size', default=0, type=int)
+    parser.add_argument('--embeddings_format', default='pt', choices=['pt', 'emb'], help="Format of extracted embeddings, 'emb' writes a memory-mapped embedding store")
+    parser.add_argument('--shard_size', default=0, type=int, help="If set, extracted embeddings are streamed into resumable shards of this many samples")
     parser.add_argument('--model_path', default=None, help="Path of the model in .ckpt format for evaluating it or continuing training from checkpoint")
     parser.add_argument('--model_metadata', default=None, help="Path of the model metadata to load the model")
     parser.add_argument('--evaluate', default="False")
@@ -45,5 +47,6 @@ def parse_args():
     parser.add_argument('--hyperparam_config', default="hyperparam_config.json", type=str)
     parser.add_argument('--prediction_data', default=None, type=str)
     parser.add_argument('--batch_size', default=100, type=int, help="Batch size mainly used for prediction")
+    parser.add_argument('--scoring', default='likelihood', choices=['likelihood', 'variants', 'masked_marginal'], help="Zero-shot scoring mode, 'likelihood' of each sequence, 'variants' scored against the wild type (ProGen2) or 'masked_marginal' log-odds of the mutations (ESM2)")
 
     return parser.parse_args()
\ No newline at end of file
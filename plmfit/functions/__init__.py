@@ -4,4 +4,5 @@ from plmfit.functions.onehot import onehot
 from plmfit.functions.feature_extraction import feature_extraction
 from plmfit.functions.predict import predict
 from plmfit.functions.blosum62 import blosum
-from plmfit.functions.categorical_train import categorical_train
\ No newline at end of file
+from plmfit.functions.categorical_train import categorical_train
+from plmfit.functions.zero_shot import zero_shot
\ No newline at end of file
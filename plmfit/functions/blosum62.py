@@ -1,8 +1,11 @@
+import numpy as np
 import torch
 import plmfit.models.downstream_heads as heads
 from lightning import Trainer
 from lightning.pytorch.loggers import TensorBoardLogger
 from plmfit.models.lightning_model import LightningModel
+from plmfit.models.trial_batching import optimize_in_batches
+from plmfit.models.head_trainer import HeadTrainer
 from lightning.pytorch.strategies import DeepSpeedStrategy
 import optuna
 import lightning.pytorch as pl
@@ -10,6 +13,7 @@ from optuna.integration import PyTorchLightningPruningCallback
 from packaging import version
 from optuna.visualization import plot_optimization_history, plot_slice
 from plmfit.shared_utils import utils, data_explore
+from plmfit.shared_utils.embedding_store import EmbeddingStore
 from plmfit.logger import LogOptunaTrialCallback
 
 
@@ -40,9 +44,29 @@ def blosum(args, logger):
     sampler = head_config["training_parameters"].get("sampler", False) == True
 
     logger.log("Initializing BLOSUM62 encoding...")
-    max_len = data['len'].max()
-    encs = utils.blosum62_encode(data['aa_seq'].values, pad_to_length=max_len, logger=logger)
-    encs = encs.reshape(encs.shape[0], -1)
+    max_len = int(data['len'].max())
+    # "profile" encodes each residue by its 20-d BLOSUM62 row instead of the
+    # full residue-pair matrix, which is too large for long sequences
+    if head_config["architecture_parameters"].get("encoding", "pairwise") == "profile":
+        encs = utils.blosum62_profile_encode(data['aa_seq'].values, pad_to_length=max_len, logger=logger)
+        encs = encs.reshape(encs.shape[0], -1)
+    else:
+        # The residue-pair matrices are streamed into a memory-mapped store,
+        # which the data loaders read lazily, instead of being held in memory
+        encs = EmbeddingStore.create(
+            f"{logger.base_dir}/blosum62_encodings.emb",
+            (len(data), max_len * max_len),
+            np.int8,
+            encoding="blosum62",
+        )
+        utils.blosum62_encode(
+            data['aa_seq'].values,
+            pad_to_length=max_len,
+            logger=logger,
+            out=encs.array.reshape(len(data), max_len, max_len),
+        )
+        encs.flush()
+        encs = EmbeddingStore(encs.path)
     logger.log(f"BLOSUM62 encoding completed!\nEncoded sequences shape: {encs.shape}")
 
     if args.ray_tuning == "True":
@@ -94,6 +118,7 @@ def objective(
     sampler=False,
     patience=5,
     num_classes=21,
+    build_only=False,
 ):
 
     network_type = head_config["architecture_parameters"]["network_type"]
@@ -189,28 +214,47 @@ def objective(
     devices = args.gpus if torch.cuda.is_available() else 1
     strategy = strategy if torch.cuda.is_available() else "auto"
 
+    if build_only:
+        # The trial is trained by the caller, batched with other trials
+        return {
+            "model": model,
+            "data_loaders": data_loaders,
+            "epochs": epochs,
+            "epoch_sizing": model.epoch_sizing(),
+            "patience": model.early_stopping_patience(),
+        }
+
     callbacks = []
-    if on_ray_tuning:
-        callbacks.append(PyTorchLightningPruningCallback(trial, monitor=f"val_loss"))
-    callbacks.append(model.early_stopping())
-
-    trainer = Trainer(
-        default_root_dir=logger.base_dir,
-        logger=lightning_logger,
-        enable_checkpointing=False,
-        max_epochs=epochs,
-        enable_progress_bar=False,
-        accumulate_grad_batches=model.gradient_accumulation_steps(),
-        gradient_clip_val=model.gradient_clipping(),
-        limit_train_batches=(model.epoch_sizing()),
-        limit_val_batches=(model.epoch_sizing()),
-        devices=devices,
-        strategy=strategy,
-        precision="16-mixed",
-        callbacks=callbacks,
-    )
+    if training_params.get("trainer", "lightning") == "head":
+        trainer = HeadTrainer(
+            max_epochs=epochs,
+            limit_train_batches=model.epoch_sizing(),
+            limit_val_batches=model.epoch_sizing(),
+            patience=model.early_stopping_patience(),
+            trial=trial if on_ray_tuning else None,
+        )
+    else:
+        if on_ray_tuning:
+            callbacks.append(PyTorchLightningPruningCallback(trial, monitor=f"val_loss"))
+        callbacks.append(model.early_stopping())
+
+        trainer = Trainer(
+            default_root_dir=logger.base_dir,
+            logger=lightning_logger,
+            enable_checkpointing=False,
+            max_epochs=epochs,
+            enable_progress_bar=False,
+            accumulate_grad_batches=model.gradient_accumulation_steps(),
+            gradient_clip_val=model.gradient_clipping(),
+            limit_train_batches=(model.epoch_sizing()),
+            limit_val_batches=(model.epoch_sizing()),
+            devices=devices,
+            strategy=strategy,
+            precision="16-mixed",
+            callbacks=callbacks,
+        )
 
-    if on_ray_tuning:
+    if on_ray_tuning and isinstance(trainer, Trainer):
         hyperparameters = dict(
             learning_rate=head_config["training_parameters"]["learning_rate"],
             batch_size=head_config["training_parameters"]["batch_size"],
@@ -287,25 +331,37 @@ def hyperparameter_tuning(
     )
 
     logger.log("Starting hyperparameter tuning...")
-    study.optimize(
-        lambda trial: objective(
-            trial,
-            task,
-            args,
-            head_config,
-            embeddings,
-            data,
-            logger,
-            split,
-            on_ray_tuning=True,
-            num_workers=num_workers,
-            weights=weights,
-            sampler=sampler,
-            num_classes=num_classes,
-        ),
-        n_trials=n_trials if network_type == "linear" else n_trials * 4,
-        callbacks=[LogOptunaTrialCallback(logger)],
+    trial_objective = lambda trial, build_only=False: objective(
+        trial,
+        task,
+        args,
+        head_config,
+        embeddings,
+        data,
+        logger,
+        split,
+        on_ray_tuning=True,
+        num_workers=num_workers,
+        weights=weights,
+        sampler=sampler,
+        num_classes=num_classes,
+        build_only=build_only,
     )
+    trials_per_batch = head_config["training_parameters"].get("trials_per_batch", 1)
+    if trials_per_batch > 1:
+        optimize_in_batches(
+            study,
+            lambda trial: trial_objective(trial, build_only=True),
+            n_trials=n_trials if network_type == "linear" else n_trials * 4,
+            trials_per_batch=trials_per_batch,
+            callbacks=[LogOptunaTrialCallback(logger)],
+        )
+    else:
+        study.optimize(
+            trial_objective,
+            n_trials=n_trials if network_type == "linear" else n_trials * 4,
+            callbacks=[LogOptunaTrialCallback(logger)],
+        )
 
     history = plot_optimization_history(study)
     slice = plot_slice(study)
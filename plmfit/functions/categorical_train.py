@@ -3,6 +3,9 @@ import plmfit.models.downstream_heads as heads
 from lightning import Trainer
 from lightning.pytorch.loggers import TensorBoardLogger
 from plmfit.models.lightning_model import LightningModel
+from plmfit.models.trial_batching import optimize_in_batches
+from plmfit.shared_utils.embedding_store import EmbeddingStore
+from plmfit.shared_utils.study_runner import optimize_in_processes
 from lightning.pytorch.strategies import DeepSpeedStrategy
 import optuna
 from optuna.storages import JournalStorage
@@ -14,6 +17,7 @@ from optuna.visualization import plot_optimization_history, plot_slice
 from plmfit.shared_utils import utils, data_explore
 from plmfit.logger import LogOptunaTrialCallback
 import copy
+from functools import partial
 
 
 def categorical_train(args, logger):
@@ -33,7 +37,7 @@ def categorical_train(args, logger):
         raise ValueError("Cannot evaluate without a standard testing split")
 
     tokenizer = utils.load_tokenizer("proteinbert")  # Use same tokenizer as proteinbert
-    encs = utils.categorical_encode(
+    encs = utils.cached_categorical_encode(
         data["aa_seq"].values,
         tokenizer,
         max_len,
@@ -62,7 +66,8 @@ def categorical_train(args, logger):
         )
     elif task == "multilabel_classification":
         # Labels are all columns starting with 'label_'
-        scores = data[[col for col in data.columns if "label_" in col]].values
+        # Same rule as the label_* projection of DATASET_COLUMNS
+        scores = data[utils.select_columns(data.columns, ["label_*"])].values
 
         # Replace -1 with -100
         scores[scores == -1] = -100
@@ -130,6 +135,8 @@ def objective(
     sampler=False,
     patience=5,
     hyperparam_config=None,
+    build_only=False,
+    datasets=None,
 ):
     config = copy.deepcopy(head_config)
 
@@ -156,17 +163,25 @@ def objective(
 
     training_params = config["training_parameters"]
 
-    data_loaders = utils.create_data_loaders(
-        embeddings,
-        scores,
-        scaler=training_params["scaler"],
-        batch_size=training_params["batch_size"],
-        validation_size=training_params["val_split"],
-        split=split,
-        num_workers=num_workers,
-        weights=weights,
-        sampler=sampler,
-    )
+    if datasets is not None:
+        data_loaders = utils.build_data_loaders(
+            **datasets,
+            batch_size=training_params["batch_size"],
+            num_workers=num_workers,
+            sampler=sampler,
+        )
+    else:
+        data_loaders = utils.create_data_loaders(
+            embeddings,
+            scores,
+            scaler=training_params["scaler"],
+            batch_size=training_params["batch_size"],
+            validation_size=training_params["val_split"],
+            split=split,
+            num_workers=num_workers,
+            weights=weights,
+            sampler=sampler,
+        )
 
     input_dim = embeddings.shape[1]
 
@@ -199,6 +214,16 @@ def objective(
         model.early_stopping() if not on_ray_tuning else model.early_stopping(patience)
     )
 
+    if build_only:
+        # The trial is trained by the caller, batched with other trials
+        return {
+            "model": model,
+            "data_loaders": data_loaders,
+            "epochs": epochs,
+            "epoch_sizing": epoch_sizing,
+            "patience": patience,
+        }
+
     trainer = Trainer(
         default_root_dir=logger.base_dir,
         logger=lightning_logger,
@@ -299,6 +324,25 @@ def hyperparameter_tuning(
     # 1. Number of trials
     n_trials = network_config["n_trials"]
 
+    n_processes = network_config.get("n_processes", 1)
+    if n_processes > 1 and not isinstance(embeddings, EmbeddingStore):
+        # Worker processes reopen the features as a memory map instead of copying them
+        embeddings = EmbeddingStore.write(f"{logger.base_dir}/optuna_features.emb", embeddings)
+
+    # The split, scaler and sample weights are built once and shared by all
+    # trials, unless they are tuned
+    datasets = None
+    if not {"scaler", "val_split"} & network_config["training_parameters"].keys():
+        datasets = utils.split_datasets(
+            embeddings,
+            scores,
+            split=split,
+            validation_size=head_config["training_parameters"]["val_split"],
+            scaler=head_config["training_parameters"]["scaler"],
+            weights=weights,
+            sampler=sampler,
+        )
+
     storage = JournalStorage(
         JournalFileBackend(f"{logger.base_dir}/optuna_journal_storage.log")
     )
@@ -313,28 +357,51 @@ def hyperparameter_tuning(
 
     logger.log("Starting hyperparameter tuning...")
     logger.mute = True
-    study.optimize(
-        lambda trial: objective(
-            trial,
-            task,
-            args,
-            head_config,
-            embeddings,
-            scores,
-            logger,
-            split,
-            on_ray_tuning=True,
-            num_workers=num_workers,
-            weights=weights,
-            sampler=sampler,
-            hyperparam_config=network_config,
-        ),
-        n_trials=n_trials,
-        callbacks=[LogOptunaTrialCallback(logger)],
-        n_jobs=int(args.gpus) if int(args.gpus) > 0 else 1,
-        gc_after_trial=True,
-        catch=(FileNotFoundError,),
+    trial_objective = partial(
+        objective,
+        task=task,
+        args=args,
+        head_config=head_config,
+        embeddings=embeddings,
+        scores=scores,
+        logger=logger,
+        split=split,
+        on_ray_tuning=True,
+        num_workers=num_workers,
+        weights=weights,
+        sampler=sampler,
+        hyperparam_config=network_config,
+        datasets=datasets,
     )
+    trials_per_batch = network_config.get("trials_per_batch", 1)
+    if n_processes > 1:
+        optimize_in_processes(
+            study,
+            trial_objective,
+            n_trials=n_trials,
+            n_processes=n_processes,
+            trials_per_batch=trials_per_batch,
+            callbacks=[LogOptunaTrialCallback(logger)],
+            catch=(FileNotFoundError,),
+        )
+    elif trials_per_batch > 1:
+        optimize_in_batches(
+            study,
+            lambda trial: trial_objective(trial, build_only=True),
+            n_trials=n_trials,
+            trials_per_batch=trials_per_batch,
+            callbacks=[LogOptunaTrialCallback(logger)],
+            catch=(FileNotFoundError,),
+        )
+    else:
+        study.optimize(
+            trial_objective,
+            n_trials=n_trials,
+            callbacks=[LogOptunaTrialCallback(logger)],
+            n_jobs=int(args.gpus) if int(args.gpus) > 0 else 1,
+            gc_after_trial=True,
+            catch=(FileNotFoundError,),
+        )
     logger.mute = False
     history = plot_optimization_history(study)
     slice = plot_slice(study)
@@ -2,9 +2,12 @@ import torch
 from plmfit.shared_utils import utils
 from lightning import Trainer
 from lightning.pytorch.loggers import TensorBoardLogger
-from plmfit.models.lightning_model import LightningModel, PredictionWriter
+from plmfit.models.lightning_model import (
+    LightningModel,
+    PredictionWriter,
+    ShardedPredictionWriter,
+)
 from lightning.pytorch.strategies import DeepSpeedStrategy
-from deepspeed.runtime.zero.stage3 import estimate_zero3_model_states_mem_needs_all_live
 from lightning.pytorch.tuner import Tuner
 
 def extract_embeddings(args, logger):
@@ -12,21 +15,79 @@ def extract_embeddings(args, logger):
     # Load dataset
     data = utils.load_dataset(args.data_type)
 
-    model = utils.init_plm(args.plm, logger, task="extract_embeddings")
+    # Comma separated layers and reductions are all extracted from one forward pass
+    layers = args.layer.split(",")
+    model = utils.init_plm(args.plm, logger, task="extract_embeddings", layers=layers)
 
     model.experimenting = (
         args.experimenting == "True"
     )  # If we are in experimenting mode
 
-    model.set_layer_to_use(args.layer)
-    model.py_model.reduction = args.reduction
+    reductions = [
+        int(reduction) if reduction.isdigit() else reduction
+        for reduction in args.reduction.split(",")
+    ]
+    if len(layers) == 1 and len(reductions) == 1:
+        model.set_layer_to_use(layers[0])
+        model.py_model.reduction = reductions[0]
+        outputs = [None]
+    else:
+        model.set_layers_to_use(layers)
+        model.py_model.reduction = reductions
+        outputs = [
+            f"layer{layer}_{reduction}" for layer in layers for reduction in reductions
+        ]
 
     encs = model.categorical_encode(data)
     encs = torch.tensor(encs)
 
     logger.save_data(vars(args), "arguments")
 
-    data_loader = utils.create_predict_data_loader(encs, batch_size=args.batch_size)
+    indices = None
+    if args.shard_size > 0:
+        pred_writers = [
+            ShardedPredictionWriter(
+                logger=logger,
+                shard_size=args.shard_size,
+                width=encs.shape[1],
+                output_index=None if name is None else i,
+                name=name,
+            )
+            for i, name in enumerate(outputs)
+        ]
+        # Samples in shards completed by a previous run are skipped
+        indices = sorted(
+            set().union(*[writer.pending_indices(len(encs)) for writer in pred_writers])
+        )
+        if len(indices) == 0:
+            logger.log("All embeddings already extracted")
+            return
+        logger.log(f"Extracting embeddings for {len(indices)} / {len(encs)} sequences")
+    else:
+        pred_writers = [
+            PredictionWriter(
+                logger=logger,
+                write_interval="epoch",
+                split_size=args.split_size,
+                format=args.embeddings_format,
+                output_index=None if name is None else i,
+                name=name,
+                metadata={
+                    "model": args.plm,
+                    "data_type": args.data_type,
+                    "layer": args.layer if name is None else layers[i // len(reductions)],
+                    "reduction": args.reduction if name is None else reductions[i % len(reductions)],
+                },
+            )
+            for i, name in enumerate(outputs)
+        ]
+
+    data_loader = utils.create_predict_data_loader(
+        encs,
+        batch_size=args.batch_size,
+        pad_token=model.get_pad_token_id(),
+        indices=indices,
+    )
 
     model = LightningModel(
         model.py_model,
@@ -50,8 +111,6 @@ def extract_embeddings(args, logger):
     devices = args.gpus if torch.cuda.is_available() else 1
     strategy = strategy if torch.cuda.is_available() else "auto"
 
-    pred_writer = PredictionWriter(logger=logger, write_interval="epoch", split_size=args.split_size)
-
     trainer = Trainer(
         default_root_dir=logger.base_dir,
         logger=lightning_logger,
@@ -59,7 +118,7 @@ def extract_embeddings(args, logger):
         devices=devices,
         strategy=strategy,
         precision="16-mixed",
-        callbacks=[pred_writer],
+        callbacks=pred_writers,
     )
     # tuner = Tuner(trainer)
 
@@ -67,8 +126,15 @@ def extract_embeddings(args, logger):
     # tuner.scale_batch_size(model, mode="power")
 
     if torch.cuda.is_available():
+        from deepspeed.runtime.zero.stage3 import (
+            estimate_zero3_model_states_mem_needs_all_live,
+        )
+
         estimate_zero3_model_states_mem_needs_all_live(
             model, num_gpus_per_node=int(args.gpus), num_nodes=1
         )
 
-    trainer.predict(model=model, dataloaders=data_loader)
+    # Streamed predictions must not be gathered in memory by the trainer
+    trainer.predict(
+        model=model, dataloaders=data_loader, return_predictions=args.shard_size == 0
+    )
@@ -3,6 +3,10 @@ import plmfit.models.downstream_heads as heads
 from lightning import Trainer
 from lightning.pytorch.loggers import TensorBoardLogger
 from plmfit.models.lightning_model import LightningModel
+from plmfit.models.trial_batching import optimize_in_batches
+from plmfit.shared_utils.embedding_store import EmbeddingStore, ShardedEmbeddings
+from plmfit.shared_utils.study_runner import optimize_in_processes
+from plmfit.models.head_trainer import HeadTrainer
 import optuna
 from optuna.storages import JournalStorage
 from optuna.storages.journal import JournalFileBackend
@@ -14,6 +18,7 @@ from plmfit.shared_utils import utils, data_explore
 from plmfit.logger import LogOptunaTrialCallback
 import gc
 import copy
+from functools import partial
 
 
 def feature_extraction(args, logger):
@@ -43,9 +48,6 @@ def feature_extraction(args, logger):
         layer=args.layer,
         reduction=args.reduction,
     )
-    assert (
-        embeddings != None
-    ), "Couldn't find embeddings, use the full path of the embeddings file (.pt) or you can use extract_embeddings function to create and save the embeddings."
 
     if task == "regression":
         scores = data["score"].values
@@ -71,7 +73,8 @@ def feature_extraction(args, logger):
         )
     elif task == "multilabel_classification":
         # Labels are all columns starting with 'label_'
-        scores = data[[col for col in data.columns if "label_" in col]].values
+        # Same rule as the label_* projection of DATASET_COLUMNS
+        scores = data[utils.select_columns(data.columns, ["label_*"])].values
 
         # Replace -1 with -100
         scores[scores == -1] = -100
@@ -128,6 +131,8 @@ def objective(
     sampler=False,
     patience=5,
     hyperparam_config=None,
+    build_only=False,
+    datasets=None,
 ):
     config = copy.deepcopy(head_config)
 
@@ -149,17 +154,25 @@ def objective(
                     p_range[1], p_type)
 
     training_params = config["training_parameters"]
-    data_loaders = utils.create_data_loaders(
-        embeddings,
-        scores,
-        scaler=training_params["scaler"],
-        batch_size=training_params["batch_size"],
-        validation_size=training_params["val_split"],
-        split=split,
-        num_workers=num_workers,
-        weights=weights,
-        sampler=sampler,  
-    )
+    if datasets is not None:
+        data_loaders = utils.build_data_loaders(
+            **datasets,
+            batch_size=training_params["batch_size"],
+            num_workers=num_workers,
+            sampler=sampler,
+        )
+    else:
+        data_loaders = utils.create_data_loaders(
+            embeddings,
+            scores,
+            scaler=training_params["scaler"],
+            batch_size=training_params["batch_size"],
+            validation_size=training_params["val_split"],
+            split=split,
+            num_workers=num_workers,
+            weights=weights,
+            sampler=sampler,  
+        )
 
     model = heads.init_head(
         config=config, input_dim=embeddings.shape[-1]
@@ -195,26 +208,47 @@ def objective(
     epoch_sizing = model.epoch_sizing()
     if on_ray_tuning:
         epoch_sizing = hyperparam_config["epoch_sizing"]
-        callbacks.append(PyTorchLightningPruningCallback(trial, monitor=f"val_loss"))
-    callbacks.append(model.early_stopping() if not on_ray_tuning else model.early_stopping(patience))
-
-    trainer = Trainer(
-        default_root_dir=logger.base_dir,
-        logger=lightning_logger,
-        enable_checkpointing=False,
-        max_epochs=epochs,
-        enable_progress_bar=False,
-        accumulate_grad_batches=model.gradient_accumulation_steps(),
-        gradient_clip_val=model.gradient_clipping(),
-        limit_train_batches=epoch_sizing,
-        limit_val_batches=epoch_sizing,
-        devices=devices,
-        strategy=strategy,
-        precision="16-mixed",
-        callbacks=callbacks,
-    )
 
-    if on_ray_tuning:
+    if build_only:
+        # The trial is trained by the caller, batched with other trials
+        return {
+            "model": model,
+            "data_loaders": data_loaders,
+            "epochs": epochs,
+            "epoch_sizing": epoch_sizing,
+            "patience": patience,
+        }
+
+    if training_params.get("trainer", "lightning") == "head":
+        trainer = HeadTrainer(
+            max_epochs=epochs,
+            limit_train_batches=epoch_sizing,
+            limit_val_batches=epoch_sizing,
+            patience=model.early_stopping_patience() if not on_ray_tuning else patience,
+            trial=trial if on_ray_tuning else None,
+        )
+    else:
+        if on_ray_tuning:
+            callbacks.append(PyTorchLightningPruningCallback(trial, monitor=f"val_loss"))
+        callbacks.append(model.early_stopping() if not on_ray_tuning else model.early_stopping(patience))
+
+        trainer = Trainer(
+            default_root_dir=logger.base_dir,
+            logger=lightning_logger,
+            enable_checkpointing=False,
+            max_epochs=epochs,
+            enable_progress_bar=False,
+            accumulate_grad_batches=model.gradient_accumulation_steps(),
+            gradient_clip_val=model.gradient_clipping(),
+            limit_train_batches=epoch_sizing,
+            limit_val_batches=epoch_sizing,
+            devices=devices,
+            strategy=strategy,
+            precision="16-mixed",
+            callbacks=callbacks,
+        )
+
+    if on_ray_tuning and isinstance(trainer, Trainer):
         hyperparameters = dict()
         for param_name, _ in hyperparam_config["architecture_parameters"].items():
             hyperparameters[param_name] = config["architecture_parameters"][param_name]
@@ -228,7 +262,9 @@ def objective(
         trainer.fit(model, data_loaders["train"], data_loaders["val"])
 
         if on_ray_tuning:
-            callbacks[0].check_pruned()
+            # The head trainer stops pruned trials itself
+            if callbacks:
+                callbacks[0].check_pruned()
             return trainer.callback_metrics[f"val_loss"].item()
         
         loss_plot = data_explore.create_loss_plot(
@@ -289,6 +325,25 @@ def hyperparameter_tuning(
     # 1. Number of trials
     n_trials = network_config["n_trials"]
 
+    n_processes = network_config.get("n_processes", 1)
+    if n_processes > 1 and not isinstance(embeddings, (EmbeddingStore, ShardedEmbeddings)):
+        # Worker processes reopen the features as a memory map instead of copying them
+        embeddings = EmbeddingStore.write(f"{logger.base_dir}/optuna_features.emb", embeddings)
+
+    # The split, scaler and sample weights are built once and shared by all
+    # trials, unless they are tuned
+    datasets = None
+    if not {"scaler", "val_split"} & network_config["training_parameters"].keys():
+        datasets = utils.split_datasets(
+            embeddings,
+            scores,
+            split=split,
+            validation_size=head_config["training_parameters"]["val_split"],
+            scaler=head_config["training_parameters"]["scaler"],
+            weights=weights,
+            sampler=sampler,
+        )
+
     storage = JournalStorage(
         JournalFileBackend(f"{logger.base_dir}/optuna_journal_storage.log")
     )
@@ -303,28 +358,51 @@ def hyperparameter_tuning(
 
     logger.log("Starting hyperparameter tuning...")
     logger.mute = True
-    study.optimize(
-        lambda trial: objective(
-            trial,
-            task,
-            args,
-            head_config,
-            embeddings,
-            scores,
-            logger,
-            split,
-            on_ray_tuning=True,
-            num_workers=num_workers,
-            weights=weights,
-            sampler=sampler,
-            hyperparam_config=network_config,
-        ),
-        n_trials=n_trials,
-        callbacks=[LogOptunaTrialCallback(logger)],
-        n_jobs=int(args.gpus),
-        gc_after_trial=True,
-        catch=(FileNotFoundError,),
+    trial_objective = partial(
+        objective,
+        task=task,
+        args=args,
+        head_config=head_config,
+        embeddings=embeddings,
+        scores=scores,
+        logger=logger,
+        split=split,
+        on_ray_tuning=True,
+        num_workers=num_workers,
+        weights=weights,
+        sampler=sampler,
+        hyperparam_config=network_config,
+        datasets=datasets,
     )
+    trials_per_batch = network_config.get("trials_per_batch", 1)
+    if n_processes > 1:
+        optimize_in_processes(
+            study,
+            trial_objective,
+            n_trials=n_trials,
+            n_processes=n_processes,
+            trials_per_batch=trials_per_batch,
+            callbacks=[LogOptunaTrialCallback(logger)],
+            catch=(FileNotFoundError,),
+        )
+    elif trials_per_batch > 1:
+        optimize_in_batches(
+            study,
+            lambda trial: trial_objective(trial, build_only=True),
+            n_trials=n_trials,
+            trials_per_batch=trials_per_batch,
+            callbacks=[LogOptunaTrialCallback(logger)],
+            catch=(FileNotFoundError,),
+        )
+    else:
+        study.optimize(
+            trial_objective,
+            n_trials=n_trials,
+            callbacks=[LogOptunaTrialCallback(logger)],
+            n_jobs=int(args.gpus),
+            gc_after_trial=True,
+            catch=(FileNotFoundError,),
+        )
     logger.mute = False
     history = plot_optimization_history(study)
     slice = plot_slice(study)
@@ -11,7 +11,6 @@ from lightning.pytorch.loggers import TensorBoardLogger
 from lightning.pytorch.utilities.deepspeed import (
     convert_zero_checkpoint_to_fp32_state_dict,
 )
-from deepspeed.runtime.zero.stage3 import estimate_zero3_model_states_mem_needs_all_live
 from plmfit.models.lightning_model import LightningModel
 from lightning.pytorch.strategies import DeepSpeedStrategy
 import ast
@@ -34,7 +33,7 @@ def fine_tune(args, logger):
     if args.evaluate == "True" and split is None:
         raise ValueError("Cannot evaluate without a standard testing split")
 
-    model = utils.init_plm(args.plm, logger, task=task)
+    model = utils.init_plm(args.plm, logger, task=task, layers=[args.layer])
 
     if args.zeroed == "True":
         model.zeroed_model()
@@ -97,6 +96,8 @@ def fine_tune(args, logger):
         log_interval=100,
         experimenting=model.experimenting,
     )
+    if task == "masked_lm" and data_loaders["train"].collate_fn.on_device:
+        model.mlm_collator = data_loaders["train"].collate_fn
     lightning_logger = TensorBoardLogger(
         save_dir=logger.base_dir, version=0, name="lightning_logs"
     )
@@ -137,6 +138,10 @@ def fine_tune(args, logger):
         callbacks=[model.early_stopping()],
     )
     if torch.cuda.is_available():
+        from deepspeed.runtime.zero.stage3 import (
+            estimate_zero3_model_states_mem_needs_all_live,
+        )
+
         estimate_zero3_model_states_mem_needs_all_live(
             model, num_gpus_per_node=int(args.gpus), num_nodes=1
         )
@@ -254,6 +259,7 @@ def downstream_prep(
         num_workers=0,
         weights=weights,
         sampler=sampler,
+        pad_token=model.get_pad_token_id(),
     )
 
     return data_loaders, training_params
@@ -311,6 +317,7 @@ def masked_lm_prep(model, args, data, split, task, head_config, logger):
         mlm_probability=head_config["architecture_parameters"]["mlm_probability"],
         mutation_boost_factor=mutation_boost_factor,
         split_ratios=(train_size, val_size, test_size),
+        mask_on_device=training_params.get("mask_on_device", False),
     )
 
     return data_loaders, training_params
@@ -31,6 +31,7 @@ def predict(args, logger):
             model_metadata["arguments"]["plm"],
             logger,
             task=model_metadata["head_config"]["architecture_parameters"]["task"],
+            layers=[model_metadata["arguments"]["layer"]],
         )
         assert model != None, "Model is not initialized"
         model.set_layer_to_use(model_metadata["arguments"]["layer"])
@@ -86,7 +87,9 @@ def predict(args, logger):
         # Encode input data
         encoded_input_data = model.categorical_encode(input_data)
         data_loader = utils.create_predict_data_loader(
-            encoded_input_data, batch_size=args.batch_size
+            encoded_input_data,
+            batch_size=args.batch_size,
+            pad_token=model.get_pad_token_id(),
         )
 
         model = model.py_model
@@ -137,22 +140,28 @@ def predict(args, logger):
 
         tokenizer = utils.load_tokenizer("proteinbert")  # Use same tokenizer as proteinbert
         num_classes = tokenizer.get_vocab_size(with_added_tokens=False)
-        encoded_input_data = utils.categorical_encode(
+        encoded_input_data = utils.cached_categorical_encode(
             input_data["aa_seq"].values,
             tokenizer,
             max_len,
             logger=logger,
             model_name="proteinbert",
         )
-        data_loader = utils.create_predict_data_loader(
-            encoded_input_data, batch_size=args.batch_size, dataset_type="one_hot"
-        )
-        data_loader.dataset.set_num_classes(num_classes)
-        if (
-            model_metadata["head_config"]["architecture_parameters"]["task"]
-            == "token_classification"
-        ):
-            data_loader.dataset.set_flatten(False)
+        if model_metadata["head_config"]["architecture_parameters"].get("one_hot_classes"):
+            # The head expands token ids to one-hot on the device
+            data_loader = utils.create_predict_data_loader(
+                encoded_input_data, batch_size=args.batch_size
+            )
+        else:
+            data_loader = utils.create_predict_data_loader(
+                encoded_input_data, batch_size=args.batch_size, dataset_type="one_hot"
+            )
+            data_loader.dataset.set_num_classes(num_classes)
+            if (
+                model_metadata["head_config"]["architecture_parameters"]["task"]
+                == "token_classification"
+            ):
+                data_loader.dataset.set_flatten(False)
 
     model.eval()
 
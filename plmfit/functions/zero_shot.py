@@ -0,0 +1,220 @@
+import os
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+import torch
+
+from plmfit.shared_utils import utils
+from plmfit.models.zero_shot import (
+    MASKED_MARGINAL_RESIDUES,
+    WildTypePrefixScorer,
+    encode_progen,
+    masked_marginal_log_odds,
+    masked_marginal_scores,
+    mutated_positions,
+    sequence_log_likelihoods,
+    shared_prefix_lengths,
+)
+
+# Rows scored and written to disk together, as a number of batches
+BATCHES_PER_CHUNK = 64
+
+
+def zero_shot(args, logger):
+    if args.scoring == "masked_marginal":
+        if "esm2" not in args.plm:
+            raise ValueError("Masked-marginal scoring is supported for ESM2 models")
+        task = "masked_lm"
+    elif "progen" in args.plm:
+        task = "causal_lm"
+    else:
+        raise ValueError(f"Scoring '{args.scoring}' is supported for ProGen2 models")
+
+    # Only the sequences are needed, the scores are joined back on their index
+    data = utils.load_dataset(args.data_type, columns=["aa_seq"])
+    model = utils.init_plm(args.plm, logger, task=task)
+    logger.save_data(vars(args), "arguments")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.py_model.to(device).eval()
+    autocast = (
+        torch.autocast("cuda", dtype=torch.float16)
+        if device.type == "cuda"
+        else nullcontext()
+    )
+
+    output_path = f"{logger.base_dir}/{logger.experiment_name}_scores.csv"
+    start_time = time.time()
+    with autocast, open(output_path, "w") as output:
+        if args.scoring == "likelihood":
+            score_likelihoods(
+                model, data["aa_seq"].values, args.batch_size, device, output, logger
+            )
+        elif args.scoring == "masked_marginal":
+            score_masked_marginals(
+                model,
+                data["aa_seq"].values,
+                utils.get_wild_type(args.data_type),
+                args.batch_size,
+                f"{utils.data_dir}/{args.data_type}/zero_shot/{args.data_type}_{args.plm}_masked_marginals.npz",
+                output,
+                logger,
+            )
+        else:
+            score_variants(
+                model,
+                data["aa_seq"].values,
+                utils.get_wild_type(args.data_type),
+                args.batch_size,
+                device,
+                output,
+                logger,
+            )
+    logger.log(
+        f"Scored {len(data)} sequences in {time.time() - start_time:.2f}s, saved to {output_path}"
+    )
+
+
+def write_scores(output, scores):
+    """Appends the scores of a chunk to the output CSV and flushes it."""
+    pd.DataFrame(scores).to_csv(output, header=output.tell() == 0, index=False)
+    output.flush()
+
+
+def score_likelihoods(model, sequences, batch_size, device, output, logger):
+    """
+    Scores each sequence by its log-likelihood under ProGen2, averaged over
+    reading it N to C terminus and C to N terminus. Sequences are batched by
+    length to keep the padding small.
+    """
+    tokenizer = model.get_tokenizer()
+    order = np.argsort([len(sequence) for sequence in sequences], kind="stable")
+    chunk_size = batch_size * BATCHES_PER_CHUNK
+    for chunk_start in range(0, len(order), chunk_size):
+        chunk = order[chunk_start : chunk_start + chunk_size]
+        log_likelihoods = np.zeros(len(chunk))
+        lengths = np.zeros(len(chunk), dtype=np.int64)
+        for batch_start in range(0, len(chunk), batch_size):
+            batch = slice(batch_start, batch_start + batch_size)
+            batch_sequences = sequences[chunk[batch]]
+            for reverse in (False, True):
+                input_ids = encode_progen(tokenizer, batch_sequences, reverse=reverse)
+                batch_log_likelihoods, residues = sequence_log_likelihoods(
+                    model.py_model, input_ids.to(device)
+                )
+                log_likelihoods[batch] += batch_log_likelihoods.cpu().numpy() / 2
+                lengths[batch] = residues.cpu().numpy()
+        write_scores(
+            output,
+            {
+                "index": chunk,
+                "log_likelihood": log_likelihoods,
+                "mean_log_likelihood": log_likelihoods / np.maximum(lengths, 1),
+            },
+        )
+        logger.log(f"Scored {chunk_start + len(chunk)} / {len(order)} sequences")
+
+
+def score_variants(model, sequences, wild_type, batch_size, device, output, logger):
+    """
+    Scores each variant by its log-likelihood ratio to the wild type, averaged
+    over both reading directions. In each direction the variants are batched
+    by the prefix they share with the wild type, which is read from the wild
+    type's key/value cache instead of being run through the model again.
+    """
+    tokenizer = model.get_tokenizer()
+    scorers = [
+        WildTypePrefixScorer(
+            model.py_model, encode_progen(tokenizer, [wild_type], reverse=reverse)[0].to(device)
+        )
+        for reverse in (False, True)
+    ]
+    wild_type_log_likelihood = sum(scorer.log_likelihood for scorer in scorers) / 2
+    logger.log(f"Wild type log-likelihood: {wild_type_log_likelihood:.4f}")
+
+    # Variants sharing the longest prefix with the wild type come first
+    prefix_lengths = shared_prefix_lengths(sequences, wild_type)
+    order = np.argsort(-prefix_lengths, kind="stable")
+    chunk_size = batch_size * BATCHES_PER_CHUNK
+    for chunk_start in range(0, len(order), chunk_size):
+        chunk = order[chunk_start : chunk_start + chunk_size]
+        chunk_sequences = sequences[chunk]
+        log_likelihoods = np.zeros(len(chunk))
+        for reverse, scorer in zip((False, True), scorers):
+            if reverse:
+                # Reading C to N terminus, the shared prefix is the wild type's C terminus
+                chunk_prefix_lengths = shared_prefix_lengths(
+                    [sequence[::-1] for sequence in chunk_sequences], wild_type[::-1]
+                )
+            else:
+                chunk_prefix_lengths = prefix_lengths[chunk]
+            chunk_order = np.argsort(-chunk_prefix_lengths, kind="stable")
+            for batch_start in range(0, len(chunk), batch_size):
+                batch = chunk_order[batch_start : batch_start + batch_size]
+                input_ids = encode_progen(tokenizer, chunk_sequences[batch], reverse=reverse)
+                batch_log_likelihoods, _ = scorer(
+                    input_ids.to(device), int(chunk_prefix_lengths[batch].min())
+                )
+                log_likelihoods[batch] += batch_log_likelihoods.cpu().numpy() / 2
+        write_scores(
+            output,
+            {
+                "index": chunk,
+                "log_likelihood": log_likelihoods,
+                "score": log_likelihoods - wild_type_log_likelihood,
+            },
+        )
+        logger.log(f"Scored {chunk_start + len(chunk)} / {len(order)} variants")
+
+
+def load_masked_marginals(path, wild_type):
+    """
+    Reads the masked-marginal table cached for `wild_type` at `path`.
+
+    Returns:
+        tuple: The L x 20 log-odds table and which of its positions are computed.
+        Nothing is computed if there is no cache or it is for another wild type.
+    """
+    if os.path.isfile(path):
+        cache = np.load(path)
+        if str(cache["wild_type"]) == wild_type:
+            return cache["log_odds"], cache["computed"]
+    return (
+        np.full((len(wild_type), len(MASKED_MARGINAL_RESIDUES)), np.nan, dtype=np.float32),
+        np.zeros(len(wild_type), dtype=bool),
+    )
+
+
+def score_masked_marginals(
+    model, sequences, wild_type, batch_size, cache_path, output, logger
+):
+    """
+    Scores substitution variants of the wild type by the sum of the
+    masked-marginal log-odds of their mutations. The log-odds table is built
+    with one masked forward pass per mutated position and cached at
+    `cache_path`, so the cost grows with the length of the protein rather
+    than the size of the library.
+    """
+    log_odds, computed = load_masked_marginals(cache_path, wild_type)
+    positions = mutated_positions(sequences, wild_type)
+    missing = positions[~computed[positions]]
+    logger.log(
+        f"{len(positions)} mutated positions, computing the masked marginals of {len(missing)}"
+    )
+    if len(missing):
+        log_odds[missing] = masked_marginal_log_odds(
+            model.py_model, model.get_tokenizer(), wild_type, missing, batch_size
+        )
+        computed[missing] = True
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.savez(cache_path, wild_type=wild_type, log_odds=log_odds, computed=computed)
+
+    scores = masked_marginal_scores(log_odds, sequences, wild_type)
+    skipped = np.isnan(scores).sum()
+    if skipped:
+        logger.log(
+            f"{skipped} sequences are not substitution variants of the wild type and are not scored"
+        )
+    write_scores(output, {"index": np.arange(len(sequences)), "score": scores})
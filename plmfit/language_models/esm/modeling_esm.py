@@ -4,7 +4,7 @@ import torch
 from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 from transformers.modeling_outputs import SequenceClassifierOutput, MaskedLMOutput, TokenClassifierOutput
-from plmfit.shared_utils.poolers import GeneralPooler
+from plmfit.shared_utils.poolers import GeneralPooler, capture_layers, pool_layers
 
 class PlmfitEsmForMaskedLM(EsmForMaskedLM):
     _keys_to_ignore_on_load_missing = [r"position_ids", "lm_head.decoder.weight"]
@@ -117,6 +117,9 @@ class PlmfitEsmForSequenceClassification(EsmForSequenceClassification):
         """
         if input_ids is not None:
             input_ids = input_ids.int()
+            if attention_mask is None:
+                # Padding tokens are neither attended to nor pooled
+                attention_mask = (input_ids != self.config.pad_token_id).long()
 
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
@@ -131,7 +134,12 @@ class PlmfitEsmForSequenceClassification(EsmForSequenceClassification):
             return_dict=return_dict,
         )
         sequence_output = outputs[0]
-        pooled_output = self.esm.pooler(sequence_output, pooling_method=self.reduction)
+        pooled_output = self.esm.pooler(
+            sequence_output,
+            pooling_method=self.reduction,
+            attention_mask=attention_mask,
+            input_ids=input_ids,
+        )
         logits = self.classifier(pooled_output)
 
         loss = None
@@ -208,6 +216,9 @@ class PlmfitEsmForTokenClassification(EsmForTokenClassification):
         """
         if input_ids is not None:
             input_ids = input_ids.int()
+            if attention_mask is None:
+                # Padding tokens are neither attended to nor pooled
+                attention_mask = (input_ids != self.config.pad_token_id).long()
 
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
@@ -268,6 +279,8 @@ class PlmfitEsmForEmbdeddingsExtraction(EsmForSequenceClassification):
     def __init__(self, config):
         super().__init__(config)
         self.reduction = "mean"
+        # Layers to pool in a single pass, with `reduction` a list of reductions
+        self.layers = None
         self.esm.pooler = GeneralPooler(config=config)
         del self.esm.contact_head
         del self.classifier
@@ -292,23 +305,49 @@ class PlmfitEsmForEmbdeddingsExtraction(EsmForSequenceClassification):
 
         if input_ids is not None:
             input_ids = input_ids.int()
+            if attention_mask is None:
+                # Padding tokens are neither attended to nor pooled
+                attention_mask = (input_ids != self.config.pad_token_id).long()
 
         return_dict = (
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
-        outputs = self.esm(
-            input_ids,
-            attention_mask=attention_mask,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+        # Only the outputs of the pooled layers are kept, not the hidden states of every layer
+        with capture_layers(self.esm.encoder.layer, self.layers or []) as layer_outputs:
+            outputs = self.esm(
+                input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+            )
         sequence_output = outputs[0]
-        pooled_output = self.esm.pooler(sequence_output, pooling_method=self.reduction)        
+        if self.layers is not None:
+            # Intermediate layers get the final layer norm, as the last layer of a model trimmed to them would
+            norm = self.esm.encoder.emb_layer_norm_after or nn.Identity()
+            last_layer = len(self.esm.encoder.layer) - 1
+            layer_states = [
+                sequence_output if layer == last_layer else norm(layer_outputs[layer])
+                for layer in self.layers
+            ]
+            pooled_output = pool_layers(
+                self.esm.pooler,
+                layer_states,
+                self.reduction,
+                attention_mask=attention_mask,
+                input_ids=input_ids,
+            )
+        else:
+            pooled_output = self.esm.pooler(
+                sequence_output,
+                pooling_method=self.reduction,
+                attention_mask=attention_mask,
+                input_ids=input_ids,
+            )
 
         return SequenceClassifierOutput(
             loss=None,
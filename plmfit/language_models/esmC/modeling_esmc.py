@@ -4,7 +4,7 @@ from torch import nn
 from transformers.modeling_outputs import (
     SequenceClassifierOutput
 )
-from plmfit.shared_utils.poolers import GeneralPooler
+from plmfit.shared_utils.poolers import GeneralPooler, pool_layers
 from esm.models.esmc import ESMC
 from esm.tokenization import EsmSequenceTokenizer
 from transformers import EsmConfig
@@ -57,13 +57,15 @@ class PlmfitEsmCForSequenceClassification(ESMC):
 
     @classmethod
     def from_pretrained(
-        cls, model_name, device: torch.device | None = None
+        cls, model_name, device: torch.device | None = None, n_layers: int | None = None
     ):
         from plmfit.language_models.esmC.pretrained import load_local_model
 
         if device is None:
             device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model = load_local_model(model_name, device=device, model_class=cls)
+        model = load_local_model(
+            model_name, device=device, model_class=cls, n_layers=n_layers
+        )
         if device.type != "cpu":
             model = model.to(torch.bfloat16)
         assert isinstance(model, cls)
@@ -90,6 +92,7 @@ class PlmfitEsmCForSequenceClassification(ESMC):
         self,
         input_ids: torch.Tensor | None = None,
         attention_mask: torch.Tensor | None = None,
+        output_hidden_states: bool = False,
     ) -> Union[Tuple, SequenceClassifierOutput]:
         r"""
         labels (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
@@ -134,15 +137,20 @@ class PlmfitEsmCForSequenceClassification(ESMC):
         #         for h in hiddens
         #     ]
 
-        # Stack hidden states into a [n_layers, B, L, D] matrix.
-        hiddens = torch.stack(hiddens, dim=0)  # type: ignore
+        # Stack hidden states into a [n_layers, B, L, D] matrix, only when they are returned
+        all_hidden_states = torch.stack(hiddens, dim=0) if output_hidden_states else None
 
-        pooled_output = self.pooler(x, pooling_method=self.reduction)
+        pooled_output = self.pooler(
+            x,
+            pooling_method=self.reduction,
+            attention_mask=attention_mask,
+            input_ids=input_ids,
+        )
         logits = self.classifier(pooled_output)
 
         return SequenceClassifierOutput(
             logits=logits,
-            hidden_states=hiddens
+            hidden_states=all_hidden_states
         )
 
 class PlmfitEsmCForEmbdeddingsExtraction(ESMC):
@@ -166,16 +174,22 @@ class PlmfitEsmCForEmbdeddingsExtraction(ESMC):
             d_model=d_model, n_heads=n_heads, n_layers=n_layers
         )
         self.reduction = "mean"
+        # Layers to pool in a single pass, with `reduction` a list of reductions
+        self.layers = None
         self.pooler = GeneralPooler()
         del self.sequence_head
 
     @classmethod
-    def from_pretrained(cls, model_name, device: torch.device | None = None):
+    def from_pretrained(
+        cls, model_name, device: torch.device | None = None, n_layers: int | None = None
+    ):
         from plmfit.language_models.esmC.pretrained import load_local_model
 
         if device is None:
             device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model = load_local_model(model_name, device=device, model_class=cls)
+        model = load_local_model(
+            model_name, device=device, model_class=cls, n_layers=n_layers
+        )
         if device.type != "cpu":
             model = model.to(torch.bfloat16)
         assert isinstance(model, cls)
@@ -193,6 +207,7 @@ class PlmfitEsmCForEmbdeddingsExtraction(ESMC):
         self,
         input_ids: torch.Tensor | None = None,
         attention_mask: torch.Tensor | None = None,
+        output_hidden_states: bool = False,
     ) -> Union[Tuple, SequenceClassifierOutput]:
         r"""
         labels (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
@@ -237,9 +252,25 @@ class PlmfitEsmCForEmbdeddingsExtraction(ESMC):
         #         for h in hiddens
         #     ]
 
-        # Stack hidden states into a [n_layers, B, L, D] matrix.
-        hiddens = torch.stack(hiddens, dim=0)  # type: ignore
-
-        pooled_output = self.pooler(x, pooling_method=self.reduction)
-
-        return SequenceClassifierOutput(logits=pooled_output, hidden_states=hiddens)
+        # Stack hidden states into a [n_layers, B, L, D] matrix, only when they are returned
+        all_hidden_states = torch.stack(hiddens, dim=0) if output_hidden_states else None
+
+        if self.layers is not None:
+            # Block outputs are pre-norm, the final norm is applied as it would be to a model trimmed to them
+            layer_states = [self.transformer.norm(hiddens[layer]) for layer in self.layers]
+            pooled_output = pool_layers(
+                self.pooler,
+                layer_states,
+                self.reduction,
+                attention_mask=attention_mask,
+                input_ids=input_ids,
+            )
+        else:
+            pooled_output = self.pooler(
+                x,
+                pooling_method=self.reduction,
+                attention_mask=attention_mask,
+                input_ids=input_ids,
+            )
+
+        return SequenceClassifierOutput(logits=pooled_output, hidden_states=all_hidden_states)
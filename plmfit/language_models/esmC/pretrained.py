@@ -27,6 +27,23 @@ from plmfit.language_models.esmC.modeling_esmc import PlmfitEsmCForEmbdeddingsEx
 
 ModelBuilder = Callable[[torch.device | str], nn.Module]
 
+ESMC_NUM_LAYERS = {ESMC_300M: 30, ESMC_600M: 36}
+
+
+def load_blocks(path, n_layers, device):
+    """
+    Loads the weights of the first `n_layers` transformer blocks, and of the
+    layers around them, from a checkpoint. The file is memory mapped, so the
+    weights of the dropped blocks are never read.
+    """
+    state_dict = torch.load(path, map_location=device, mmap=True)
+    return {
+        key: value
+        for key, value in state_dict.items()
+        if not key.startswith("transformer.blocks.")
+        or int(key.split(".")[2]) < n_layers
+    }
+
 
 def ESM3_structure_encoder_v0(device: torch.device | str = "cpu"):
     with torch.device(device):
@@ -67,18 +84,20 @@ def ESMC_300M_202412(
     device: torch.device | str = "cpu",
     use_flash_attn: bool = True,
     model_class: ESMC = PlmfitEsmCForSequenceClassification,
+    n_layers: int = 30,
 ):
     with torch.device(device):
         model = model_class(
             d_model=960,
             n_heads=15,
-            n_layers=30,
+            n_layers=n_layers,
             tokenizer=get_esmc_model_tokenizers(),
             use_flash_attn=use_flash_attn,
         ).eval()
-    state_dict = torch.load(
+    state_dict = load_blocks(
         data_root("esmc-300") / "data/weights/esmc_300m_2024_12_v0.pth",
-        map_location=device,
+        n_layers,
+        device,
     )
     model.load_state_dict(state_dict)
 
@@ -89,18 +108,20 @@ def ESMC_600M_202412(
     device: torch.device | str = "cpu",
     use_flash_attn: bool = True,
     model_class: ESMC = PlmfitEsmCForSequenceClassification,
+    n_layers: int = 36,
 ):
     with torch.device(device):
         model = model_class(
             d_model=1152,
             n_heads=18,
-            n_layers=36,
+            n_layers=n_layers,
             tokenizer=get_esmc_model_tokenizers(),
             use_flash_attn=use_flash_attn,
         ).eval()
-    state_dict = torch.load(
+    state_dict = load_blocks(
         data_root("esmc-600") / "data/weights/esmc_600m_2024_12_v0.pth",
-        map_location=device,
+        n_layers,
+        device,
     )
     model.load_state_dict(state_dict)
 
@@ -137,11 +158,18 @@ LOCAL_MODEL_REGISTRY: dict[str, ModelBuilder] = {
 
 
 def load_local_model(
-    model_name: str, device: torch.device = torch.device("cpu"), model_class: ESMC = PlmfitEsmCForSequenceClassification
+    model_name: str,
+    device: torch.device = torch.device("cpu"),
+    model_class: ESMC = PlmfitEsmCForSequenceClassification,
+    n_layers: int | None = None,
 ) -> nn.Module:
     if model_name not in LOCAL_MODEL_REGISTRY:
         raise ValueError(f"Model {model_name} not found in local model registry.")
-    return LOCAL_MODEL_REGISTRY[model_name](device, model_class=model_class)
+    if n_layers is None:
+        return LOCAL_MODEL_REGISTRY[model_name](device, model_class=model_class)
+    return LOCAL_MODEL_REGISTRY[model_name](
+        device, model_class=model_class, n_layers=n_layers
+    )
 
 
 # Register custom versions of ESM3 for use with the local inference API
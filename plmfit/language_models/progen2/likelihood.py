@@ -79,8 +79,6 @@ def sample(device, model, tokenizer, context, max_length, num_return_sequences,
 # likelihood
 
 def cross_entropy(logits, target, reduction='mean'):
-    print(logits.shape)
-    print(target.shape)
     return torch.nn.functional.cross_entropy(input=logits, target=target, weight=None, size_average=None, reduce=None, reduction=reduction)
 
 
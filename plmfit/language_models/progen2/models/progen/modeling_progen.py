@@ -30,6 +30,7 @@ from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import logging
 from transformers.utils.model_parallel_utils import assert_device_map, get_device_map
 from .configuration_progen import ProGenConfig
+from plmfit.shared_utils.poolers import GeneralPooler, capture_layers, pool_layers
 
 
 logger = logging.get_logger(__name__)
@@ -622,8 +623,8 @@ class ProGenForCausalLM(ProGenPreTrainedModel):
         inputs_embeds=None,
         labels=None,
         use_cache=None,
-        output_attentions=True,
-        output_hidden_states=True,
+        output_attentions=None,
+        output_hidden_states=None,
         return_dict=None,
     ):
         r"""
@@ -706,6 +707,7 @@ class ProGenForSequenceClassification(ProGenPreTrainedModel):
         self.init_weights()
 
         self.reduction = 'eos'
+        self.pooler = GeneralPooler()
 
         # Model parallel
         self.model_parallel = False
@@ -752,9 +754,9 @@ class ProGenForSequenceClassification(ProGenPreTrainedModel):
         head_mask=None,
         inputs_embeds=None,
         labels=None,
-        use_cache=None,
-        output_attentions=True,
-        output_hidden_states=True,
+        use_cache=False,
+        output_attentions=None,
+        output_hidden_states=None,
         return_dict=None,
     ):
         r"""
@@ -768,6 +770,9 @@ class ProGenForSequenceClassification(ProGenPreTrainedModel):
         # Convert input ids to int if not already done
         if input_ids is not None:
             input_ids = input_ids.int()
+            if attention_mask is None and self.config.pad_token_id is not None:
+                # Padding tokens are neither attended to nor pooled
+                attention_mask = (input_ids != self.config.pad_token_id).long()
         transformer_outputs = self.transformer(
             input_ids,
             past_key_values=past_key_values,
@@ -787,23 +792,9 @@ class ProGenForSequenceClassification(ProGenPreTrainedModel):
         else:
             batch_size = inputs_embeds.shape[0]
 
-        if self.reduction == 'eos':
-            if self.config.pad_token_id is None and batch_size != 1:
-                raise ValueError("Cannot handle batch sizes > 1 if no padding token is defined.")
-            if self.config.pad_token_id is None:
-                sequence_lengths = -1
-            else:
-                if input_ids is not None:
-                    sequence_lengths = torch.ne(input_ids, self.config.pad_token_id).sum(-1) - 1
-                else:
-                    sequence_lengths = -1
-                    logger.warning(
-                        f"{self.__class__.__name__} will not detect padding tokens in `inputs_embeds`. Results may be "
-                        "unexpected if using padding tokens in conjunction with `inputs_embeds.`"
-                    )
-            hidden_states = hidden_states[torch.arange(batch_size, device=hidden_states.device), sequence_lengths]
-        elif self.reduction == 'mean':
-            hidden_states = torch.mean(hidden_states, dim=1)
+        if self.reduction == 'eos' and attention_mask is None and batch_size != 1:
+            raise ValueError("Cannot handle batch sizes > 1 if no padding token or attention mask is defined.")
+        hidden_states = self.pooler(hidden_states, pooling_method=self.reduction, attention_mask=attention_mask, input_ids=input_ids)
 
         pooled_logits = self.classifier(hidden_states)
 
@@ -856,6 +847,9 @@ class ProGenForEmbeddingsExtraction(ProGenPreTrainedModel):
         self.init_weights()
 
         self.reduction = "eos"
+        # Layers to pool in a single pass, with `reduction` a list of reductions
+        self.layers = None
+        self.pooler = GeneralPooler()
 
         # Model parallel
         self.model_parallel = False
@@ -899,9 +893,9 @@ class ProGenForEmbeddingsExtraction(ProGenPreTrainedModel):
         head_mask=None,
         inputs_embeds=None,
         labels=None,
-        use_cache=None,
-        output_attentions=True,
-        output_hidden_states=True,
+        use_cache=False,
+        output_attentions=None,
+        output_hidden_states=None,
         return_dict=None,
     ):
         r"""
@@ -917,50 +911,55 @@ class ProGenForEmbeddingsExtraction(ProGenPreTrainedModel):
         # Convert input ids to int if not already done
         if input_ids is not None:
             input_ids = input_ids.int()
-        transformer_outputs = self.transformer(
-            input_ids,
-            past_key_values=past_key_values,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+            if attention_mask is None and self.config.pad_token_id is not None:
+                # Padding tokens are neither attended to nor pooled
+                attention_mask = (input_ids != self.config.pad_token_id).long()
+        # Only the outputs of the pooled layers are kept, not the hidden states of every layer
+        with capture_layers(self.transformer.h, self.layers or []) as layer_outputs:
+            transformer_outputs = self.transformer(
+                input_ids,
+                past_key_values=past_key_values,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            )
         hidden_states = transformer_outputs[0]
         if input_ids is not None:
             batch_size = input_ids.shape[0]
         else:
             batch_size = inputs_embeds.shape[0]
 
-        if self.reduction == "eos":
-            if self.config.pad_token_id is None and batch_size != 1:
+        if self.layers is not None:
+            # Intermediate layers get ln_f, as the last layer of a model trimmed to them would
+            last_layer = len(self.transformer.h) - 1
+            layer_states = [
+                hidden_states if layer == last_layer else self.transformer.ln_f(layer_outputs[layer])
+                for layer in self.layers
+            ]
+            hidden_states = pool_layers(
+                self.pooler,
+                layer_states,
+                self.reduction,
+                attention_mask=attention_mask,
+                input_ids=input_ids,
+            )
+        else:
+            if self.reduction == "eos" and attention_mask is None and batch_size != 1:
                 raise ValueError(
-                    "Cannot handle batch sizes > 1 if no padding token is defined."
+                    "Cannot handle batch sizes > 1 if no padding token or attention mask is defined."
                 )
-            if self.config.pad_token_id is None:
-                sequence_lengths = -1
-            else:
-                if input_ids is not None:
-                    sequence_lengths = (
-                        torch.ne(input_ids, self.config.pad_token_id).sum(-1) - 1
-                    )
-                else:
-                    sequence_lengths = -1
-                    logger.warning(
-                        f"{self.__class__.__name__} will not detect padding tokens in `inputs_embeds`. Results may be "
-                        "unexpected if using padding tokens in conjunction with `inputs_embeds.`"
-                    )
-            hidden_states = hidden_states[
-                torch.arange(batch_size, device=hidden_states.device), sequence_lengths
-            ]
-        elif self.reduction == "mean":
-            hidden_states = torch.mean(hidden_states, dim=1)
-        elif self.reduction == "none":
-            pass
+            hidden_states = self.pooler(
+                hidden_states,
+                pooling_method=self.reduction,
+                attention_mask=attention_mask,
+                input_ids=input_ids,
+            )
 
         return SequenceClassifierOutputWithPast(
             loss=None,
@@ -1030,9 +1029,9 @@ class ProGenForTokenClassification(ProGenPreTrainedModel):
         head_mask=None,
         inputs_embeds=None,
         labels=None,
-        use_cache=None,
-        output_attentions=True,
-        output_hidden_states=True,
+        use_cache=False,
+        output_attentions=None,
+        output_hidden_states=None,
         return_dict=None,
     ):
         r"""
@@ -1048,6 +1047,9 @@ class ProGenForTokenClassification(ProGenPreTrainedModel):
         # Convert input ids to int if not already done
         if input_ids is not None:
             input_ids = input_ids.int()
+            if attention_mask is None and self.config.pad_token_id is not None:
+                # Padding tokens are neither attended to nor pooled
+                attention_mask = (input_ids != self.config.pad_token_id).long()
         transformer_outputs = self.transformer(
             input_ids,
             past_key_values=past_key_values,
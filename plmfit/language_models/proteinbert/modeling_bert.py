@@ -26,6 +26,7 @@ from torch import nn
 from torch.utils.checkpoint import checkpoint
 from transformers.modeling_outputs import SequenceClassifierOutputWithPast, MaskedLMOutput
 
+from plmfit.shared_utils.poolers import GeneralPooler, capture_layers, pool_layers
 from .modeling_utils import ProteinConfig
 from .modeling_utils import ProteinModel
 from .modeling_utils import prune_linear_layer
@@ -363,28 +364,6 @@ class ProteinBertEncoder(nn.Module):
         return outputs  # outputs, (hidden states), (attentions)
 
 
-class ProteinBertPooler(nn.Module):
-    def __init__(self, config):
-        super().__init__()
-        self.dense = nn.Linear(config.hidden_size, config.hidden_size)
-        self.activation = nn.Tanh()
-
-    def forward(self, hidden_states, pooling_method='default'):
-        # We "pool" the model by simply taking the hidden state corresponding
-        # to the first token.
-        if pooling_method == 'default':
-            first_token_tensor = hidden_states[:, 0]
-            pooled_output = self.dense(first_token_tensor)
-            pooled_output = self.activation(pooled_output)
-        elif pooling_method == 'bos':
-            pooled_output = hidden_states[:, 0]
-        elif pooling_method == 'mean':
-            pooled_output = torch.mean(hidden_states, dim=1)
-        elif pooling_method == 'none':
-            pooled_output = hidden_states
-        return pooled_output
-
-
 class ProteinBertAbstractModel(ProteinModel):
     """ An abstract class to handle weights initialization and
         a simple interface for dowloading and loading pretrained models.
@@ -411,7 +390,7 @@ class ProteinBertModel(ProteinBertAbstractModel):
 
         self.embeddings = ProteinBertEmbeddings(config)
         self.encoder = ProteinBertEncoder(config)
-        self.pooler = ProteinBertPooler(config)
+        self.pooler = GeneralPooler(config)
 
         self.init_weights()
 
@@ -521,7 +500,6 @@ class ProteinBertForValuePrediction(ProteinBertAbstractModel):
 class ProteinBertForSequenceClassification(ProteinBertAbstractModel):
 
     def __init__(self, config):
-        config.output_hidden_states = True
         super().__init__(config)
         self.num_labels = config.num_labels
         self.bert = ProteinBertModel(config)
@@ -542,9 +520,14 @@ class ProteinBertForSequenceClassification(ProteinBertAbstractModel):
         
         # The first element of outputs is the last layer hidden-state
         sequence_output = outputs[0]
-        # The third element of outputs is the hidden states from all layers
-        all_hidden_states = outputs[2]
-        pooled_output = self.bert.pooler(sequence_output, pooling_method=self.reduction)
+        # The third element of outputs is the hidden states from all layers, if requested
+        all_hidden_states = outputs[2] if self.bert.encoder.output_hidden_states else None
+        pooled_output = self.bert.pooler(
+            sequence_output,
+            pooling_method=self.reduction,
+            attention_mask=input_mask,
+            input_ids=input_ids,
+        )
 
         logits = self.classifier(pooled_output)
         # (loss), prediction_scores, (hidden_states), (attentions)
@@ -597,10 +580,11 @@ class ProteinBertForContactPrediction(ProteinBertAbstractModel):
 class ProteinBertForEmbeddingsExtraction(ProteinBertAbstractModel):
 
     def __init__(self, config):
-        config.output_hidden_states = True
         super().__init__(config)
         self.bert = ProteinBertModel(config)
         self.reduction = "bos"
+        # Layers to pool in a single pass, with `reduction` a list of reductions
+        self.layers = None
         self.init_weights()
 
     def trim_model(self, layer_to_use):
@@ -611,13 +595,30 @@ class ProteinBertForEmbeddingsExtraction(ProteinBertAbstractModel):
     def forward(self, input_ids, input_mask=None, targets=None):
         if input_ids is not None:
             input_ids = input_ids.int()
-        outputs = self.bert(input_ids, input_mask=input_mask)
+        # Only the outputs of the pooled layers are kept, not the hidden states of every layer
+        with capture_layers(self.bert.encoder.layer, self.layers or []) as layer_outputs:
+            outputs = self.bert(input_ids, input_mask=input_mask)
 
         # The first element of outputs is the last layer hidden-state
         sequence_output = outputs[0]
-        # The third element of outputs is the hidden states from all layers
-        all_hidden_states = outputs[2]
-        pooled_output = self.bert.pooler(sequence_output, pooling_method=self.reduction)
+        # The third element of outputs is the hidden states from all layers, if requested
+        all_hidden_states = outputs[2] if self.bert.encoder.output_hidden_states else None
+        if self.layers is not None:
+            layer_states = [layer_outputs[layer] for layer in self.layers]
+            pooled_output = pool_layers(
+                self.bert.pooler,
+                layer_states,
+                self.reduction,
+                attention_mask=input_mask,
+                input_ids=input_ids,
+            )
+        else:
+            pooled_output = self.bert.pooler(
+                sequence_output,
+                pooling_method=self.reduction,
+                attention_mask=input_mask,
+                input_ids=input_ids,
+            )
 
         # (loss), prediction_scores, (hidden_states), (attentions)
         return SequenceClassifierOutputWithPast(
@@ -628,7 +629,6 @@ class ProteinBertForEmbeddingsExtraction(ProteinBertAbstractModel):
 class ProteinBertForTokenClassification(ProteinBertAbstractModel):
 
     def __init__(self, config):
-        config.output_hidden_states = True
         super().__init__(config)
         self.num_labels = config.num_labels
         self.bert = ProteinBertModel(config)
@@ -650,8 +650,8 @@ class ProteinBertForTokenClassification(ProteinBertAbstractModel):
 
         # The first element of outputs is the last layer hidden-state
         sequence_output = outputs[0]
-        # The third element of outputs is the hidden states from all layers
-        all_hidden_states = outputs[2]
+        # The third element of outputs is the hidden states from all layers, if requested
+        all_hidden_states = outputs[2] if self.bert.encoder.output_hidden_states else None
 
         logits = self.classifier(sequence_output)
         
@@ -1,13 +1,15 @@
 import datetime
 import os
 import json
-import matplotlib.pyplot as plt
-import torch
-import requests
 import traceback
-import optuna
 import sys
 import logging
+from typing import TYPE_CHECKING
+
+# matplotlib, torch and requests are only imported when a plot, a model or a
+# file is saved, so that starting plmfit does not pay for them
+if TYPE_CHECKING:
+    import optuna
 
 try:
     from dotenv import load_dotenv 
@@ -121,6 +123,8 @@ class Logger(object):
     def save_plot(self, plot, plot_name):
         plot_path = os.path.join(self.base_dir, f"{self.experiment_name}_{plot_name}.png")
         plot.savefig(plot_path)
+        import matplotlib.pyplot as plt
+
         plt.close(plot)  # Close the plot to free memory
         self.log(f'Saved plot with name "{plot_name}.png"')
         if self.log_to_server:
@@ -130,12 +134,16 @@ class Logger(object):
                 self.log(f'Error posting data to server: {e}', force_dont_send=True)
 
     def save_model(self, model, model_name):
+        import torch
+
         plot_path = os.path.join(self.base_dir, f"{self.experiment_name}.pt")
         torch.save(model.state_dict(
         ), plot_path)
         self.log(f'Saved model with name "{self.experiment_name}.pt"')
 
     def post_to_server(self, file_path, data_name):
+        import requests
+
         # Ensure the token is included in the headers for authorization
         headers = {'Authorization': f'Bearer {self.token}'}
 
@@ -168,7 +176,7 @@ class LogOptunaTrialCallback:
         self.logger = logger
 
     def __call__(
-        self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial
+        self, study: "optuna.study.Study", trial: "optuna.trial.FrozenTrial"
     ) -> None:
         try:
             self.logger.log(
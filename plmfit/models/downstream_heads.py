@@ -6,10 +6,55 @@ from plmfit.shared_utils.utils import get_activation_function
 from plmfit.shared_utils.random_state import get_random_state
 from plmfit.models.custom_transformer import TransformerPWFF
 
+class OneHotLinear(nn.Linear):
+    """
+    Linear layer over one-hot encoded tokens that takes the token ids directly.
+
+    Multiplying a one-hot vector with the weight matrix selects one column per
+    position, so the layer gathers those columns (as an embedding bag) instead
+    of materializing the one-hot input. With flatten=True the input is the
+    (batch, length) id matrix of a flattened (batch, length * num_classes)
+    one-hot input, otherwise ids are expanded per position, as for token
+    classification. Dense one-hot inputs are still accepted.
+    """
+
+    def __init__(self, in_features, out_features, num_classes, flatten=True):
+        super(OneHotLinear, self).__init__(in_features, out_features)
+        self.num_classes = num_classes
+        self.flatten = flatten
+
+    def forward(self, x):
+        if x.dim() == (2 if self.flatten else 3) and x.shape[-1] == self.in_features:
+            return super().forward(x)
+        x = x.long()
+        if self.flatten:
+            # Position l of class c is feature l * num_classes + c
+            offsets = torch.arange(x.shape[-1], device=x.device) * self.num_classes
+            x = F.embedding_bag(x + offsets, self.weight.t(), mode="sum")
+        else:
+            x = F.embedding(x, self.weight.t())
+        return x + self.bias
+
+
+def input_layer(config, out_features):
+    """
+    First linear layer of a head, gathering from token ids when the head
+    is trained on one-hot encoded sequences (`one_hot_classes` is set).
+    """
+    if config.get('one_hot_classes'):
+        return OneHotLinear(
+            config['input_dim'],
+            out_features,
+            config['one_hot_classes'],
+            flatten=config['task'] != "token_classification",
+        )
+    return nn.Linear(config['input_dim'], out_features)
+
+
 class LinearHead(nn.Module):
     def __init__(self, config):
         super(LinearHead, self).__init__()
-        self.linear = nn.Linear(config['input_dim'], config['output_dim'])
+        self.linear = input_layer(config, config['output_dim'])
         self.task = config['task']
         self.config = config
         # Check if there's an activation function specified for the layer
@@ -24,7 +69,7 @@ class LinearHead(nn.Module):
 
     def forward(self, x):
         # if device is MPS, convert input to int
-        if torch.backends.mps.is_available():
+        if torch.backends.mps.is_available() and not isinstance(self.linear, OneHotLinear):
             x = x.to(torch.float)
         x = self.linear(x)
         if "output_activation" in self.config:
@@ -40,7 +85,7 @@ class MLP(nn.Module):
         self.layers = nn.ModuleList()
 
         # Input Layer
-        self.layers.append(nn.Linear(config['input_dim'], config['hidden_dim']))
+        self.layers.append(input_layer(config, config['hidden_dim']))
         self.layers.append(nn.Dropout(config['hidden_dropout']))
         # Check if there's an activation function specified for the layer
         if 'hidden_activation' in config:
@@ -64,7 +109,7 @@ class MLP(nn.Module):
 
     def forward(self, x):
         # if device is MPS, convert input to int
-        if torch.backends.mps.is_available():
+        if torch.backends.mps.is_available() and not isinstance(self.layers[0], OneHotLinear):
             x = x.to(torch.float)
         for layer in self.layers:
             x = layer(x)
@@ -91,6 +136,7 @@ class RNN(nn.Module):
     def __init__(self, config):
         super(RNN, self).__init__()
         self.task = config['task']
+        self.one_hot_classes = config.get('one_hot_classes')
         self.rnn = nn.RNN(input_size=config['input_dim'], hidden_size=config['hidden_dim'], num_layers=config['num_layers'],
                           batch_first=True, dropout=config['dropout'], bidirectional=config['bidirectional'])
         fc_input_dim = (
@@ -103,6 +149,13 @@ class RNN(nn.Module):
         self.init_weights()
 
     def forward(self, x):
+        # Token ids are one-hot encoded on the device, flattened to the
+        # (batch, length * num_classes) input of sequence level tasks
+        token_level = self.task == "token_classification"
+        if self.one_hot_classes and x.dim() == 2 and (token_level or x.shape[-1] != self.rnn.input_size):
+            x = F.one_hot(x.long(), self.one_hot_classes).to(self.fc.weight.dtype)
+            if not token_level:
+                x = x.flatten(start_dim=1)
         # if device is MPS, convert input to int
         if torch.backends.mps.is_available():
             x = x.to(torch.float)
@@ -0,0 +1,406 @@
+import json
+import os
+import time
+from contextlib import nullcontext
+
+import lightning as L
+import optuna
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+
+from plmfit.shared_utils.samplers import LabelWeightedSampler
+from plmfit.shared_utils.utils import IndexedDataset
+
+
+class HeadTrainer:
+    """
+    In-process trainer for small heads over in-memory features (embeddings,
+    one-hot or BLOSUM encodings), a lean replacement of the Lightning Trainer
+    for `LightningModel`s that only wrap a head.
+
+    The train and validation sets are materialized once as whole tensors on
+    the device and batches are gathered from them by permutation index, so
+    there is no DataLoader, logger or distributed synchronization per step.
+    Besides the optimizers of `LightningModel`, the `optimizer` training
+    parameter can be set to:
+
+    - "ridge": closed-form ridge regression (L2 of `weight_decay`) for a
+      linear regression head trained with MSE, solved in a single pass.
+    - "lbfgs": full-batch L-BFGS, one optimizer step per epoch.
+
+    It writes the same artifacts as the Lightning path: the loss history,
+    the training report, `lightning_logs/best_model.ckpt` and, on test, the
+    metrics report.
+
+    :param max_epochs: number of epochs.
+    :param limit_train_batches: fraction (float) or number (int) of train batches per epoch.
+    :param limit_val_batches: fraction (float) or number (int) of validation batches per epoch.
+    :param patience: early stopping patience on the validation loss, -1 or None to disable.
+    :param trial: Optuna trial, the validation loss is reported to it and pruned trials are stopped.
+    :param device: device to train on, CUDA if available by default.
+    :param precision: "16-mixed" for mixed precision on CUDA, "32" otherwise.
+    :param chunk_size: number of rows materialized, or solved for, at once.
+    """
+
+    def __init__(
+        self,
+        max_epochs,
+        limit_train_batches=1.0,
+        limit_val_batches=1.0,
+        patience=None,
+        trial=None,
+        device=None,
+        precision="16-mixed",
+        chunk_size=65536,
+    ):
+        self.max_epochs = max_epochs
+        self.limit_train_batches = limit_train_batches
+        self.limit_val_batches = limit_val_batches
+        self.patience = -1 if patience is None else patience
+        self.trial = trial
+        self.device = torch.device(
+            device if device is not None else "cuda" if torch.cuda.is_available() else "cpu"
+        )
+        self.mixed_precision = precision == "16-mixed" and self.device.type == "cuda"
+        self.chunk_size = chunk_size
+        self.callback_metrics = {}
+
+    ### DATA ###
+    def materialize(self, dataloader):
+        """Loads the whole dataset of a DataLoader as tensors on the device."""
+        dataset = dataloader.dataset
+        if isinstance(dataset, IndexedDataset):
+            chunks = torch.arange(len(dataset)).split(self.chunk_size)
+            features = (
+                torch.cat([dataset.fetch(chunk) for chunk in chunks])
+                if len(dataset) > 0
+                else dataset.fetch(torch.arange(0))
+            )
+            columns = [features, *dataset.tensors]
+        else:
+            batches = DataLoader(
+                dataset, batch_size=self.chunk_size, collate_fn=dataloader.collate_fn
+            )
+            columns = [torch.cat(column) for column in zip(*batches)]
+        # Half precision inputs are only used under autocast
+        return [
+            (
+                column.float()
+                if column.dtype in (torch.float16, torch.bfloat16) and not self.mixed_precision
+                else column
+            ).to(self.device)
+            for column in columns
+        ]
+
+    def epoch_indices(self, dataloader, num_samples):
+        """Draws the indices of one epoch as the DataLoader's sampler would."""
+        sampler = getattr(dataloader.batch_sampler, "sampler", dataloader.sampler)
+        if isinstance(sampler, RandomSampler):
+            generator = sampler.generator
+            indices = torch.randperm(
+                num_samples,
+                generator=generator if isinstance(generator, torch.Generator) else None,
+            )
+        elif isinstance(sampler, SequentialSampler):
+            indices = torch.arange(num_samples)
+        elif isinstance(sampler, LabelWeightedSampler):
+            indices = sampler.draw()
+        else:
+            indices = torch.as_tensor(list(sampler), dtype=torch.long)
+        return indices.to(self.device)
+
+    @staticmethod
+    def batch_size(dataloader):
+        if dataloader.batch_size is not None:
+            return dataloader.batch_size
+        return dataloader.batch_sampler.batch_size
+
+    @staticmethod
+    def num_batches(limit, num_batches):
+        if isinstance(limit, float):
+            return max(1, int(num_batches * limit)) if num_batches > 0 else 0
+        return min(limit, num_batches)
+
+    def autocast(self):
+        if self.mixed_precision:
+            return torch.autocast(device_type="cuda", dtype=torch.float16)
+        return nullcontext()
+
+    ### TRAINING ###
+    def fit(self, model, train_dataloaders, val_dataloaders):
+        """Trains `model`, a LightningModel, keeping the weights of the best validation loss."""
+        logger = model.plmfit_logger
+        model.to(self.device)
+        train_data = self.materialize(train_dataloaders)
+        val_data = self.materialize(val_dataloaders)
+
+        optimizer_name = model.hparams.optimizer
+        if optimizer_name == "ridge":
+            epochs = 1
+        elif optimizer_name == "lbfgs":
+            optimizer = torch.optim.LBFGS(
+                model.parameters(),
+                lr=model.hparams.learning_rate,
+                max_iter=model.hparams.get("lbfgs_max_iter", 20),
+                line_search_fn="strong_wolfe",
+            )
+            epochs = self.max_epochs
+        else:
+            optimizer = model.initialize_optimizer(model.parameters())
+            scaler = torch.amp.GradScaler("cuda", enabled=self.mixed_precision)
+            epochs = self.max_epochs
+
+        start_time = time.time()
+        epoch_train_loss, epoch_val_loss = [], []
+        best_val_loss, best_epoch, epochs_no_improve = float("inf"), 0, 0
+        best_state_dict = None
+        for epoch in range(epochs):
+            epoch_start_time = time.time()
+            logger.log("\nEpoch {}/{}".format(epoch + 1, epochs))
+            logger.log("-" * 10)
+
+            model.train()
+            if optimizer_name == "ridge":
+                self.solve_ridge(model, train_data)
+                train_loss = self.evaluate(model, train_data, model.train_metric)
+            elif optimizer_name == "lbfgs":
+                train_loss = self.lbfgs_epoch(model, optimizer, train_data)
+            else:
+                train_loss = self.train_epoch(
+                    model, optimizer, scaler, train_data, train_dataloaders
+                )
+            train_metric = model.train_metric.compute().item()
+            model.train_metric.reset()
+            epoch_train_loss.append(train_loss)
+            logger.log(f"(train) loss: {train_loss:.4f} {time.time() - epoch_start_time:.4f}s")
+            logger.log(f"(train) {model.metric_label}: {train_metric:.4f}")
+
+            model.eval()
+            val_loss = self.evaluate(
+                model,
+                val_data,
+                model.val_metric,
+                indices=self.epoch_indices(val_dataloaders, len(val_data[0])),
+                batch_size=self.batch_size(val_dataloaders),
+                limit=self.limit_val_batches,
+            )
+            val_metric = model.val_metric.compute().item()
+            model.val_metric.reset()
+            epoch_val_loss.append(val_loss)
+            logger.log(f"(val) loss: {val_loss:.4f}")
+            logger.log(f"(val) {model.metric_label}: {val_metric:.4f}")
+            self.callback_metrics = {
+                "train_loss": torch.tensor(train_loss),
+                "val_loss": torch.tensor(val_loss),
+                f"val_{model.metric_label}": torch.tensor(val_metric),
+            }
+
+            if (
+                val_loss < best_val_loss
+                and epoch >= model.track_validation_after
+                or model.track_validation_after == -1
+            ):
+                best_val_loss = val_loss
+                best_epoch = epoch
+                best_state_dict = {
+                    key: value.detach().clone() for key, value in model.state_dict().items()
+                }
+                if self.trial is None:
+                    self.save_checkpoint(model, epoch)
+            logger.log(f"The best model was last saved at epoch {best_epoch + 1}.")
+
+            # Early stopping on the best loss seen, as the Lightning callback does
+            if val_loss < min(epoch_val_loss[:-1], default=float("inf")):
+                epochs_no_improve = 0
+            else:
+                epochs_no_improve += 1
+
+            if self.trial is not None:
+                self.trial.report(val_loss, step=epoch)
+                if self.trial.should_prune():
+                    raise optuna.TrialPruned(f"Trial was pruned at epoch {epoch}.")
+            if self.patience != -1 and epochs_no_improve >= self.patience:
+                logger.log(f"Early stopping at epoch {epoch + 1}.")
+                break
+
+        if best_state_dict is not None:
+            model.load_state_dict(best_state_dict)
+        if self.trial is None:
+            self.save_report(model, start_time, epoch + 1, epoch_train_loss, epoch_val_loss)
+
+    def train_epoch(self, model, optimizer, scaler, train_data, dataloader):
+        accumulation_steps = model.gradient_accumulation_steps()
+        gradient_clipping = model.gradient_clipping()
+        indices = self.epoch_indices(dataloader, len(train_data[0]))
+        batches = indices.split(self.batch_size(dataloader))
+        batches = batches[: self.num_batches(self.limit_train_batches, len(batches))]
+
+        total_loss, total_samples = 0.0, 0
+        optimizer.zero_grad(set_to_none=True)
+        for batch_idx, batch_indices in enumerate(batches):
+            batch = [column[batch_indices] for column in train_data]
+            with self.autocast():
+                loss, outputs, labels = model.shared_step(batch)
+            scaler.scale(loss / accumulation_steps).backward()
+            if (batch_idx + 1) % accumulation_steps == 0 or batch_idx + 1 == len(batches):
+                if gradient_clipping > 0:
+                    scaler.unscale_(optimizer)
+                    nn.utils.clip_grad_norm_(model.parameters(), gradient_clipping)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+            model.train_metric.update(
+                model.metric_outputs(outputs.detach().float()), model.metric_labels(labels)
+            )
+            total_loss += loss.item() * len(batch_indices)
+            total_samples += len(batch_indices)
+        return total_loss / max(total_samples, 1)
+
+    def lbfgs_epoch(self, model, optimizer, train_data):
+        num_samples = len(train_data[0])
+        weight_decay = model.hparams.get("weight_decay", 0) or 0
+
+        def closure():
+            optimizer.zero_grad(set_to_none=True)
+            total_loss = 0.0
+            # Full-batch loss and gradients, accumulated over chunks of rows
+            for chunk in torch.arange(num_samples, device=self.device).split(self.chunk_size):
+                with self.autocast():
+                    loss, _, _ = model.shared_step([column[chunk] for column in train_data])
+                loss = loss * len(chunk) / num_samples
+                loss.backward()
+                total_loss += loss.detach()
+            if weight_decay > 0:
+                penalty = weight_decay / 2 * sum(
+                    parameter.pow(2).sum() for name, parameter in model.named_parameters()
+                    if parameter.requires_grad and not name.endswith("bias")
+                )
+                penalty.backward()
+                total_loss += penalty.detach()
+            return total_loss
+
+        optimizer.step(closure)
+        return self.evaluate(model, train_data, model.train_metric)
+
+    def solve_ridge(self, model, train_data):
+        """
+        Sets the weights of a linear regression head to the ridge solution of
+        min mean((Xw + b - y)^2) + weight_decay / 2 * |w|^2, which matches the
+        L2 penalty Adam's `weight_decay` applies to the gradients.
+        """
+        head = model.model
+        linear = getattr(head, "linear", None)
+        if (
+            model.model.task != "regression"
+            or type(linear) is not nn.Linear
+            or "output_activation" in getattr(head, "config", {})
+            or model.hparams.loss_f != "mse"
+        ):
+            raise ValueError(
+                "The ridge solver requires a linear regression head over dense features trained with MSE"
+            )
+        features, labels = train_data[0], train_data[1]
+        num_samples, dim = features.shape
+        # Sufficient statistics in float64, accumulated over chunks of rows
+        sum_x = torch.zeros(dim, dtype=torch.float64, device=self.device)
+        sum_y = torch.zeros(1, dtype=torch.float64, device=self.device)
+        gram = torch.zeros(dim, dim, dtype=torch.float64, device=self.device)
+        cross = torch.zeros(dim, dtype=torch.float64, device=self.device)
+        for chunk in torch.arange(num_samples, device=self.device).split(self.chunk_size):
+            x = features[chunk].double()
+            y = labels[chunk].double().reshape(-1)
+            sum_x += x.sum(dim=0)
+            sum_y += y.sum()
+            gram += x.T @ x
+            cross += x.T @ y
+        mean_x, mean_y = sum_x / num_samples, sum_y / num_samples
+        covariance = gram / num_samples - torch.outer(mean_x, mean_x)
+        cross_covariance = cross / num_samples - mean_x * mean_y
+        alpha = (model.hparams.get("weight_decay", 0) or 0) / 2
+        weight = torch.linalg.solve(
+            covariance + alpha * torch.eye(dim, dtype=torch.float64, device=self.device),
+            cross_covariance,
+        )
+        with torch.no_grad():
+            linear.weight.copy_(weight.reshape(1, -1))
+            linear.bias.copy_(mean_y - mean_x @ weight)
+
+    @torch.no_grad()
+    def evaluate(self, model, data, metric, indices=None, batch_size=None, limit=1.0):
+        if indices is None:
+            indices = torch.arange(len(data[0]), device=self.device)
+        batches = indices.split(batch_size or self.chunk_size)
+        batches = batches[: self.num_batches(limit, len(batches))]
+        total_loss, total_samples = 0.0, 0
+        for batch_indices in batches:
+            with self.autocast():
+                loss, outputs, labels = model.shared_step(
+                    [column[batch_indices] for column in data]
+                )
+            metric.update(model.metric_outputs(outputs.float()), model.metric_labels(labels))
+            total_loss += loss.item() * len(batch_indices)
+            total_samples += len(batch_indices)
+        return total_loss / max(total_samples, 1)
+
+    ### ARTIFACTS ###
+    def checkpoint_path(self, model):
+        return f"{model.plmfit_logger.base_dir}/lightning_logs/best_model.ckpt"
+
+    def save_checkpoint(self, model, epoch):
+        path = self.checkpoint_path(model)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.save(
+            {
+                "epoch": epoch,
+                "state_dict": model.state_dict(),
+                "hyper_parameters": dict(model.hparams),
+                "pytorch-lightning_version": L.__version__,
+            },
+            path,
+        )
+
+    def save_report(self, model, start_time, epochs, epoch_train_loss, epoch_val_loss):
+        logger = model.plmfit_logger
+        total_time = time.time() - start_time
+        logger.log(f"\nMean time per epoch: {total_time/epochs:.4f}s")
+        logger.log(f"Total training time: {total_time:.1f}s")
+        with open(
+            f"{logger.base_dir}/{logger.experiment_name}_loss.json", "w", encoding="utf-8"
+        ) as f:
+            json.dump(
+                {"epoch_train_loss": epoch_train_loss, "epoch_val_loss": epoch_val_loss},
+                f,
+                indent=4,
+            )
+        logger.save_data(
+            {
+                "training_time": f"{total_time:.1f}",
+                "avg_time_per_epoch": f"{total_time/epochs:.4f}",
+            },
+            "report",
+        )
+
+    ### TESTING ###
+    @torch.no_grad()
+    def test(self, model, ckpt_path=None, dataloaders=None):
+        """Evaluates `model` on the test set, loading the weights of `ckpt_path` if given."""
+        if ckpt_path is not None:
+            checkpoint = torch.load(ckpt_path, map_location=self.device, weights_only=False)
+            model.load_state_dict(checkpoint["state_dict"])
+        model.to(self.device)
+        model.eval()
+        model.on_test_start()
+        total_loss, total_samples = 0.0, 0
+        for batch in dataloaders:
+            batch = [column.to(self.device) for column in batch]
+            if not self.mixed_precision and batch[0].dtype in (torch.float16, torch.bfloat16):
+                batch[0] = batch[0].float()
+            with self.autocast():
+                loss, outputs, labels = model.shared_step(batch)
+            model.metrics.add(
+                model.test_outputs(outputs.float()), model.metric_labels(labels), batch[2]
+            )
+            total_loss += loss.item() * len(batch[0])
+            total_samples += len(batch[0])
+        model.save_test_metrics(total_loss / max(total_samples, 1))
@@ -1,12 +1,12 @@
 import lightning as L
 from lightning.pytorch.callbacks.early_stopping import EarlyStopping
 import torch
+import torch.nn.functional as F
 import time
 import json
-from deepspeed.ops.adam import DeepSpeedCPUAdam
 from lightning.pytorch.strategies import DeepSpeedStrategy
 from plmfit.shared_utils import utils
-from deepspeed.profiling.flops_profiler.profiler import FlopsProfiler
+from plmfit.shared_utils.embedding_store import EmbeddingStore
 import os
 import torch.distributed as dist
 from torchmetrics.classification import (
@@ -32,6 +32,41 @@ from torchmetrics.text import Perplexity
 from lightning.pytorch.callbacks import BasePredictionWriter
 from plmfit.shared_utils.custom_loss_functions import MaskedBCEWithLogitsLoss, MaskedFocalWithLogitsLoss
 import numpy as np
+from functools import partial
+
+
+# Per-task transforms of the step, module level so that the model stays picklable
+def _identity(x):
+    return x
+
+
+def _squeeze(outputs):
+    return outputs.squeeze(dim=1)
+
+
+def _channels_first(outputs):
+    # swap 3rd dimension to 2nd dimension
+    return outputs.permute(0, 2, 1)
+
+
+def _argmax(outputs):
+    return torch.argmax(outputs, dim=1)
+
+
+def _to_long(labels):
+    return labels.long()
+
+
+def _to_int(labels):
+    return labels.int()
+
+
+def _to_float32(labels):
+    return labels.to(torch.float32)
+
+
+def _one_hot(labels, num_classes):
+    return F.one_hot(labels, num_classes=num_classes).float()
 
 
 class LightningModel(L.LightningModule):
@@ -102,16 +137,93 @@ class LightningModel(L.LightningModule):
             self.track_validation_after = 0
             self.track_training_loss = False
 
+            self.init_step_functions()
+
         self.profiling_interval = 100
 
         self.experimenting = experimenting
 
+        # Set to a MaskedLMCollator to mask MLM batches after they reach the device
+        self.mlm_collator = None
+
     def forward(self, input, **args):
         if torch.backends.mps.is_available():
             input = input.to(torch.float)
         output = self.model(input, **args)
         return output
 
+    def init_step_functions(self):
+        """
+        Select once the per-task transforms applied in every step:
+        step_outputs/step_labels prepare the model outputs and the labels for
+        the loss, loss_targets builds its targets from the labels and
+        metric_outputs/metric_labels/test_outputs prepare them for the metrics.
+        """
+        task = self.model.task
+        multiclass = self.hparams.no_classes > 1
+        # MPS does not support float64/float16 targets
+        float_labels = _to_float32 if torch.backends.mps.is_available() else _identity
+        self.loss_targets = _identity
+        self.metric_labels = _identity
+        if task == "classification" and multiclass:
+            # No squeezing, leave logits as is for CrossEntropyLoss, which
+            # takes class indices directly
+            self.step_outputs = _identity
+            self.step_labels = _to_long
+            if self.hparams.loss_f != "cross_entropy":
+                self.loss_targets = partial(_one_hot, num_classes=self.hparams.no_classes)
+            self.metric_outputs = _argmax
+            self.test_outputs = _identity
+        elif task == "token_classification" and multiclass:
+            self.step_outputs = _channels_first
+            self.step_labels = _to_long
+            # Get the maximum value of the 3rd dimension
+            self.metric_outputs = _argmax
+            self.test_outputs = _argmax
+        elif task == "multilabel_classification":
+            self.step_outputs = _identity
+            self.step_labels = float_labels
+            if self.hparams.no_classes == 1:
+                # Logits loss function must be being used so we have to convert to probabilities
+                self.metric_outputs = torch.sigmoid
+                self.metric_labels = _to_int
+            else:
+                self.metric_outputs = _identity
+            self.test_outputs = self.metric_outputs
+        else:
+            self.step_outputs = _squeeze
+            self.step_labels = float_labels
+            self.metric_outputs = _identity
+            self.test_outputs = _identity
+
+    def shared_step(self, batch):
+        """Runs the model on a batch and returns the loss, the outputs and the labels."""
+        if self.model.task == "masked_lm":
+            outputs = self(
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                labels=batch["labels"],
+            )
+            return outputs.loss, outputs.logits.squeeze(dim=1).to(torch.float32), batch["labels"]
+
+        input, labels = batch[0], batch[1]
+        outputs = self(input)
+        if hasattr(outputs, "logits"):
+            outputs = outputs.logits
+        outputs = self.step_outputs(outputs)
+        labels = self.step_labels(labels)
+        loss = self.loss_function(outputs, self.loss_targets(labels))
+        return loss, outputs, labels
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if (
+            self.mlm_collator is not None
+            and isinstance(batch, dict)
+            and "labels" not in batch
+        ):
+            batch = self.mlm_collator.mask(batch)
+        return batch
+
     # If code hangs here, try https://github.com/microsoft/DeepSpeed/issues/2816
     def on_fit_start(self) -> None:
         self.start_time = time.time()
@@ -140,6 +252,8 @@ class LightningModel(L.LightningModule):
         if torch.cuda.is_available() and isinstance(
             self.trainer.strategy, DeepSpeedStrategy
         ):
+            from deepspeed.profiling.flops_profiler.profiler import FlopsProfiler
+
             self.profiler = FlopsProfiler(self, ds_engine=self.trainer.strategy.model)
 
     def on_fit_end(self) -> None:
@@ -188,61 +302,7 @@ class LightningModel(L.LightningModule):
 
     def training_step(self, batch, batch_idx):
         batch_start_time = time.time()
-        if self.model.task == "masked_lm":
-            input = batch["input_ids"]
-            attention_mask = batch["attention_mask"]
-            labels = batch["labels"]
-            outputs = self(input, attention_mask=attention_mask, labels=labels)
-            loss = outputs.loss
-            outputs = outputs.logits.squeeze(dim=1)
-            outputs = outputs.to(torch.float32)
-        else:
-            input, labels = batch
-            outputs = self(input)
-            # No squeezing, leave logits as is for CrossEntropyLoss
-            if self.model.task == "classification" and self.hparams.no_classes > 1:
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits
-                labels = torch.nn.functional.one_hot(
-                    labels.long(), num_classes=self.hparams.no_classes
-                )
-                labels = labels.float()
-            elif (
-                self.model.task == "token_classification"
-                and self.hparams.no_classes > 1
-            ):
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits
-                # swap 3rd dimension to 2nd dimension
-                outputs = outputs.permute(0, 2, 1)
-                # Convert labels to long
-                labels = labels.long()
-            elif self.model.task == "multilabel_classification":
-                if self.hparams.no_classes < 2:
-                    if hasattr(outputs, "logits"):
-                        outputs = outputs.logits
-            else:
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits.squeeze(dim=1)
-                else:
-                    outputs = outputs.squeeze(dim=1)
-            if torch.backends.mps.is_available():
-                labels = labels.to(torch.float32)
-            loss = self.loss_function(outputs, labels)
-
-        if self.model.task == "classification" and self.hparams.no_classes > 1:
-            labels = torch.argmax(labels, dim=1)
-            outputs = torch.argmax(outputs, dim=1)
-        if self.model.task == "token_classification" and self.hparams.no_classes > 1:
-            # Get the maximum value of the 3rd dimension
-            outputs = torch.argmax(outputs, dim=1)
-        if (
-            self.model.task == "multilabel_classification"
-            and self.hparams.no_classes == 1
-        ):
-            # Logits loss function must be being used so we have to convert to probabilities
-            outputs = torch.sigmoid(outputs)
-            labels = labels.int()
+        loss, outputs, labels = self.shared_step(batch)
 
         self.log(
             "train_loss",
@@ -254,7 +314,7 @@ class LightningModel(L.LightningModule):
             sync_dist=True,
         )
 
-        self.train_metric.update(outputs, labels)
+        self.train_metric.update(self.metric_outputs(outputs), self.metric_labels(labels))
         self.log(
             f"train_{self.metric_label}_step",
             self.train_metric,
@@ -329,47 +389,7 @@ class LightningModel(L.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         batch_start_time = time.time()
-
-        if self.model.task == "masked_lm":
-            input = batch["input_ids"]
-            attention_mask = batch["attention_mask"]
-            labels = batch["labels"]
-            outputs = self(input, attention_mask=attention_mask, labels=labels)
-            loss = outputs.loss
-            outputs = outputs.logits.squeeze(dim=1)
-            outputs = outputs.to(torch.float32)
-        else:
-            input, labels = batch
-            outputs = self(input)
-            # No squeezing, leave logits as is for CrossEntropyLoss
-            if self.model.task == "classification" and self.hparams.no_classes > 1:
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits
-                labels = torch.nn.functional.one_hot(
-                    labels.long(), num_classes=self.hparams.no_classes
-                )
-                labels = labels.float()
-            elif (
-                self.model.task == "token_classification"
-                and self.hparams.no_classes > 1
-            ):
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits
-                outputs = outputs.permute(0, 2, 1)
-                # Convert labels to long
-                labels = labels.long()
-            elif self.model.task == "multilabel_classification":
-                if self.hparams.no_classes < 2:
-                    if hasattr(outputs, "logits"):
-                        outputs = outputs.logits
-            else:
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits.squeeze(dim=1)
-                else:
-                    outputs = outputs.squeeze(dim=1)
-            if torch.backends.mps.is_available():
-                labels = labels.to(torch.float32)
-            loss = self.loss_function(outputs, labels)
+        loss, outputs, labels = self.shared_step(batch)
 
         self.log(
             "val_loss",
@@ -381,20 +401,7 @@ class LightningModel(L.LightningModule):
             sync_dist=True,
         )
 
-        if self.model.task == "classification" and self.hparams.no_classes > 1:
-            labels = torch.argmax(labels, dim=1)
-            outputs = torch.argmax(outputs, dim=1)
-        if self.model.task == "token_classification" and self.hparams.no_classes > 1:
-            # Get the maxium value of the 3rd dimension
-            outputs = torch.argmax(outputs, dim=1)
-        if (
-            self.model.task == "multilabel_classification"
-            and self.hparams.no_classes == 1
-        ):
-            # Logits loss function must be being used so we have to convert to probabilities
-            outputs = torch.sigmoid(outputs)
-            labels = labels.int()
-        self.val_metric.update(outputs, labels)
+        self.val_metric.update(self.metric_outputs(outputs), self.metric_labels(labels))
         self.log(
             f"val_{self.metric_label}_step",
             self.val_metric,
@@ -450,66 +457,16 @@ class LightningModel(L.LightningModule):
 
     def test_step(self, batch, batch_idx):
         batch_start_time = time.time()
-        if self.model.task == "masked_lm":
-            input = batch["input_ids"]
-            attention_mask = batch["attention_mask"]
-            labels = batch["labels"]
-            outputs = self(input, attention_mask=attention_mask, labels=labels)
-            loss = outputs.loss
-            outputs = outputs.logits.squeeze(dim=1)
-            outputs = outputs.to(torch.float32)
-        else:
-            input, labels, ids = batch
-            outputs = self(input)
-
-            # No squeezing, leave logits as is for CrossEntropyLoss
-            if self.model.task == "classification" and self.hparams.no_classes > 1:
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits
-                labels = torch.nn.functional.one_hot(
-                    labels.long(), num_classes=self.hparams.no_classes
-                )
-                labels = labels.float()
-            elif (
-                self.model.task == "token_classification"
-                and self.hparams.no_classes > 1
-            ):
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits
-                # swap 3rd dimension to 2nd dimension
-                outputs = outputs.permute(0, 2, 1)
-                # Convert labels to long
-                labels = labels.long()
-            elif self.model.task == "multilabel_classification":
-                if self.hparams.no_classes < 2:
-                    if hasattr(outputs, "logits"):
-                        outputs = outputs.logits
-            else:
-                if hasattr(outputs, "logits"):
-                    outputs = outputs.logits.squeeze(dim=1)
-                else:
-                    outputs = outputs.squeeze(dim=1)
-            if torch.backends.mps.is_available():
-                labels = labels.to(torch.float32)
-            loss = self.loss_function(outputs, labels)
+        loss, outputs, labels = self.shared_step(batch)
         self.log(
             "test_loss", loss, on_step=True, on_epoch=True, logger=True, prog_bar=False
         )
 
-        if self.model.task == "classification" and self.hparams.no_classes > 1:
-            labels = torch.argmax(labels, dim=1)
-            # outputs = torch.argmax(outputs, dim=1)
-        if self.model.task == "token_classification" and self.hparams.no_classes > 1:
-            # Get the maximum value of the 3rd dimension
-            outputs = torch.argmax(outputs, dim=1)
-        if (
-            self.model.task == "multilabel_classification"
-            and self.hparams.no_classes == 1
-        ):
-            # Logits loss function must be being used so we have to convert to probabilities
-            outputs = torch.sigmoid(outputs)
-            labels = labels.int()
-        self.metrics.add(outputs, labels, ids)
+        self.metrics.add(
+            self.test_outputs(outputs),
+            self.metric_labels(labels),
+            None if self.model.task == "masked_lm" else batch[2],
+        )
 
         if self.log_interval != -1 and batch_idx % self.log_interval == 0:
             self.plmfit_logger.log(
@@ -519,16 +476,21 @@ class LightningModel(L.LightningModule):
         return loss
 
     def on_test_end(self) -> None:
+        self.save_test_metrics(
+            self.trainer.logged_metrics["test_loss_epoch"], self.trainer.global_rank
+        )
+
+    def save_test_metrics(self, test_loss, global_rank=0):
         self.metrics.preds_list = self.merge_lists(self.metrics.preds_list)
         self.metrics.actual_list = self.merge_lists(self.metrics.actual_list)
         self.metrics.ids = self.merge_lists(self.metrics.ids)
         metrics = self.metrics.get_metrics(device=self.device)
         self.plmfit_logger.log(
-            f'loss: {self.trainer.logged_metrics["test_loss_epoch"]:.4f} {time.time() - self.epoch_start_time:.4f}s'
+            f"loss: {test_loss:.4f} {time.time() - self.epoch_start_time:.4f}s"
         )
         for key, value in metrics["main"].items():
             self.plmfit_logger.log(f"{key}: {value}")
-        if self.trainer.global_rank == 0:
+        if global_rank == 0:
             self.plmfit_logger.save_data(metrics["main"], "metrics")
             self.metrics.save_metrics(
                 path=f"{self.plmfit_logger.base_dir}/{self.plmfit_logger.experiment_name}"
@@ -575,7 +537,11 @@ class LightningModel(L.LightningModule):
             )
         elif self.hparams.optimizer == "adam":
             # if strategy is deepspeed, use DeepSpeedCPUAdam instead of torch.optim.Adam
-            if isinstance(self.trainer.strategy, DeepSpeedStrategy):
+            if self._trainer is not None and isinstance(
+                self.trainer.strategy, DeepSpeedStrategy
+            ):
+                from deepspeed.ops.adam import DeepSpeedCPUAdam
+
                 return DeepSpeedCPUAdam(
                     parameters,
                     lr=self.hparams.learning_rate,
@@ -642,11 +608,14 @@ class LightningModel(L.LightningModule):
     def handle_hparam_exists(self, hparam_name):
         return hparam_name in self.hparams and self.hparams[hparam_name] is not None
 
+    def early_stopping_patience(self):
+        return self.handle_bool_float_config_param(
+            self.hparams.early_stopping, false_value=-1, true_value=10
+        )
+
     def early_stopping(self, patience=None):
         if patience is None:
-            patience = self.handle_bool_float_config_param(
-                self.hparams.early_stopping, false_value=-1, true_value=10
-            )
+            patience = self.early_stopping_patience()
         if patience == -1:
             return None
         return EarlyStopping(
@@ -680,13 +649,35 @@ class LightningModel(L.LightningModule):
         return lists
 
 
+def concat_rows(chunks, pad_value=0):
+    """
+    Concatenate batches of rows, padding them to the widest one first when
+    they have different widths (length-bucketed token classification).
+    """
+    if len(chunks) == 0:
+        return torch.empty(0)
+    if chunks[0].dim() > 1:
+        width = max(chunk.size(1) for chunk in chunks)
+        chunks = [
+            F.pad(chunk, (0, width - chunk.size(1)), value=pad_value) for chunk in chunks
+        ]
+    return torch.cat(chunks)
+
+
 class Metrics(torch.nn.Module):
+    """
+    Test metrics of a task. Predictions, labels and ids are kept as CPU tensor
+    chunks per batch and the raw arrays are written to a `.npz` sidecar next to
+    the JSON report, which only points to it.
+    """
+
     def __init__(self, task: str, no_classes=1, no_labels=1):
         super().__init__()
         self.task = task
         self.preds_list = []
         self.actual_list = []
         self.ids = []
+        self.report = None
         if task == "classification":
             self.no_classes = no_classes
             if self.no_classes < 2:
@@ -735,33 +726,13 @@ class Metrics(torch.nn.Module):
             )
 
     def add(self, preds, actual, ids):
-        if (
-            self.task == "token_classification"
-            or self.task == "multilabel_classification"
-        ):
-            self.preds_list.extend(preds.tolist())
-            self.actual_list.extend(actual.tolist())
-            (
-                self.ids.extend(ids.tolist())
-                if len(ids.tolist()) > 1
-                else self.ids.append(ids.item())
-            )
-        else:
-            (
-                self.preds_list.extend(preds.tolist())
-                if len(preds.tolist()) > 1
-                else self.preds_list.append(preds.item())
-            )
-            (
-                self.actual_list.extend(actual.tolist())
-                if len(actual.tolist()) > 1
-                else self.actual_list.append(actual.item())
-            )
-            (
-                self.ids.extend(ids.tolist())
-                if len(ids.tolist()) > 1
-                else self.ids.append(ids.item())
-            )
+        if self.task == "masked_lm":
+            # Logits are too large to keep, update the metric right away
+            self.calc_masked_lm_metrics(preds, actual)
+            return
+        self.preds_list.append(preds.detach().cpu())
+        self.actual_list.append(actual.detach().cpu())
+        self.ids.append(ids.detach().cpu().reshape(-1))
 
     def calculate(self, preds, actual):
         if self.task == "classification":
@@ -808,10 +779,13 @@ class Metrics(torch.nn.Module):
         self.cm.update(preds, actual)
 
     def get_metrics(self, device="cpu"):
-        self.calculate(
-            torch.tensor(self.preds_list, device=device),
-            torch.tensor(self.actual_list, device=device),
-        )
+        # Length-bucketed batches are trimmed to different widths, pad
+        # them back with the ignored label
+        self.preds = concat_rows(self.preds_list)
+        self.actual = concat_rows(self.actual_list, pad_value=-100)
+        self.sample_ids = concat_rows(self.ids)
+        if self.task != "masked_lm":
+            self.calculate(self.preds.to(device), self.actual.to(device))
         if self.task == "classification":
             return self.get_classification_metrics()
         elif self.task == "regression":
@@ -837,12 +811,7 @@ class Metrics(torch.nn.Module):
                     "fpr": fpr.tolist(),
                     "tpr": tpr.tolist(),
                     "roc_auc_val": self.roc_auc.compute().item(),
-                },
-                "pred_data": {
-                    "preds": self.preds_list,
-                    "actual": self.actual_list,
-                    "ids": self.ids,
-                },
+                }
             }
         else:
             self.report = {
@@ -851,12 +820,7 @@ class Metrics(torch.nn.Module):
                     "micro_accuracy": self.micro_acc.compute().item(),
                     "mcc": self.mcc.compute().item(),
                     "confusion_matrix": self.cm.compute().tolist(),
-                },
-                "pred_data": {
-                    "preds": self.preds_list,
-                    "actual": self.actual_list,
-                    "ids": self.ids,
-                },
+                }
             }
         return self.report
 
@@ -869,15 +833,7 @@ class Metrics(torch.nn.Module):
             "spearman": self.spearman.compute().item(),
         }
 
-        self.report = {
-            "main": metrics,
-            "pred_data": {
-                "preds": self.preds_list,
-                "actual": self.actual_list,
-                "ids": self.ids,
-                "eval_metrics": metrics,
-            },
-        }
+        self.report = {"main": metrics}
 
         return self.report
 
@@ -897,12 +853,7 @@ class Metrics(torch.nn.Module):
                 "micro_accuracy": self.micro_acc.compute().item(),
                 "mcc": self.mcc.compute().item(),
                 "confusion_matrix": self.cm.compute().tolist(),
-            },
-            "pred_data": {
-                "preds": self.preds_list,
-                "actual": self.actual_list,
-                "ids": self.ids,
-            },
+            }
         }
         return self.report
 
@@ -912,41 +863,43 @@ class Metrics(torch.nn.Module):
                 "accuracy": self.acc.compute().item(),
                 "mcc": self.mcc.compute().item(),
                 "confusion_matrix": self.cm.compute().tolist(),
-            },
-            "pred_data": {
-                "preds": self.preds_list,
-                "actual": self.actual_list,
-                "ids": self.ids,
-            },
+            }
         }
         return self.report
 
     def save_metrics(self, path):
         metrics_path = f"{path}_metrics.json"
+        pred_data_path = f"{path}_pred_data.npz"
         if self.report is None:
             self.get_metrics()
 
+        pred_data = {"preds": self.preds, "actual": self.actual, "ids": self.sample_ids}
         # Check if the metrics file already exists
         if os.path.exists(metrics_path):
             # Load the existing data
             with open(metrics_path, "r", encoding="utf-8") as f:
                 existing_data = json.load(f)
 
-            # Check if 'pred_data' field exists and update it
-            if "pred_data" in existing_data:
-                existing_data["pred_data"]["preds"].extend(
-                    self.report["pred_data"]["preds"]
-                )
-                existing_data["pred_data"]["actual"].extend(
-                    self.report["pred_data"]["actual"]
-                )
-                existing_data["pred_data"]["ids"].extend(
-                    self.report["pred_data"]["ids"]
-                )
+            # Check if 'pred_data' field exists and append to it
+            if "pred_data" in existing_data and self.task != "masked_lm":
+                existing = utils.load_pred_data(metrics_path, existing_data)
+                pred_data = {
+                    key: concat_rows(
+                        [torch.as_tensor(existing[key]), pred_data[key]],
+                        pad_value=-100 if key == "actual" else 0,
+                    )
+                    for key in pred_data
+                }
                 self.report = existing_data
-            else:
-                # If 'pred_data' does not exist, simply prepare to write the current report
-                pass
+
+        if self.task != "masked_lm":
+            np.savez(
+                pred_data_path, **{key: value.numpy() for key, value in pred_data.items()}
+            )
+            self.report["pred_data"] = {
+                "file": os.path.basename(pred_data_path),
+                "num_samples": len(pred_data["ids"]),
+            }
 
         # Write the updated or original report to the file
         with open(metrics_path, "w", encoding="utf-8") as f:
@@ -955,15 +908,40 @@ class Metrics(torch.nn.Module):
 
 class PredictionWriter(BasePredictionWriter):
 
-    def __init__(self, logger, write_interval, split_size=0, format="pt"):
+    def __init__(
+        self,
+        logger,
+        write_interval,
+        split_size=0,
+        format="pt",
+        output_index=None,
+        name=None,
+        metadata=None,
+    ):
         super().__init__(write_interval)
         self.output_dir = logger.base_dir
-        self.file_name = logger.experiment_name
+        self.file_name = (
+            logger.experiment_name if name is None else f"{logger.experiment_name}_{name}"
+        )
         self.logger = logger
         self.split_size = split_size
         self.format = format
+        # Index of this writer's output in multi-output predictions
+        self.output_index = output_index
+        # Header fields of embedding stores (e.g. model, layer, reduction)
+        self.metadata = metadata if metadata is not None else {}
 
     def write_on_epoch_end(self, trainer, pl_module, predictions, batch_indices):
+        if self.output_index is not None:
+            predictions = [p[:, self.output_index] for p in predictions]
+        # Token level predictions of length-bucketed batches are trimmed to
+        # different widths, pad them back to the widest batch
+        if len({p.shape[1:] for p in predictions}) > 1:
+            width = max(p.shape[1] for p in predictions)
+            predictions = [
+                F.pad(p, (0, 0) * (p.dim() - 2) + (0, width - p.shape[1]))
+                for p in predictions
+            ]
         # Make list into a single tensor
         predictions = torch.cat(predictions, dim=0)
         batch_indices = [
@@ -980,6 +958,12 @@ class PredictionWriter(BasePredictionWriter):
         if self.split_size == 0:
             if self.format == "pt":
                 torch.save(sorted_predictions, f"{self.output_dir}/{self.file_name}.pt")
+            elif self.format == "emb":
+                EmbeddingStore.write(
+                    f"{self.output_dir}/{self.file_name}.emb",
+                    sorted_predictions,
+                    **self.metadata,
+                )
             elif self.format == "csv":
                 sorted_predictions = sorted_predictions.cpu().numpy()
                 # Save the predictions to a CSV file
@@ -1043,3 +1027,134 @@ class PredictionWriter(BasePredictionWriter):
 
         self.logger.log(f"Predictions saved to {self.output_dir}/{self.file_name}.pt")
         self.logger.log(f"Predictions shape: {prediction.shape}")
+
+
+class ShardedPredictionWriter(BasePredictionWriter):
+    """
+    Streams predictions batch by batch into fixed-size .npy shards, so the
+    output is never fully resident in host or device memory. Each shard is
+    stored next to the sample indices of its rows and recorded in a per-rank
+    manifest once complete; a restarted job predicts only `pending_indices`.
+    """
+
+    def __init__(
+        self,
+        logger,
+        shard_size=100000,
+        width=None,
+        dtype=np.float32,
+        output_index=None,
+        name=None,
+    ):
+        super().__init__("batch")
+        file_name = (
+            logger.experiment_name if name is None else f"{logger.experiment_name}_{name}"
+        )
+        self.output_dir = f"{logger.base_dir}/{file_name}_shards"
+        self.logger = logger
+        self.shard_size = shard_size
+        self.width = width
+        self.dtype = dtype
+        # Index of this writer's output in multi-output predictions
+        self.output_index = output_index
+        self.manifest = None
+        self.shard = None
+        self.num_samples = None
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def pending_indices(self, num_samples):
+        # Recorded in the manifest, so that loading can tell an unfinished extraction
+        self.num_samples = num_samples
+        done = np.zeros(num_samples, dtype=bool)
+        for entry in utils.read_shard_manifests(self.output_dir):
+            done[np.load(f"{self.output_dir}/{entry['indices']}")] = True
+        return np.flatnonzero(~done).tolist()
+
+    def open_shard(self, rank, row_shape):
+        self.manifest_path = f"{self.output_dir}/manifest_{rank}.json"
+        if self.manifest is None:
+            self.manifest = {"shards": []}
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self.manifest = json.load(f)
+        self.shard_name = f"shard_{rank}_{len(self.manifest['shards']):05d}"
+        self.shard = np.lib.format.open_memmap(
+            f"{self.output_dir}/{self.shard_name}.partial.npy",
+            mode="w+",
+            dtype=self.dtype,
+            shape=(self.shard_size,) + tuple(row_shape),
+        )
+        self.shard_indices = np.empty(self.shard_size, dtype=np.int64)
+        self.rows = 0
+
+    def close_shard(self):
+        partial_path = f"{self.output_dir}/{self.shard_name}.partial.npy"
+        if self.rows == self.shard_size:
+            self.shard.flush()
+            self.shard = None
+            os.replace(partial_path, f"{self.output_dir}/{self.shard_name}.npy")
+        else:
+            np.save(f"{self.output_dir}/{self.shard_name}.npy", self.shard[: self.rows])
+            self.shard = None
+            os.remove(partial_path)
+        np.save(
+            f"{self.output_dir}/{self.shard_name}.idx.npy",
+            self.shard_indices[: self.rows],
+        )
+
+        # The manifest is only updated once the shard is on disk, so a crash
+        # mid-shard loses at most that shard
+        self.manifest["shards"].append(
+            {
+                "file": f"{self.shard_name}.npy",
+                "indices": f"{self.shard_name}.idx.npy",
+                "rows": self.rows,
+            }
+        )
+        if self.num_samples is not None:
+            self.manifest["num_samples"] = self.num_samples
+        with open(f"{self.manifest_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def write_on_batch_end(
+        self,
+        trainer,
+        pl_module,
+        prediction,
+        batch_indices,
+        batch,
+        batch_idx,
+        dataloader_idx,
+    ):
+        if self.output_index is not None:
+            prediction = prediction[:, self.output_index]
+        prediction = prediction.detach().float().cpu()
+        # Token level predictions of length-bucketed batches are trimmed to
+        # different widths, pad them back to the input width
+        if prediction.dim() > 2 and self.width is not None:
+            prediction = F.pad(
+                prediction,
+                (0, 0) * (prediction.dim() - 2) + (0, self.width - prediction.shape[1]),
+            )
+        prediction = prediction.numpy()
+        batch_indices = np.asarray(batch_indices, dtype=np.int64)
+
+        start = 0
+        while start < len(prediction):
+            if self.shard is None:
+                self.open_shard(trainer.global_rank, prediction.shape[1:])
+            rows = min(len(prediction) - start, self.shard_size - self.rows)
+            self.shard[self.rows : self.rows + rows] = prediction[start : start + rows]
+            self.shard_indices[self.rows : self.rows + rows] = batch_indices[
+                start : start + rows
+            ]
+            self.rows += rows
+            start += rows
+            if self.rows == self.shard_size:
+                self.close_shard()
+
+    def on_predict_epoch_end(self, trainer, pl_module):
+        if self.shard is not None and self.rows > 0:
+            self.close_shard()
+        self.logger.log(f"Predictions saved to {self.output_dir}")
@@ -1,10 +1,13 @@
 import os
+from plmfit.language_models.progen2.models.progen.configuration_progen import ProGenConfig
 from plmfit.language_models.progen2.models.progen.modeling_progen import (
+    ProGenForCausalLM,
     ProGenForSequenceClassification,
     ProGenForEmbeddingsExtraction,
     ProGenForTokenClassification,
 )
 from plmfit.language_models.proteinbert.modeling_bert import (
+    ProteinBertConfig,
     ProteinBertForSequenceClassification,
     ProteinBertForMaskedLM,
     ProteinBertForEmbeddingsExtraction,
@@ -20,11 +23,13 @@ from plmfit.language_models.esmC.modeling_esmc import (
     PlmfitEsmCForSequenceClassification,
     PlmfitEsmCForEmbdeddingsExtraction,
 )
+from plmfit.language_models.esmC.pretrained import ESMC_NUM_LAYERS
 
 # from plmfit.shared_utils.data_explore import visualize_embeddings
 
 from plmfit.shared_utils.linear_block import ProGenLinearBlock
 import plmfit.shared_utils.utils as utils
+from plmfit.shared_utils.poolers import GeneralPooler, reduce_hidden_states
 import torch.nn as nn
 import plmfit.logger as l
 import torch
@@ -36,10 +41,10 @@ from tokenizers import Tokenizer
 from transformers import (
     AutoTokenizer,
     AutoModel,
+    EsmConfig,
     EsmForMaskedLM,
     EsmForSequenceClassification,
 )
-from antiberty import AntiBERTyRunner
 from numpy import array
 import psutil
 import traceback
@@ -81,22 +86,60 @@ class IPretrainedProteinLanguageModel(nn.Module):
     def set_tokenizer(self, tokenizer):
         self.tokenizer = tokenizer
 
-    def set_layer_to_use(self, layer):
+    def get_pad_token_id(self):
+        return self.tokenizer.pad_token_id
+
+    def get_eos_token_id(self):
+        return self.tokenizer.eos_token_id
+
+    def set_pooler_eos_token_id(self):
+        # The "eos" reduction of the model's poolers looks up this token
+        for module in self.py_model.modules():
+            if isinstance(module, GeneralPooler):
+                module.eos_token_id = self.get_eos_token_id()
+
+    def layer_index(self, layer):
         if layer == "last":
             # The last hidden layer
-            self.layer_to_use = self.no_layers - 1
+            return self.no_layers - 1
         elif layer == "middle":
-            self.layer_to_use = (self.no_layers - 1) // 2
+            return (self.no_layers - 1) // 2
         elif layer == "first":
-            self.layer_to_use = 0
+            return 0
         elif layer == "quarter1":
-            self.layer_to_use = (self.no_layers - 1) // 4
+            return (self.no_layers - 1) // 4
         elif layer == "quarter3":
-            self.layer_to_use = (self.no_layers - 1) // 2 + (self.no_layers - 1) // 4
+            return (self.no_layers - 1) // 2 + (self.no_layers - 1) // 4
         else:
             # Fallback for numeric layer specification or unexpected strings
-            self.layer_to_use = int(layer) if layer.isdigit() else self.no_layers - 1
+            return int(layer) if layer.isdigit() else self.no_layers - 1
+
+    def layers_to_load(self, layers=None):
+        """
+        Number of transformer blocks to build and load from the checkpoint so
+        that `layers` can be used, all of them when no layers are given.
+        """
+        if layers is None:
+            return self.no_layers
+        return max(self.layer_index(str(layer)) for layer in layers) + 1
+
+    def check_layer_loaded(self, layer_to_use):
+        if layer_to_use >= self.no_loaded_layers:
+            raise ValueError(
+                f"Layer {layer_to_use} is not loaded, only the first {self.no_loaded_layers} "
+                f"of {self.no_layers} layers were initialized"
+            )
 
+    def set_layer_to_use(self, layer):
+        self.layer_to_use = self.layer_index(layer)
+        self.check_layer_loaded(self.layer_to_use)
+        self.py_model.trim_model(self.layer_to_use)
+
+    def set_layers_to_use(self, layers):
+        # Several layers are pooled from one forward pass of the model trimmed after the deepest
+        self.py_model.layers = [self.layer_index(layer) for layer in layers]
+        self.layer_to_use = max(self.py_model.layers)
+        self.check_layer_loaded(self.layer_to_use)
         self.py_model.trim_model(self.layer_to_use)
 
 
@@ -105,6 +148,8 @@ class Antiberty(IPretrainedProteinLanguageModel):
         super().__init__()
         self.name = "antiberty"
         self.logger = l.Logger(f"{self.name}")
+        from antiberty import AntiBERTyRunner
+
         self.model = AntiBERTyRunner()
 
     def extract_embeddings(self, data_type, layer, reduction, output_dir="default"):
@@ -187,36 +232,44 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
     tokenizer: Tokenizer
 
     def __init__(
-        self, progen_model_name: str, logger: l.Logger, task: str = "regression"
+        self,
+        progen_model_name: str,
+        logger: l.Logger,
+        task: str = "regression",
+        layers=None,
     ):
         super().__init__(logger)
         self.name = progen_model_name
         self.task = task
+        checkpoint = (
+            f"{utils.plmfit_path}/language_models/progen2/checkpoints/{progen_model_name}"
+        )
+        self.no_layers = ProGenConfig.from_pretrained(checkpoint).n_layer
+        # Only the blocks up to the deepest layer used are built and read from the checkpoint
+        load_kwargs = {"n_layer": self.layers_to_load(layers), "low_cpu_mem_usage": True}
         if self.task == "causal_lm":
-            raise ValueError("Causal LM not supported yet for ProGen")
-            # self.py_model : PlmfitEsmForMaskedLM = PlmfitEsmForMaskedLM.from_pretrained(f'facebook/{esm_version}', output_hidden_states = True)
-            # self.output_dim = self.py_model.lm_head.decoder.out_features
+            self.py_model = ProGenForCausalLM.from_pretrained(checkpoint, **load_kwargs)
+            self.output_dim = self.py_model.lm_head.out_features
         elif self.task == "token_classification":
             self.py_model = ProGenForTokenClassification.from_pretrained(
-                f"{utils.plmfit_path}/language_models/progen2/checkpoints/{progen_model_name}"
+                checkpoint, **load_kwargs
             )
             self.output_dim = self.py_model.classifier.out_features
         elif self.task == "extract_embeddings":
             self.py_model = ProGenForEmbeddingsExtraction.from_pretrained(
-                f"{utils.plmfit_path}/language_models/progen2/checkpoints/{progen_model_name}"
+                checkpoint, **load_kwargs
             )
         else:
             self.py_model: ProGenForSequenceClassification = (
-                ProGenForSequenceClassification.from_pretrained(
-                    f"{utils.plmfit_path}/language_models/progen2/checkpoints/{progen_model_name}"
-                )
+                ProGenForSequenceClassification.from_pretrained(checkpoint, **load_kwargs)
             )
             self.output_dim = self.py_model.classifier.out_features
         self.no_parameters = utils.get_parameters(self.py_model)
-        self.no_layers = len(self.py_model.transformer.h)
+        self.no_loaded_layers = len(self.py_model.transformer.h)
         self.emb_layers_dim = self.py_model.transformer.h[0].attn.out_proj.out_features
         self.tokenizer = utils.load_tokenizer(progen_model_name)
-        self.layer_to_use = self.no_layers - 1
+        self.layer_to_use = self.no_loaded_layers - 1
+        self.set_pooler_eos_token_id()
         self.config = self.py_model.config
         self.experimenting = False
 
@@ -231,7 +284,7 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
             self.logger.log("Zeroed the model with plain linear blocks")
 
     def categorical_encode(self, data, max_length="default"):
-        encs = utils.categorical_encode(
+        encs = utils.cached_categorical_encode(
             data["aa_seq"].values,
             self.tokenizer,
             max(data["len"].values) if max_length == "default" else max_length,
@@ -241,10 +294,18 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
         )
         return encs
 
+    def get_pad_token_id(self):
+        return self.tokenizer.get_vocab()["<|pad|>"]
+
+    def get_eos_token_id(self):
+        return self.tokenizer.get_vocab()["<|eos|>"]
+
     def extract_embeddings(
         self, data_type, batch_size=1, layer=11, reduction="mean", log_interval=1000
     ):
         try:
+            if utils.convert_to_number(reduction) is not None:
+                reduction = int(reduction)
             self.set_layer_to_use(layer)
             layer = (
                 self.layer_to_use + 1
@@ -310,7 +371,7 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
                             if mem_usage > max_mem_usage:
                                 max_mem_usage = mem_usage
                         else:
-                            model_output = self.py_model(batch[0])
+                            model_output = self.py_model(batch[0], output_hidden_states=True)
                             mem_usage = utils.print_gpu_utilization(
                                 memory_usage, device
                             )
@@ -327,91 +388,14 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
 
                             # Now select the specific layer's output
                             out = hidden_states[layer]
-                        if reduction == "mean":
-                            embs[i : i + current_batch_size, :] = torch.mean(out, dim=1)
-                            if i == 2:
-                                self.logger.log(f"{(torch.mean(out, dim=1)).size()}")
-                                # visualize_embeddings(torch.mean(out, dim=1), use_heatmap=False)
-                        elif reduction == "weighted_mean":
-                            # Calculate L2 norms of vectors across the feature dimension
-                            l2_norms = torch.norm(out, p=2, dim=-1)
-
-                            # Calculate variance of vectors across the feature dimension
-                            variances = torch.var(out, dim=-1, unbiased=False)
-
-                            # Normalize the outputs to positive values to calculate entropy
-                            normalized_outputs = F.softmax(out, dim=-1)
-                            # Calculate entropy across the feature dimension
-                            entropy = -torch.sum(
-                                normalized_outputs
-                                * torch.log(normalized_outputs + 1e-10),
-                                dim=-1,
-                            )
-
-                            # Apply softmax to L2 norms to get weights for each token
-                            weights = F.softmax(l2_norms, dim=1)
-                            print(weights)
-                            # Use weights to perform weighted mean across the sequence length dimension
-                            weighted_mean = torch.sum(
-                                out * weights.unsqueeze(-1), dim=1
-                            )
-                            embs[i : i + current_batch_size, :] = weighted_mean
-                            if i == 2:
-                                # print(f"First batch weighted mean vector: {weighted_mean}")
-                                self.logger.log(
-                                    f"Weighted Mean of first batch: {weighted_mean.numpy()}"
-                                )
-                                # visualize_embeddings(weighted_mean, use_heatmap=False)
-
-                        elif reduction == "sum":
-                            embs[i : i + current_batch_size, :] = torch.sum(out, dim=1)
-                        elif reduction == "bos":
-                            # Select the embeddings for the first token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[:, 0, :]
-                        elif reduction == "eos":
-                            # Initialize a tensor to store the selected embeddings
-                            selected_embs = torch.zeros(
-                                current_batch_size, out.shape[2], device=out.device
-                            )
-
-                            # Iterate over each sequence in the batch
-                            for seq_idx in range(current_batch_size):
-                                # Find the positions of the token with ID equal to 2 in the current sequence
-                                token_positions = (batch[0][seq_idx] == 2).nonzero(
-                                    as_tuple=True
-                                )[0]
-
-                                # Check if the token ID is present in the sequence
-                                if len(token_positions) > 0:
-                                    # Select the position of the last occurrence of the token
-                                    last_position = token_positions[-1].item()
-
-                                    # Select the embeddings for the last occurrence of the token
-                                    selected_embs[seq_idx, :] = out[
-                                        seq_idx, last_position, :
-                                    ]
-                                else:
-                                    # If the token ID is not found, you might want to handle this case.
-                                    # For example, use the embeddings of the last token of the sequence
-                                    # or set to zeros, depending on your application's requirements.
-                                    # Here, we use the embeddings of the last token as a fallback.
-                                    selected_embs[seq_idx, :] = out[seq_idx, -1, :]
-                                    self.logger.log(
-                                        f"EOS token not found for sequence {i}"
-                                    )
-
-                            # Update the embeddings tensor with the selected embeddings
-                            embs[i : i + current_batch_size, :] = selected_embs
-                            if i == 2:
-                                self.logger.log(selected_embs)
-                                # visualize_embeddings(selected_embs, use_heatmap=False)
-                        elif utils.convert_to_number(reduction) is not None:
-                            # Select the embeddings for the i token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[
-                                :, utils.convert_to_number(reduction), :
-                            ]
-                        else:
-                            raise ValueError("Unsupported reduction option")
+                        # Padding is excluded, eos falls back to the last non-padding token of truncated rows
+                        embs[i : i + current_batch_size, :] = reduce_hidden_states(
+                            out,
+                            reduction,
+                            attention_mask=batch[0] != self.get_pad_token_id(),
+                            input_ids=batch[0],
+                            eos_token_id=self.get_eos_token_id(),
+                        )
                         del out
                         i = i + current_batch_size
                         if log_interval != -1 and i % log_interval == 0:
@@ -461,7 +445,7 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
         return 0
 
     def forward(self, src):
-        src = self.py_model(src).hidden_states[self.layer_to_use]
+        src = self.py_model(src, output_hidden_states=True).hidden_states[self.layer_to_use]
         src = torch.mean(src, dim=1)
         if self.head != None:
             src = self.head(src)
@@ -471,41 +455,57 @@ class ProGenFamily(IPretrainedProteinLanguageModel):
 class ESMFamily(IPretrainedProteinLanguageModel):
     tokenizer: AutoTokenizer
 
-    def __init__(self, esm_version: str, logger: l.Logger, task: str = "regression"):
+    def __init__(
+        self,
+        esm_version: str,
+        logger: l.Logger,
+        task: str = "regression",
+        layers=None,
+    ):
         super().__init__(logger, task)
         self.version = esm_version
+        checkpoint = f"facebook/{esm_version}"
+        self.no_layers = EsmConfig.from_pretrained(checkpoint).num_hidden_layers
+        # Only the blocks up to the deepest layer used are built and read from the checkpoint
+        load_kwargs = {
+            "num_hidden_layers": self.layers_to_load(layers),
+            "low_cpu_mem_usage": True,
+        }
         if self.task == "masked_lm":
             self.py_model: PlmfitEsmForMaskedLM = PlmfitEsmForMaskedLM.from_pretrained(
-                f"facebook/{esm_version}", output_hidden_states=True
+                checkpoint, **load_kwargs
             )
             self.output_dim = self.py_model.lm_head.decoder.out_features
         elif self.task == "token_classification":
             self.py_model = PlmfitEsmForTokenClassification.from_pretrained(
-                f"facebook/{esm_version}", output_hidden_states=True
+                checkpoint, **load_kwargs
             )
             self.output_dim = self.py_model.classifier.out_features
         elif self.task == "extract_embeddings":
             self.py_model = PlmfitEsmForEmbdeddingsExtraction.from_pretrained(
-                f"facebook/{esm_version}", output_hidden_states=True
+                checkpoint, **load_kwargs
             )
         else:
             self.py_model = PlmfitEsmForSequenceClassification.from_pretrained(
-                f"facebook/{esm_version}", output_hidden_states=True
+                checkpoint, **load_kwargs
             )
             self.output_dim = self.py_model.classifier.out_features
         self.no_parameters = utils.get_parameters(self.py_model)
-        self.no_layers = len(self.py_model.esm.encoder.layer)
+        self.no_loaded_layers = len(self.py_model.esm.encoder.layer)
         self.emb_layers_dim = self.py_model.esm.encoder.layer[
             0
         ].attention.self.query.in_features
-        self.tokenizer = AutoTokenizer.from_pretrained(f"facebook/{esm_version}")
-        self.layer_to_use = self.no_layers - 1
+        self.tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+        self.layer_to_use = self.no_loaded_layers - 1
+        self.set_pooler_eos_token_id()
         self.experimenting = False
 
     def extract_embeddings(
         self, data_type, batch_size=1, layer=11, reduction="mean", log_interval=1000
     ):
         try:
+            if utils.convert_to_number(reduction) is not None:
+                reduction = int(reduction)
             self.set_layer_to_use(layer)
             layer = (
                 self.layer_to_use + 1
@@ -566,7 +566,7 @@ class ESMFamily(IPretrainedProteinLanguageModel):
                         if layer == "logits":
                             out = self.py_model(batch[0]).logits
                         else:
-                            model_output = self.py_model(batch[0])
+                            model_output = self.py_model(batch[0], output_hidden_states=True)
                             hidden_states = model_output.hidden_states
 
                             # Log the shape of each layer's embeddings for the first batch if we are unsure what our model outputs
@@ -576,56 +576,14 @@ class ESMFamily(IPretrainedProteinLanguageModel):
 
                             # Now select the specific layer's output
                             out = hidden_states[layer]
-                        if reduction == "mean":
-                            embs[i : i + current_batch_size, :] = torch.mean(out, dim=1)
-                            if i == 0:
-                                self.logger.log(f"{(torch.mean(out, dim=1)).size()}")
-                        elif reduction == "sum":
-                            embs[i : i + current_batch_size, :] = torch.sum(out, dim=1)
-                        elif reduction == "bos":
-                            # Select the embeddings for the first token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[:, 0, :]
-                        elif reduction == "eos":
-                            # Initialize a tensor to store the selected embeddings
-                            selected_embs = torch.zeros(
-                                current_batch_size, out.shape[2], device=out.device
-                            )
-
-                            # Iterate over each sequence in the batch
-                            for seq_idx in range(current_batch_size):
-                                # Find the positions of the token with ID equal to 2 in the current sequence
-                                token_positions = (batch[0][seq_idx] == 2).nonzero(
-                                    as_tuple=True
-                                )[0]
-
-                                # Check if the token ID is present in the sequence
-                                if len(token_positions) > 0:
-                                    # Select the position of the last occurrence of the token
-                                    last_position = token_positions[-1].item()
-
-                                    # Select the embeddings for the last occurrence of the token
-                                    selected_embs[seq_idx, :] = out[
-                                        seq_idx, last_position, :
-                                    ]
-                                else:
-                                    # If the token ID is not found, you might want to handle this case.
-                                    # For example, use the embeddings of the last token of the sequence
-                                    # or set to zeros, depending on your application's requirements.
-                                    # Here, we use the embeddings of the last token as a fallback.
-                                    selected_embs[seq_idx, :] = out[seq_idx, -1, :]
-                                    self.logger.log(
-                                        f"EOS token not found for sequence {i}"
-                                    )
-
-                            # Update the embeddings tensor with the selected embeddings
-                            embs[i : i + current_batch_size, :] = selected_embs
-                        elif utils.convert_to_number(reduction) is not None:
-                            # Select the embeddings for the i token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[
-                                :, utils.convert_to_number(reduction), :
-                            ]
-                        else:
-                            raise ValueError("Unsupported reduction option")
+                        # Padding is excluded, eos falls back to the last non-padding token of truncated rows
+                        embs[i : i + current_batch_size, :] = reduce_hidden_states(
+                            out,
+                            reduction,
+                            attention_mask=batch[0] != self.get_pad_token_id(),
+                            input_ids=batch[0],
+                            eos_token_id=self.get_eos_token_id(),
+                        )
                         del out
                         i = i + current_batch_size
                         if log_interval != -1 and i % log_interval == 0:
@@ -681,7 +639,7 @@ class ESMFamily(IPretrainedProteinLanguageModel):
         pass
 
     def categorical_encode(self, data, max_length="default"):
-        encs = utils.categorical_encode(
+        encs = utils.cached_categorical_encode(
             data["aa_seq"].values,
             self.tokenizer,
             max(data["len"].values) if max_length == "default" else max_length,
@@ -693,32 +651,42 @@ class ESMFamily(IPretrainedProteinLanguageModel):
 
 class ESMCFamily(IPretrainedProteinLanguageModel):
 
-    def __init__(self, esm_version: str, logger: l.Logger, task: str = "regression"):
+    def __init__(
+        self,
+        esm_version: str,
+        logger: l.Logger,
+        task: str = "regression",
+        layers=None,
+    ):
         super().__init__(logger, task)
         self.version = esm_version
+        self.no_layers = ESMC_NUM_LAYERS[esm_version]
+        # Only the blocks up to the deepest layer used are built and read from the checkpoint
+        n_layers = self.layers_to_load(layers)
         if self.task == "masked_lm":
             raise ValueError("Masked LM not supported for ESM Cambrian")
         elif self.task == "token_classification":
             self.py_model = PlmfitEsmCForSequenceClassification.from_pretrained(
-                f"{esm_version}"
+                f"{esm_version}", n_layers=n_layers
             )
         elif self.task == "extract_embeddings":
             self.py_model = PlmfitEsmCForEmbdeddingsExtraction.from_pretrained(
-                f"{esm_version}"
+                f"{esm_version}", n_layers=n_layers
             )
         else:
             self.py_model = PlmfitEsmCForSequenceClassification.from_pretrained(
-                f"{esm_version}"
+                f"{esm_version}", n_layers=n_layers
             )
         self.no_parameters = utils.get_parameters(self.py_model)
-        self.no_layers = len(self.py_model.transformer.blocks)
+        self.no_loaded_layers = len(self.py_model.transformer.blocks)
         self.emb_layers_dim = self.py_model.embed.embedding_dim
         self.tokenizer = self.py_model.tokenizer
-        self.layer_to_use = self.no_layers - 1
+        self.layer_to_use = self.no_loaded_layers - 1
+        self.set_pooler_eos_token_id()
         self.experimenting = False
 
     def categorical_encode(self, data, max_length="default"):
-        encs = utils.categorical_encode(
+        encs = utils.cached_categorical_encode(
             data["aa_seq"].values,
             self.tokenizer,
             max(data["len"].values) if max_length == "default" else max_length,
@@ -731,40 +699,46 @@ class ESMCFamily(IPretrainedProteinLanguageModel):
 class ProteinBERTFamily(IPretrainedProteinLanguageModel):
     tokenizer: Tokenizer
 
-    def __init__(self, logger=None, task="regression"):
+    def __init__(self, logger=None, task="regression", layers=None):
         super().__init__(logger, task)
         self.name = "bert-base"
+        self.no_layers = ProteinBertConfig.from_pretrained(self.name).num_hidden_layers
+        # Only the blocks up to the deepest layer used are built and loaded
+        load_kwargs = {"num_hidden_layers": self.layers_to_load(layers)}
         if self.task == "masked_lm":
             self.py_model: ProteinBertForMaskedLM = (
-                ProteinBertForMaskedLM.from_pretrained("bert-base")
+                ProteinBertForMaskedLM.from_pretrained(self.name, **load_kwargs)
             )
             self.output_dim = self.py_model.mlm.vocab_size
         elif self.task == "token_classification":
             self.py_model: ProteinBertForTokenClassification = (
-                ProteinBertForTokenClassification.from_pretrained("bert-base")
+                ProteinBertForTokenClassification.from_pretrained(self.name, **load_kwargs)
             )
             self.output_dim = self.py_model.classifier.out_features
         elif self.task == "extract_embeddings":
             self.py_model = ProteinBertForEmbeddingsExtraction.from_pretrained(
-                "bert-base"
+                self.name, **load_kwargs
             )
         else:
             self.py_model: ProteinBertForSequenceClassification = (
-                ProteinBertForSequenceClassification.from_pretrained("bert-base")
+                ProteinBertForSequenceClassification.from_pretrained(
+                    self.name, **load_kwargs
+                )
             )
             self.output_dim = self.py_model.classifier.out_features
         self.no_parameters = utils.get_parameters(self.py_model)
-        self.no_layers = len(self.py_model.bert.encoder.layer)
+        self.no_loaded_layers = len(self.py_model.bert.encoder.layer)
         self.emb_layers_dim = self.py_model.bert.encoder.layer[
             0
         ].attention.output.dense.out_features
         self.tokenizer = utils.load_tokenizer(self.name)
-        self.layer_to_use = self.no_layers - 1
+        self.layer_to_use = self.no_loaded_layers - 1
+        self.set_pooler_eos_token_id()
         self.experimenting = False
         self.config = self.py_model.config
 
     def categorical_encode(self, data, max_length="default"):
-        encs = utils.categorical_encode(
+        encs = utils.cached_categorical_encode(
             data["aa_seq"].values,
             self.tokenizer,
             max(data["len"].values) if max_length == "default" else max_length,
@@ -775,10 +749,18 @@ class ProteinBERTFamily(IPretrainedProteinLanguageModel):
         )
         return encs
 
+    def get_pad_token_id(self):
+        return self.tokenizer.get_vocab()["<pad>"]
+
+    def get_eos_token_id(self):
+        return self.tokenizer.get_vocab()["<sep>"]
+
     def extract_embeddings(
         self, data_type, batch_size=1, layer=11, reduction="mean", log_interval=1000
     ):
         try:
+            if utils.convert_to_number(reduction) is not None:
+                reduction = int(reduction)
             self.set_layer_to_use(layer)
             layer = (
                 self.layer_to_use + 1
@@ -830,6 +812,8 @@ class ProteinBERTFamily(IPretrainedProteinLanguageModel):
             self.py_model = self.py_model.to(device)
             i = 0
             self.py_model.eval()
+            # This extraction reads the layer from the hidden states of every layer
+            self.py_model.bert.encoder.output_hidden_states = True
             start_extraction_time = time.time()
             with torch.no_grad():
                 with torch.cuda.amp.autocast(enabled=fp16, cache_enabled=False):
@@ -849,56 +833,14 @@ class ProteinBERTFamily(IPretrainedProteinLanguageModel):
 
                             # Now select the specific layer's output
                             out = hidden_states[layer]
-                        if reduction == "mean":
-                            embs[i : i + current_batch_size, :] = torch.mean(out, dim=1)
-                            if i == 0:
-                                self.logger.log(f"{(torch.mean(out, dim=1)).size()}")
-                        elif reduction == "sum":
-                            embs[i : i + current_batch_size, :] = torch.sum(out, dim=1)
-                        elif reduction == "bos":
-                            # Select the embeddings for the first token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[:, 0, :]
-                        elif reduction == "eos":
-                            # Initialize a tensor to store the selected embeddings
-                            selected_embs = torch.zeros(
-                                current_batch_size, out.shape[2], device=out.device
-                            )
-
-                            # Iterate over each sequence in the batch
-                            for seq_idx in range(current_batch_size):
-                                # Find the positions of the token with ID equal to 2 in the current sequence
-                                token_positions = (batch[0][seq_idx] == 2).nonzero(
-                                    as_tuple=True
-                                )[0]
-
-                                # Check if the token ID is present in the sequence
-                                if len(token_positions) > 0:
-                                    # Select the position of the last occurrence of the token
-                                    last_position = token_positions[-1].item()
-
-                                    # Select the embeddings for the last occurrence of the token
-                                    selected_embs[seq_idx, :] = out[
-                                        seq_idx, last_position, :
-                                    ]
-                                else:
-                                    # If the token ID is not found, you might want to handle this case.
-                                    # For example, use the embeddings of the last token of the sequence
-                                    # or set to zeros, depending on your application's requirements.
-                                    # Here, we use the embeddings of the last token as a fallback.
-                                    selected_embs[seq_idx, :] = out[seq_idx, -1, :]
-                                    self.logger.log(
-                                        f"EOS token not found for sequence {i}"
-                                    )
-
-                            # Update the embeddings tensor with the selected embeddings
-                            embs[i : i + current_batch_size, :] = selected_embs
-                        elif utils.convert_to_number(reduction) is not None:
-                            # Select the embeddings for the i token of each sequence in the batch
-                            embs[i : i + current_batch_size, :] = out[
-                                :, utils.convert_to_number(reduction), :
-                            ]
-                        else:
-                            raise ValueError("Unsupported reduction option")
+                        # Padding is excluded, eos falls back to the last non-padding token of truncated rows
+                        embs[i : i + current_batch_size, :] = reduce_hidden_states(
+                            out,
+                            reduction,
+                            attention_mask=batch[0] != self.get_pad_token_id(),
+                            input_ids=batch[0],
+                            eos_token_id=self.get_eos_token_id(),
+                        )
                         del out
                         i = i + current_batch_size
                         if log_interval != -1 and i % log_interval == 0:
@@ -0,0 +1,238 @@
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+from optuna.trial import TrialState
+from torch.func import functional_call, stack_module_state, vmap
+
+from plmfit.models.head_trainer import HeadTrainer
+
+
+def trial_batch_key(setup):
+    """
+    Trials can be trained together when their heads have the same structure
+    and they see the same batches with the same step rules.
+    """
+    model = setup["model"]
+    head = model.model
+    return (
+        type(head),
+        tuple((name, tuple(p.shape)) for name, p in head.named_parameters()),
+        tuple(m.p for m in head.modules() if isinstance(m, nn.Dropout)),
+        model.hparams.loss_f,
+        model.hparams.optimizer,
+        HeadTrainer.batch_size(setup["data_loaders"]["train"]),
+        model.gradient_accumulation_steps(),
+        model.gradient_clipping(),
+        setup["epochs"],
+        setup["epoch_sizing"],
+        setup["patience"],
+    )
+
+
+class BatchedHeadTrainer(HeadTrainer):
+    """
+    Trains the heads of several Optuna trials in lockstep, as one vmapped
+    model over the same resident features.
+
+    The heads' parameters are stacked along a leading trial dimension and a
+    single forward/backward computes every trial's loss on the same batch.
+    Adam and SGD steps are applied with each trial's own learning rate and
+    weight decay. Every epoch, each trial's validation loss is reported to
+    its own Optuna trial; pruned or early stopped trials stop being updated.
+    Training is done in full precision.
+    """
+
+    def fit_trials(self, models, trials, train_dataloaders, val_dataloaders):
+        """
+        Returns the last validation loss of each trial, None for the pruned ones.
+        All `models` must share the same trial_batch_key.
+        """
+        base = models[0]
+        if base.hparams.optimizer not in ("adam", "sgd"):
+            raise ValueError(
+                f"Batched trials support the adam and sgd optimizers, not {base.hparams.optimizer}"
+            )
+        self.mixed_precision = False
+        num_trials = len(models)
+        heads = [model.model.to(self.device) for model in models]
+        params, buffers = stack_module_state(heads)
+        learning_rates = torch.tensor(
+            [model.hparams.learning_rate for model in models], device=self.device
+        )
+        weight_decays = torch.tensor(
+            [model.hparams.get("weight_decay", 0) or 0 for model in models], device=self.device
+        )
+
+        def member_loss(member_params, member_buffers, input, labels):
+            outputs = functional_call(heads[0], (member_params, member_buffers), (input,))
+            if hasattr(outputs, "logits"):
+                outputs = outputs.logits
+            outputs = base.step_outputs(outputs)
+            labels = base.step_labels(labels)
+            return base.loss_function(outputs, base.loss_targets(labels))
+
+        losses_fn = vmap(member_loss, in_dims=(0, 0, None, None), randomness="different")
+
+        train_data = self.materialize(train_dataloaders)
+        val_data = self.materialize(val_dataloaders)
+        accumulation_steps = base.gradient_accumulation_steps()
+        gradient_clipping = base.gradient_clipping()
+        batch_size = self.batch_size(train_dataloaders)
+
+        state = {name: (torch.zeros_like(p), torch.zeros_like(p)) for name, p in params.items()}
+        step = 0
+        active = torch.ones(num_trials, dtype=torch.bool, device=self.device)
+        values = [None] * num_trials
+        best_val_loss = torch.full((num_trials,), float("inf"))
+        epochs_no_improve = torch.zeros(num_trials, dtype=torch.long)
+        for epoch in range(self.max_epochs):
+            for head in heads:
+                head.train()
+            indices = self.epoch_indices(train_dataloaders, len(train_data[0]))
+            batches = indices.split(batch_size)
+            batches = batches[: self.num_batches(self.limit_train_batches, len(batches))]
+            for batch_idx, batch_indices in enumerate(batches):
+                input, labels = train_data[0][batch_indices], train_data[1][batch_indices]
+                losses = losses_fn(params, buffers, input, labels)
+                (losses.sum() / accumulation_steps).backward()
+                if (batch_idx + 1) % accumulation_steps == 0 or batch_idx + 1 == len(batches):
+                    step += 1
+                    self.optimizer_step(
+                        base.hparams.optimizer, params, state, step, learning_rates,
+                        weight_decays, active, gradient_clipping,
+                    )
+
+            for head in heads:
+                head.eval()
+            val_losses = self.evaluate_trials(
+                losses_fn,
+                params,
+                buffers,
+                val_data,
+                self.epoch_indices(val_dataloaders, len(val_data[0])),
+                self.batch_size(val_dataloaders),
+            )
+
+            for i, trial in enumerate(trials):
+                if not active[i]:
+                    continue
+                val_loss = val_losses[i].item()
+                values[i] = val_loss
+                trial.report(val_loss, step=epoch)
+                if trial.should_prune():
+                    active[i] = False
+                    values[i] = None
+                    continue
+                if val_loss < best_val_loss[i]:
+                    best_val_loss[i] = val_loss
+                    epochs_no_improve[i] = 0
+                else:
+                    epochs_no_improve[i] += 1
+                    if self.patience != -1 and epochs_no_improve[i] >= self.patience:
+                        active[i] = False
+            if not active.any():
+                break
+        return values
+
+    @torch.no_grad()
+    def optimizer_step(
+        self, optimizer, params, state, step, learning_rates, weight_decays, active, gradient_clipping
+    ):
+        def per_trial(values, like):
+            return values.view(-1, *([1] * (like.dim() - 1)))
+
+        if gradient_clipping > 0:
+            # Clip the gradient norm of each trial separately
+            norms = torch.sqrt(
+                sum(p.grad.pow(2).flatten(1).sum(dim=1) for p in params.values())
+            )
+            clip_coefficients = (gradient_clipping / (norms + 1e-6)).clamp(max=1.0)
+            for p in params.values():
+                p.grad.mul_(per_trial(clip_coefficients, p))
+
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+        for name, p in params.items():
+            # L2 penalty added to the gradients, as torch.optim.Adam and SGD do
+            grad = p.grad + per_trial(weight_decays, p) * p
+            if optimizer == "adam":
+                exp_avg, exp_avg_sq = state[name]
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                update = (exp_avg / (1 - beta1**step)) / (
+                    (exp_avg_sq / (1 - beta2**step)).sqrt() + eps
+                )
+            else:
+                update = grad
+            p.sub_(per_trial(learning_rates * active, p) * update)
+            p.grad = None
+
+    @torch.no_grad()
+    def evaluate_trials(self, losses_fn, params, buffers, data, indices, batch_size):
+        batches = indices.split(batch_size)
+        batches = batches[: self.num_batches(self.limit_val_batches, len(batches))]
+        total_losses = torch.zeros(len(next(iter(params.values()))), device=self.device)
+        total_samples = 0
+        for batch_indices in batches:
+            losses = losses_fn(params, buffers, data[0][batch_indices], data[1][batch_indices])
+            total_losses += losses * len(batch_indices)
+            total_samples += len(batch_indices)
+        return (total_losses / max(total_samples, 1)).cpu()
+
+
+def optimize_in_batches(
+    study, build_trial, n_trials, trials_per_batch, callbacks=(), catch=()
+):
+    """
+    Runs `n_trials` Optuna trials, `trials_per_batch` at a time. `build_trial`
+    takes a trial, suggests its parameters and returns its setup, a dict with
+    the LightningModel ("model"), its "data_loaders", "epochs", "epoch_sizing"
+    and "patience". The trials asked together are grouped by trial_batch_key
+    and each group is trained by a BatchedHeadTrainer.
+    """
+    completed = 0
+    while completed < n_trials:
+        trials = [study.ask() for _ in range(min(trials_per_batch, n_trials - completed))]
+        completed += len(trials)
+
+        groups = defaultdict(list)
+        for trial in trials:
+            try:
+                setup = build_trial(trial)
+            except catch:
+                tell(study, trial, None, TrialState.FAIL, callbacks)
+                continue
+            groups[trial_batch_key(setup)].append((trial, setup))
+
+        for members in groups.values():
+            setup = members[0][1]
+            trainer = BatchedHeadTrainer(
+                max_epochs=setup["epochs"],
+                limit_train_batches=setup["epoch_sizing"],
+                limit_val_batches=setup["epoch_sizing"],
+                patience=setup["patience"],
+            )
+            try:
+                values = trainer.fit_trials(
+                    [member_setup["model"] for _, member_setup in members],
+                    [trial for trial, _ in members],
+                    setup["data_loaders"]["train"],
+                    setup["data_loaders"]["val"],
+                )
+            except catch:
+                values = [TrialState.FAIL] * len(members)
+            for (trial, _), value in zip(members, values):
+                if value is TrialState.FAIL:
+                    tell(study, trial, None, TrialState.FAIL, callbacks)
+                elif value is None:
+                    tell(study, trial, None, TrialState.PRUNED, callbacks)
+                else:
+                    tell(study, trial, value, TrialState.COMPLETE, callbacks)
+
+
+def tell(study, trial, value, state, callbacks):
+    frozen_trial = study.tell(trial, value, state=state)
+    # Called for every finished trial, as Study.optimize does
+    for callback in callbacks:
+        callback(study, frozen_trial)
+    return frozen_trial
@@ -0,0 +1,234 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# ProGen2 reads a protein between the terminal tokens '1' and '2' and its
+# residues 'A' to 'Z' are the token ids 5 to 29
+PROGEN_RESIDUES = slice(5, 30)
+PROGEN_PAD_TOKEN_ID = 0
+
+
+def encode_progen(tokenizer, sequences, reverse=False):
+    """
+    Encodes `sequences` between their terminal tokens, N to C terminus or
+    C to N terminus if `reverse`, right padded into one tensor. A causal
+    model never attends to the padding that follows a sequence, so no
+    attention mask is needed.
+    """
+    if reverse:
+        texts = [f"2{sequence[::-1]}1" for sequence in sequences]
+    else:
+        texts = [f"1{sequence}2" for sequence in sequences]
+    encodings = tokenizer.encode_batch(texts, add_special_tokens=False)
+    input_ids = torch.full(
+        (len(encodings), max(len(encoding.ids) for encoding in encodings)),
+        PROGEN_PAD_TOKEN_ID,
+        dtype=torch.long,
+    )
+    for i, encoding in enumerate(encodings):
+        input_ids[i, : len(encoding.ids)] = torch.tensor(encoding.ids)
+    return input_ids
+
+
+def residue_log_likelihoods(logits, targets):
+    """
+    Log-probability of each target under the logits predicting it, normalized
+    over the residue tokens. Targets that are not residues (terminals and
+    padding) are masked out and get 0.
+
+    Returns:
+        tuple: The log-likelihoods and the mask of the residue targets.
+    """
+    log_probs = F.log_softmax(logits[..., PROGEN_RESIDUES].float(), dim=-1)
+    residues = (targets >= PROGEN_RESIDUES.start) & (targets < PROGEN_RESIDUES.stop)
+    index = (targets - PROGEN_RESIDUES.start).clamp(0, log_probs.size(-1) - 1)
+    log_likelihoods = log_probs.gather(-1, index.unsqueeze(-1)).squeeze(-1)
+    return log_likelihoods * residues, residues
+
+
+@torch.no_grad()
+def sequence_log_likelihoods(model, input_ids):
+    """
+    Summed residue log-likelihoods of a right padded batch of sequences, in a
+    single forward pass of a causal language model.
+
+    Returns:
+        tuple: The log-likelihood and the number of residues of each sequence.
+    """
+    logits = model(input_ids, use_cache=False).logits
+    log_likelihoods, residues = residue_log_likelihoods(logits[:, :-1], input_ids[:, 1:])
+    return log_likelihoods.sum(dim=-1), residues.sum(dim=-1)
+
+
+def shared_prefix_lengths(sequences, reference):
+    """
+    Number of leading residues each sequence shares with `reference`.
+    """
+    reference = np.frombuffer(reference.encode(), dtype=np.uint8)
+    lengths = np.empty(len(sequences), dtype=np.int64)
+    for i, sequence in enumerate(sequences):
+        sequence = np.frombuffer(sequence.encode(), dtype=np.uint8)
+        n = min(len(sequence), len(reference))
+        mismatches = np.flatnonzero(sequence[:n] != reference[:n])
+        lengths[i] = mismatches[0] if len(mismatches) else n
+    return lengths
+
+
+class WildTypePrefixScorer:
+    """
+    Scores variants of a wild type with a causal language model, reusing the
+    key/value cache of the wild type for the residues a variant shares with
+    it. The log-likelihood of the shared prefix is read from the wild type's
+    and only the tokens from the first mutation on are run through the model.
+
+    Args:
+        model: The causal language model, e.g. ProGenForCausalLM.
+        wild_type_ids (torch.Tensor): The encoded wild type, as given by encode_progen.
+    """
+
+    @torch.no_grad()
+    def __init__(self, model, wild_type_ids):
+        self.model = model
+        output = model(wild_type_ids[None], use_cache=True)
+        self.past_key_values = output.past_key_values
+        log_likelihoods, _ = residue_log_likelihoods(output.logits[0, :-1], wild_type_ids[1:])
+        # Log-likelihood of the first k residues of the wild type at index k
+        self.prefix_log_likelihoods = F.pad(log_likelihoods.cumsum(dim=0), (1, 0))
+        self.log_likelihood = self.prefix_log_likelihoods[-1].item()
+
+    @torch.no_grad()
+    def __call__(self, input_ids, prefix_length):
+        """
+        Scores a right padded batch of encoded variants whose first
+        `prefix_length` residues are those of the wild type.
+
+        Returns:
+            tuple: The log-likelihood and the number of residues of each variant.
+        """
+        # The cache holds the N terminal token and the shared residues but the
+        # last one, which is fed again to predict the first mutated residue
+        batch_size = input_ids.size(0)
+        past_key_values = tuple(
+            tuple(
+                state[:, :, :prefix_length].expand(batch_size, -1, -1, -1)
+                for state in layer_past
+            )
+            for layer_past in self.past_key_values
+        )
+        logits = self.model(
+            input_ids[:, prefix_length:], past_key_values=past_key_values, use_cache=False
+        ).logits
+        log_likelihoods, residues = residue_log_likelihoods(
+            logits[:, :-1], input_ids[:, prefix_length + 1 :]
+        )
+        return (
+            self.prefix_log_likelihoods[prefix_length] + log_likelihoods.sum(dim=-1),
+            prefix_length + residues.sum(dim=-1),
+        )
+
+
+# Columns of the masked-marginal tables, the 20 canonical amino acids
+MASKED_MARGINAL_RESIDUES = "ACDEFGHIKLMNPQRSTVWY"
+# Variants compared to the wild type at once, to keep their byte matrix small
+VARIANTS_PER_SLICE = 65536
+
+
+def residue_columns(sequences):
+    """
+    Encodes equal length `sequences` as an array of their residues' columns
+    in MASKED_MARGINAL_RESIDUES, -1 for any other residue.
+    """
+    columns = np.full(256, -1, dtype=np.int64)
+    columns[np.frombuffer(MASKED_MARGINAL_RESIDUES.encode(), dtype=np.uint8)] = np.arange(
+        len(MASKED_MARGINAL_RESIDUES)
+    )
+    residues = np.frombuffer("".join(sequences).encode(), dtype=np.uint8)
+    return columns[residues].reshape(len(sequences), -1)
+
+
+def mutated_positions(sequences, wild_type):
+    """
+    Positions at which any of the substitution variants among `sequences`
+    differs from `wild_type`. Variants of another length are ignored.
+    """
+    variants = [sequence for sequence in sequences if len(sequence) == len(wild_type)]
+    if not variants:
+        return np.zeros(0, dtype=np.int64)
+    mutated = np.zeros(len(wild_type), dtype=bool)
+    wild_type = np.frombuffer(wild_type.encode(), dtype=np.uint8)
+    for start in range(0, len(variants), VARIANTS_PER_SLICE):
+        residues = np.frombuffer(
+            "".join(variants[start : start + VARIANTS_PER_SLICE]).encode(), dtype=np.uint8
+        ).reshape(-1, len(wild_type))
+        mutated |= (residues != wild_type).any(axis=0)
+    return np.flatnonzero(mutated)
+
+
+@torch.no_grad()
+def masked_marginal_log_odds(model, tokenizer, wild_type, positions, batch_size):
+    """
+    Masked-marginal log-odds of the wild type, with one forward pass per
+    position in which only that position is masked. Forwards are run in
+    batches of `batch_size` positions.
+
+    Args:
+        model: The masked language model, e.g. PlmfitEsmForMaskedLM.
+        tokenizer: The model's tokenizer, prepending one special token to the sequence.
+        wild_type (str): The wild type sequence.
+        positions (numpy.ndarray): The 0-based positions to compute.
+        batch_size (int): Number of masked positions per forward pass.
+
+    Returns:
+        numpy.ndarray: The log-probability of each residue of MASKED_MARGINAL_RESIDUES
+        minus that of the wild type residue, one row per position. Rows of
+        non canonical wild type residues are NaN.
+    """
+    device = next(model.parameters()).device
+    wild_type_ids = torch.tensor(tokenizer.encode(wild_type), device=device)
+    residue_ids = torch.tensor(
+        tokenizer.convert_tokens_to_ids(list(MASKED_MARGINAL_RESIDUES)), device=device
+    )
+    wild_type_columns = residue_columns([wild_type])[0]
+    log_odds = np.empty((len(positions), len(MASKED_MARGINAL_RESIDUES)), dtype=np.float32)
+    for start in range(0, len(positions), batch_size):
+        batch_positions = positions[start : start + batch_size]
+        # Residue i is token i + 1, after the <cls> token
+        tokens = torch.as_tensor(batch_positions, device=device) + 1
+        rows = torch.arange(len(batch_positions), device=device)
+        input_ids = wild_type_ids.repeat(len(batch_positions), 1)
+        input_ids[rows, tokens] = tokenizer.mask_token_id
+        logits = model(input_ids).logits[rows, tokens]
+        log_probs = F.log_softmax(logits[:, residue_ids].float(), dim=-1).cpu().numpy()
+        columns = wild_type_columns[batch_positions]
+        wild_type_log_probs = np.where(
+            columns >= 0, log_probs[np.arange(len(columns)), columns], np.nan
+        )
+        log_odds[start : start + len(batch_positions)] = (
+            log_probs - wild_type_log_probs[:, None]
+        )
+    return log_odds
+
+
+def masked_marginal_scores(log_odds, sequences, wild_type):
+    """
+    Scores substitution variants of the wild type by looking up the log-odds
+    of their mutations in the L x 20 `log_odds` table and summing them.
+    Variants of another length than the wild type, or with a non canonical
+    mutation, get NaN.
+    """
+    scores = np.full(len(sequences), np.nan)
+    lengths = np.array([len(sequence) for sequence in sequences])
+    variants = np.flatnonzero(lengths == len(wild_type))
+    if not len(variants):
+        return scores
+    wild_type_residues = residue_columns([wild_type])[0]
+    # Appended NaN column, looked up by non canonical residues (-1)
+    table = np.concatenate([log_odds, np.full((len(log_odds), 1), np.nan)], axis=1)
+    positions = np.arange(len(wild_type))
+    for start in range(0, len(variants), VARIANTS_PER_SLICE):
+        rows = variants[start : start + VARIANTS_PER_SLICE]
+        residues = residue_columns([sequences[row] for row in rows])
+        mutated = residues != wild_type_residues
+        # Unmutated positions look up the wild type, whose log-odds are 0
+        scores[rows] = np.where(mutated, table[positions, residues], 0).sum(axis=1)
+    return scores
@@ -310,8 +310,9 @@ def plot_actual_vs_predicted(y_test_list=None, y_pred_list=None, axis_range=[0,
     if json_path:
         with open(json_path, 'r') as file:
             json_data = json.load(file)
-            y_test_list = json_data['pred_data']['actual']
-            y_pred_list = json_data['pred_data']['preds']
+            pred_data = utils.load_pred_data(json_path, json_data)
+            y_test_list = pred_data['actual']
+            y_pred_list = pred_data['preds']
             eval_metrics = json_data['main']
     fig, ax = plt.subplots(figsize=(8, 8))
     y_test_list = np.asarray(y_test_list, dtype=np.float32).flatten()
@@ -0,0 +1,178 @@
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+MAGIC = b"PLMFEMB1"
+HEADER_ALIGNMENT = 64
+
+
+class EmbeddingStore:
+    """
+    Memory-mapped embedding matrix stored in a single file.
+
+    The file starts with a magic string and a JSON header holding the shape,
+    the dtype and free-form metadata (model, layer, reduction, ...), followed
+    by the raw row-major data, so rows are read lazily and in their stored dtype.
+
+    :param path: path of the store file.
+    :param mode: memmap mode, "r" to read or "r+" to write into an existing store.
+    """
+
+    def __init__(self, path: str, mode: str = "r") -> None:
+        self.path = path
+        self.mode = mode
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not an embedding store")
+            (header_length,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length).decode("utf-8"))
+        self.shape = tuple(header.pop("shape"))
+        self.dtype = np.dtype(header.pop("dtype"))
+        self.metadata = header
+        self.offset = len(MAGIC) + 8 + header_length
+        self.array = np.memmap(
+            path, dtype=self.dtype, mode=mode, offset=self.offset, shape=self.shape
+        )
+
+    @classmethod
+    def create(cls, path, shape, dtype, **metadata):
+        """Allocates a store of the given shape and returns it opened for writing."""
+        dtype = np.dtype(dtype)
+        header = json.dumps(
+            {"shape": list(shape), "dtype": dtype.str, **metadata}
+        ).encode("utf-8")
+        # Pad the header so that the data starts aligned
+        header += b" " * (-(len(MAGIC) + 8 + len(header)) % HEADER_ALIGNMENT)
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.truncate(f.tell() + int(np.prod(shape)) * dtype.itemsize)
+        return cls(path, mode="r+")
+
+    @classmethod
+    def write(cls, path, embeddings, chunk_size=100000, **metadata):
+        """Writes an array or tensor to a new store, in chunks of rows."""
+        if torch.is_tensor(embeddings):
+            embeddings = embeddings.detach().cpu()
+            # Keep the dtype unless numpy cannot represent it
+            if embeddings.dtype == torch.bfloat16:
+                embeddings = embeddings.float()
+            embeddings = embeddings.numpy()
+        store = cls.create(path, embeddings.shape, embeddings.dtype, **metadata)
+        for start in range(0, len(embeddings), chunk_size):
+            store.array[start : start + chunk_size] = embeddings[start : start + chunk_size]
+        store.flush()
+        return cls(path)
+
+    @staticmethod
+    def is_store(path):
+        if not os.path.isfile(path):
+            return False
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+
+    def flush(self):
+        self.array.flush()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    # Memmaps are pickled by copying their data, reopen the file instead so
+    # that DataLoader workers share the page cache
+    def __getstate__(self):
+        return {"path": self.path, "mode": self.mode}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], mode=state["mode"])
+
+
+class ShardedEmbeddings:
+    """
+    Lazy view of the shards of a sharded embeddings directory, indexed by
+    sample. Each shard stays memory-mapped and rows are read from the shards
+    holding them only when indexed, so the embeddings are never assembled in
+    memory.
+
+    :param shard_dir: directory written by ShardedPredictionWriter.
+    :param shards: its manifest entries, each with the shard file, its indices file and row count.
+    :param num_samples: number of samples of the extraction, after the largest written index if None.
+    :raises ValueError: if some of the samples are in no shard, as left by an unfinished extraction.
+    """
+
+    def __init__(self, shard_dir: str, shards: list, num_samples: int = None) -> None:
+        self.shard_dir = shard_dir
+        self.shards = shards
+        self.arrays = [
+            np.load(os.path.join(shard_dir, shard["file"]), mmap_mode="r") for shard in shards
+        ]
+        indices = [np.load(os.path.join(shard_dir, shard["indices"])) for shard in shards]
+        written = max((int(idx.max()) + 1 for idx in indices if len(idx) > 0), default=0)
+        if num_samples is None:
+            num_samples = written
+        elif written > num_samples:
+            raise ValueError(
+                f"Shards in {shard_dir} hold sample {written - 1} of only {num_samples} samples"
+            )
+        # Shard holding each sample (-1 if none) and its row in that shard
+        self.shard_of_sample = np.full(num_samples, -1, dtype=np.int32)
+        self.row_of_sample = np.zeros(num_samples, dtype=np.int64)
+        for i, idx in enumerate(indices):
+            self.shard_of_sample[idx] = i
+            self.row_of_sample[idx] = np.arange(len(idx))
+        missing = np.flatnonzero(self.shard_of_sample < 0)
+        if len(missing) or not shards:
+            raise ValueError(
+                f"Shards in {shard_dir} are incomplete, {len(missing)} of {num_samples} samples "
+                f"are missing (first: {missing[:5].tolist()}), resume the extraction to finish them"
+            )
+        self.shape = (num_samples,) + self.arrays[0].shape[1:]
+        self.dtype = self.arrays[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def sample_indices(self, index):
+        """Sample indices selected by an int, a slice or an index array, without a full arange."""
+        if isinstance(index, slice):
+            return np.arange(*index.indices(len(self)))
+        samples = np.asarray(index)
+        if samples.dtype == bool:
+            return np.flatnonzero(samples)
+        samples = samples.astype(np.int64, copy=False)
+        if ((samples < -len(self)) | (samples >= len(self))).any():
+            raise IndexError(f"Index out of bounds for {len(self)} samples")
+        return np.where(samples < 0, samples + len(self), samples)
+
+    def __getitem__(self, index):
+        samples = self.sample_indices(index)
+        if samples.ndim == 0:
+            return self[samples[None]][0]
+        output = np.empty((len(samples),) + self.shape[1:], dtype=self.dtype)
+        shard_of_sample = self.shard_of_sample[samples]
+        for i in np.unique(shard_of_sample):
+            mask = shard_of_sample == i
+            output[mask] = self.arrays[i][self.row_of_sample[samples[mask]]]
+        return output
+
+    def to_tensor(self, device="cpu", chunk_size=100000):
+        """Reads all the embeddings into a single tensor, in chunks of samples."""
+        output = torch.from_numpy(np.empty(self.shape, dtype=self.dtype))
+        for start in range(0, len(self), chunk_size):
+            output[start : start + chunk_size] = torch.from_numpy(
+                self[start : start + chunk_size]
+            )
+        return output.to(device)
+
+    # Memmaps are pickled by copying their data, reopen the shards instead
+    def __getstate__(self):
+        return {"shard_dir": self.shard_dir, "shards": self.shards, "num_samples": len(self)}
+
+    def __setstate__(self, state):
+        self.__init__(state["shard_dir"], state["shards"], state["num_samples"])
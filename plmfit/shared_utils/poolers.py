@@ -1,25 +1,147 @@
+from contextlib import contextmanager
+from functools import partial
+
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 
+def masked_mean(hidden_states, attention_mask=None):
+    """Mean over the sequence dimension, excluding positions masked out by attention_mask."""
+    if attention_mask is None:
+        return torch.mean(hidden_states, dim=1)
+    mask = attention_mask.to(hidden_states.dtype).unsqueeze(-1)
+    return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
+def reduce_hidden_states(
+    hidden_states, reduction, attention_mask=None, input_ids=None, eos_token_id=None
+):
+    """
+    Pools (batch, length, hidden) states over the sequence dimension with batched
+    mask and gather operations, so no per-sequence device syncs are needed.
+    Padding positions are excluded whenever an attention_mask is given. The
+    "eos" reduction takes the eos token of each sequence when input_ids and
+    eos_token_id are given, and the last non-padding token of rows without one.
+    """
+    if reduction == "mean":
+        return masked_mean(hidden_states, attention_mask)
+    elif reduction == "sum":
+        if attention_mask is not None:
+            hidden_states = hidden_states * attention_mask.to(hidden_states.dtype).unsqueeze(-1)
+        return hidden_states.sum(dim=1)
+    elif reduction == "max":
+        if attention_mask is not None:
+            hidden_states = hidden_states.masked_fill(
+                ~attention_mask.bool().unsqueeze(-1), torch.finfo(hidden_states.dtype).min
+            )
+        return hidden_states.amax(dim=1)
+    elif reduction == "bos":
+        return hidden_states[:, 0]
+    elif reduction == "eos":
+        # Last non-padding token of each sequence
+        length = hidden_states.shape[1]
+        if attention_mask is None:
+            last_tokens = torch.full(
+                (hidden_states.shape[0],), length - 1, device=hidden_states.device
+            )
+        else:
+            last_tokens = attention_mask.long().sum(dim=1).clamp(min=1) - 1
+        if input_ids is not None and eos_token_id is not None:
+            # Sequences truncated before their eos token keep the last token
+            positions = torch.arange(length, device=input_ids.device)
+            eos_positions = torch.where(input_ids == eos_token_id, positions, -1).amax(dim=1)
+            last_tokens = torch.where(eos_positions >= 0, eos_positions, last_tokens)
+        index = last_tokens.view(-1, 1, 1).expand(-1, 1, hidden_states.shape[-1])
+        return hidden_states.gather(1, index).squeeze(1)
+    elif reduction == "norm_weighted_mean":
+        # Tokens are weighted by the softmax of their L2 norms, not by attention
+        scores = torch.norm(hidden_states.float(), p=2, dim=-1)
+        if attention_mask is not None:
+            scores = scores.masked_fill(~attention_mask.bool(), float("-inf"))
+        weights = F.softmax(scores, dim=1).to(hidden_states.dtype)
+        return torch.sum(hidden_states * weights.unsqueeze(-1), dim=1)
+    elif isinstance(reduction, int):
+        # Positional reduction, the hidden state of a fixed token position
+        return hidden_states[:, reduction]
+    elif reduction == "none":
+        return hidden_states
+    raise ValueError(f"Unsupported reduction option: {reduction}")
+
+
 class GeneralPooler(nn.Module):
-    def __init__(self, config=None):
+    def __init__(self, config=None, eos_token_id=None):
         super().__init__()
         if config is not None:
             self.dense = nn.Linear(config.hidden_size, config.hidden_size)
             self.activation = nn.Tanh()
+        # Set by the model wrappers from their tokenizer, used by the "eos" reduction
+        self.eos_token_id = eos_token_id
 
-    def forward(self, hidden_states, pooling_method="default"):
+    def forward(
+        self, hidden_states, pooling_method="default", attention_mask=None, input_ids=None
+    ):
         # We "pool" the model by simply taking the hidden state corresponding
         # to the first token.
         if pooling_method == "default":
             first_token_tensor = hidden_states[:, 0]
             pooled_output = self.dense(first_token_tensor)
             pooled_output = self.activation(pooled_output)
-        elif pooling_method == "bos":
-            pooled_output = hidden_states[:, 0]
-        elif pooling_method == "mean":
-            pooled_output = torch.mean(hidden_states, dim=1)
-        elif pooling_method == "none":
-            pooled_output = hidden_states
-        return pooled_output
+            return pooled_output
+        return reduce_hidden_states(
+            hidden_states,
+            pooling_method,
+            attention_mask,
+            input_ids=input_ids,
+            eos_token_id=self.eos_token_id,
+        )
+
+
+def pool_layers(pooler, layer_states, reductions, attention_mask=None, input_ids=None):
+    """
+    Pools the hidden states of several layers with several reductions.
+
+    Returns a (batch, len(layer_states) * len(reductions), hidden) tensor,
+    ordered layer-major.
+    """
+    if "none" in reductions:
+        raise ValueError("Reduction 'none' cannot be combined with other outputs")
+    return torch.stack(
+        [
+            pooler(
+                hidden_states,
+                pooling_method=reduction,
+                attention_mask=attention_mask,
+                input_ids=input_ids,
+            )
+            for hidden_states in layer_states
+            for reduction in reductions
+        ],
+        dim=1,
+    )
+
+
+def _keep_layer_output(outputs, layer, module, args, output):
+    # Transformer blocks return a tuple led by their hidden states
+    outputs[layer] = output[0] if isinstance(output, (tuple, list)) else output
+
+
+@contextmanager
+def capture_layers(blocks, layers):
+    """
+    Keeps the output of the `layers` among the transformer `blocks` during a
+    forward pass, so that the model does not need to return the hidden states
+    of every layer.
+
+    Yields a dict of the captured outputs by layer index, filled by the pass.
+    """
+    outputs = {}
+    handles = [
+        blocks[layer].register_forward_hook(partial(_keep_layer_output, outputs, layer))
+        for layer in set(layers)
+    ]
+    try:
+        yield outputs
+    finally:
+        for handle in handles:
+            handle.remove()
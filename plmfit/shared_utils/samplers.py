@@ -1,20 +1,49 @@
 from typing import Sequence
 from torch import cat, multinomial, as_tensor, double as torch_double
-from torch.utils.data.sampler import Sampler
+from torch.utils.data.sampler import BatchSampler, Sampler
 import torch
 
+class LabelIndexTable:
+    """
+    Indices of a dataset grouped by label, computed once so that samplers built
+    over the same labels (every epoch, every Optuna trial) can reuse them.
+
+    :param labels: list(len=dataset_len)[int], labels of a dataset, from 0 to num_classes - 1.
+    :param num_classes: number of classes, inferred from the labels if None.
+    """
+
+    def __init__(self, labels: Sequence[int], num_classes: int = None) -> None:
+        labels = torch.as_tensor(labels, dtype=torch.long)
+        num_classes = int(labels.max()) + 1 if num_classes is None else num_classes
+        # Dataset indices sorted by label, the ones of class i are
+        # order[offsets[i]:offsets[i] + counts[i]]
+        self.order = torch.argsort(labels, stable=True)
+        self.counts = torch.bincount(labels, minlength=num_classes)
+        self.offsets = torch.cumsum(self.counts, dim=0) - self.counts
+
+    @classmethod
+    def from_values(cls, values):
+        """Builds the table over the unique values (e.g. sample weights), returned with it in order."""
+        unique_values, labels = torch.unique(torch.as_tensor(values), return_inverse=True)
+        return cls(labels, num_classes=len(unique_values)), unique_values
+
+    def __len__(self):
+        return len(self.counts)
+
+
 class LabelWeightedSampler(Sampler[int]):
 
     label_weights: Sequence[float]
-    klass_indices: Sequence[Sequence[int]]
     num_samples: int
 
-    def __init__(self, label_weights: Sequence[float], labels: Sequence[int], num_samples: int, replacement: bool = True, generator=None) -> None:
+    def __init__(self, label_weights: Sequence[float], labels: Sequence[int] = None, num_samples: int = None,
+                 replacement: bool = True, generator=None, table: LabelIndexTable = None) -> None:
         """
 
         :param label_weights: list(len=num_classes)[float], weights for each class.
         :param labels: list(len=dataset_len)[int], labels of a dataset.
         :param num_samples: number of samples.
+        :param table: precomputed LabelIndexTable of the labels, used instead of `labels`.
         """
         if not isinstance(num_samples, int) or isinstance(num_samples, bool) or \
                 num_samples <= 0:
@@ -22,30 +51,107 @@ class LabelWeightedSampler(Sampler[int]):
         if not isinstance(replacement, bool):
             raise ValueError(f"replacement should be a boolean value, but got replacement={replacement}")
 
-        super(LabelWeightedSampler, self).__init__(None)
+        super(LabelWeightedSampler, self).__init__()
 
         self.label_weights = torch.as_tensor(label_weights, dtype=torch.float32)
-        self.labels        = torch.as_tensor(labels, dtype=torch.int)
         self.num_samples   = num_samples
         self.n_klass       = len(label_weights)
-        # list of tensor.
-        self.klass_indices = [(self.labels == i_klass).nonzero(as_tuple=True)[0]
-                              for i_klass in range(self.n_klass)]
+        self.table = table if table is not None else LabelIndexTable(labels, num_classes=self.n_klass)
         self.replacement = replacement
         self.generator = generator
 
-    def __iter__(self):
+    def draw(self):
+        """Draws the indices of one epoch as a tensor."""
         sample_labels = torch.multinomial(self.label_weights,
                                           num_samples=self.num_samples,
                                           replacement=self.replacement,
                                           generator=self.generator)
-        sample_indices = torch.empty_like(sample_labels)
-        for i_klass in range(self.n_klass):
-            left_inds  = (sample_labels == i_klass).nonzero(as_tuple=True)[0]
-            right_inds = torch.randint(len(self.klass_indices[i_klass]), size=(len(left_inds), ))
-            sample_indices[left_inds] = self.klass_indices[i_klass][right_inds]
+        # Uniform position within the drawn class, for all the samples at once
+        positions = (
+            torch.rand(self.num_samples, generator=self.generator) * self.table.counts[sample_labels]
+        ).long()
+        return self.table.order[self.table.offsets[sample_labels] + positions]
+
+    def __iter__(self):
+        return iter(self.draw().tolist())
+
+    def __len__(self):
+        return self.num_samples
+
 
-        return iter(sample_indices.tolist())
+class LabelWeightedBatchSampler(BatchSampler):
+    """
+    Batch sampler yielding ready-made index tensors from a LabelWeightedSampler,
+    so that no per-index Python work is done in the DataLoader loop.
+
+    Any other sampler (e.g. one wrapped by Lightning for distributed training)
+    is batched as by a BatchSampler.
+    """
+
+    def __init__(self, sampler, batch_size: int, drop_last: bool = False) -> None:
+        super(LabelWeightedBatchSampler, self).__init__(sampler, batch_size, drop_last)
+
+    def __iter__(self):
+        if not isinstance(self.sampler, LabelWeightedSampler):
+            yield from super(LabelWeightedBatchSampler, self).__iter__()
+            return
+        batches = self.sampler.draw().split(self.batch_size)
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        yield from batches
+
+
+class LengthBucketSampler(Sampler[int]):
+    """
+    Sampler that orders indices so that consecutive batches hold sequences of
+    similar length.
+
+    Indices drawn from `sampler` (sequential, random or label weighted) are
+    taken in pools of `batch_size * bucket_size_multiplier` and sorted by
+    length within each pool, so that padded batches can be trimmed to their
+    longest sequence with little waste. With shuffle=True the order of the
+    batches is shuffled as well. Use it with a DataLoader of the same
+    batch_size.
+
+    :param lengths: list(len=dataset_len)[int], sequence lengths of the dataset.
+    :param batch_size: size of the batches.
+    :param sampler: sampler yielding dataset indices, sequential if None.
+    :param bucket_size_multiplier: number of batches sorted together.
+    :param shuffle: shuffle the order of the batches.
+    :param generator: generator used to shuffle the batches.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int, sampler=None,
+                 bucket_size_multiplier: int = 100, shuffle: bool = False, generator=None) -> None:
+        super(LengthBucketSampler, self).__init__()
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __iter__(self):
+        if self.sampler is None:
+            indices = torch.arange(len(self.lengths))
+        elif isinstance(self.sampler, LabelWeightedSampler):
+            indices = self.sampler.draw()
+        else:
+            indices = torch.as_tensor(list(self.sampler), dtype=torch.long)
+        pool_size = self.batch_size * self.bucket_size_multiplier
+        batches = []
+        for pool in indices.split(pool_size):
+            order = torch.argsort(self.lengths[pool], stable=True)
+            batches.extend(pool[order].split(self.batch_size))
+        if self.shuffle:
+            # Only the last batch can be incomplete, keep it last so that
+            # batch boundaries stay aligned with the DataLoader's
+            full_batches = len(batches) - int(len(batches[-1]) < self.batch_size) if batches else 0
+            permutation = torch.randperm(full_batches, generator=self.generator).tolist()
+            batches = [batches[i] for i in permutation] + batches[full_batches:]
+        if len(batches) == 0:
+            return iter([])
+        return iter(torch.cat(batches).tolist())
 
     def __len__(self):
-        return self.num_samples
\ No newline at end of file
+        return len(self.sampler) if self.sampler is not None else len(self.lengths)
@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+
+import torch
+
+from plmfit.models.trial_batching import optimize_in_batches
+
+
+def worker_resources(n_processes, devices=None):
+    """
+    Splits the machine between `n_processes` workers: one CUDA device each,
+    round-robin over `devices` (all visible devices by default), when CUDA is
+    available, and an equal share of the CPUs otherwise.
+
+    Returns:
+        list: The CUDA device index (or None) and the CPU ids of each worker.
+    """
+    if devices is None and torch.cuda.is_available():
+        devices = list(range(torch.cuda.device_count()))
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    cpus_per_worker = max(1, len(cpus) // n_processes)
+    resources = []
+    for rank in range(n_processes):
+        device = devices[rank % len(devices)] if devices else None
+        worker_cpus = cpus[rank * cpus_per_worker : (rank + 1) * cpus_per_worker]
+        resources.append((device, worker_cpus or cpus))
+    return resources
+
+
+def _run_worker(study, objective, n_trials, device, cpus, trials_per_batch, callbacks, catch):
+    # Pin the worker before CUDA or the intra-op thread pool are initialized
+    if device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+    # Workers start from copies of the same sampler, draw different suggestions
+    study.sampler.reseed_rng()
+    if trials_per_batch > 1:
+        optimize_in_batches(
+            study,
+            lambda trial: objective(trial, build_only=True),
+            n_trials=n_trials,
+            trials_per_batch=trials_per_batch,
+            callbacks=callbacks,
+            catch=catch,
+        )
+    else:
+        study.optimize(
+            objective,
+            n_trials=n_trials,
+            callbacks=callbacks,
+            gc_after_trial=True,
+            catch=catch,
+        )
+
+
+def optimize_in_processes(
+    study,
+    objective,
+    n_trials,
+    n_processes,
+    devices=None,
+    trials_per_batch=1,
+    callbacks=(),
+    catch=(),
+):
+    """
+    Runs `n_trials` trials of `study` in `n_processes` spawned worker
+    processes, each pinned to its own CUDA device or share of the CPUs.
+
+    The study must use a storage that several processes can share, such as
+    the JournalStorage of `hyperparameter_tuning`, and `objective` and
+    `callbacks` must be picklable (e.g. a functools.partial of a module-level
+    objective). Features should be EmbeddingStores, which workers reopen as
+    memory maps instead of receiving a copy. When the workers are done, the
+    study holds all the trials as if they had been run in this process.
+    """
+    context = multiprocessing.get_context("spawn")
+    resources = worker_resources(n_processes, devices)
+    workers = []
+    for rank, (device, cpus) in enumerate(resources):
+        # Spread the trials evenly, the first workers take the remainder
+        worker_trials = n_trials // n_processes + int(rank < n_trials % n_processes)
+        if worker_trials == 0:
+            continue
+        worker = context.Process(
+            target=_run_worker,
+            args=(
+                study,
+                objective,
+                worker_trials,
+                device,
+                cpus,
+                trials_per_batch,
+                list(callbacks),
+                catch,
+            ),
+            name=f"optuna-worker-{rank}",
+        )
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Optuna worker processes failed: {', '.join(failed)}")
@@ -1,42 +1,50 @@
-from sklearn.preprocessing import StandardScaler
 import torch
 import json
+import hashlib
+import shutil
 import pandas as pd
 from tokenizers import Tokenizer
-from transformers import PreTrainedTokenizerFast
 from torch.utils.data import (
     TensorDataset,
     DataLoader,
     Subset,
     random_split,
     WeightedRandomSampler,
+    RandomSampler,
+    default_collate,
 )
-from sklearn.model_selection import train_test_split
 import numpy as np
-from pynvml import *
 import os
 import torch.nn as nn
 import psutil
 from tokenizers.processors import TemplateProcessing
 from torch.utils.data import Dataset
-from plmfit.models.pretrained_models import (
-    Antiberty,
-    ESMFamily,
-    ProGenFamily,
-    ProteinBERTFamily,
-    AnkhFamily,
-    ESMCFamily
-)
 from dotenv import load_dotenv
-import blosum as bl
-from collections import Counter
 import torch.nn.functional as F
 import ast
 from plmfit.shared_utils.random_state import get_random_state, get_numpy_random_state
+from plmfit.shared_utils.embedding_store import EmbeddingStore, ShardedEmbeddings
 from concurrent.futures import ProcessPoolExecutor, as_completed
-from plmfit.shared_utils.samplers import LabelWeightedSampler
-from esm.utils import encoding
-from optuna.trial import Trial
+from typing import TYPE_CHECKING
+from plmfit.shared_utils.samplers import (
+    LabelIndexTable,
+    LabelWeightedBatchSampler,
+    LabelWeightedSampler,
+    LengthBucketSampler,
+)
+
+# The PLM backends, sklearn and the other heavy dependencies are imported by
+# the functions using them, so that importing utils stays cheap
+if TYPE_CHECKING:
+    from optuna.trial import Trial
+
+# pyarrow is optional, datasets are read from CSV without it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 load_dotenv()
 plmfit_path = os.getenv("PLMFIT_PATH", "./plmfit")
@@ -65,11 +73,90 @@ def set_path(base_path):
     config_dir = os.getenv("CONFIG_DIR", "./config")
 
 
-def load_dataset(data_type):
+# Columns read by the training functions, entries ending with "*" match by prefix (multilabel columns).
+# mut_mask holds the mutated positions that masked language modelling fine-tuning masks first
+DATASET_COLUMNS = ["aa_seq", "len", "score", "binary_score", "label", "label_*", "mut_mask"]
+
+
+def load_dataset(data_type, columns=None, nrows=None):
+    """
+    Load a dataset by its short name, or by the full path of its CSV file.
+
+    When pyarrow is installed, CSV datasets are converted once into a Parquet
+    cache next to them, which is rebuilt if the CSV changes. Only the requested
+    columns are read and reading stops after nrows rows, for CSVs as well.
+
+    Parameters:
+        data_type (str): Short name of the dataset, or full path to it.
+        columns (list): Columns to read, all of them if None. Entries ending with '*' match by prefix.
+        nrows (int): Number of rows to read, all of them if None.
+
+    Returns:
+        pandas.DataFrame: The dataset.
+    """
+    path = f"{data_dir}/{data_type}/{data_type}_data_full.csv"
+    if not os.path.isfile(path):
+        path = data_type  # Assume it is a full path to dataset
+
+    parquet_path = parquet_cache_path(path)
+    if parquet_path is not None:
+        return read_parquet(parquet_path, columns=columns, nrows=nrows)
+
+    header = pd.read_csv(path, nrows=0).columns
+    return pd.read_csv(path, usecols=select_columns(header, columns), nrows=nrows)
+
+
+def select_columns(available, columns=None):
+    if columns is None:
+        return list(available)
+    return [
+        column
+        for column in available
+        if any(
+            column == name or (name.endswith("*") and column.startswith(name[:-1]))
+            for name in columns
+        )
+    ]
+
+
+def parquet_cache_path(csv_path):
+    """
+    Path of the up to date Parquet cache of a CSV dataset, converting it if needed.
+    None if pyarrow is not installed or the cache cannot be written.
+    """
+    if pq is None or not csv_path.endswith(".csv"):
+        return None
+    parquet_path = f"{csv_path[:-4]}.parquet"
+    if os.path.isfile(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path):
+        return parquet_path
+
     try:
-        return pd.read_csv(f"{data_dir}/{data_type}/{data_type}_data_full.csv")
-    except:
-        return pd.read_csv(data_type) # Assume it is a full path to dataset
+        table = pa.Table.from_pandas(pd.read_csv(csv_path), preserve_index=False)
+        # Written aside and renamed, so concurrent jobs never read a partial file
+        tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, parquet_path)
+    except (OSError, pa.ArrowException):
+        return None
+    return parquet_path
+
+
+def read_parquet(path, columns=None, nrows=None):
+    parquet_file = pq.ParquetFile(path)
+    columns = select_columns(parquet_file.schema_arrow.names, columns)
+    if nrows is None:
+        return parquet_file.read(columns=columns).to_pandas()
+
+    batches = []
+    rows = 0
+    for batch in parquet_file.iter_batches(batch_size=min(nrows, 65536), columns=columns):
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows >= nrows:
+            break
+    if len(batches) == 0:
+        return parquet_file.read(columns=columns).to_pandas()
+    return pa.Table.from_batches(batches).slice(0, nrows).to_pandas()
 
 
 def load_embeddings(
@@ -89,27 +176,82 @@ def load_embeddings(
         layer (str): Layer information (default is 'last').
         model (str): Model information (default is 'progen2-small').
         reduction (str): Reduction method (default is 'mean').
+
+    Returns:
+        torch.Tensor, EmbeddingStore or ShardedEmbeddings: The embeddings, memory-mapped if saved
+        as an embedding store (.emb) or in shards.
     """
     if emb_path is None:
         emb_path = f"{data_dir}/{data_type}/embeddings/{data_type}_{model}_embs_layer{layer}_{reduction}.pt"
 
-    try:
-        embeddings = torch.load(
-            f"{emb_path}/{data_type}_{model}_embs_{layer}_{reduction}/{data_type}_{model}_embs_{layer}_{reduction}.pt",
-            map_location=torch.device(device),
-        )
-        # embeddings = embeddings.numpy() if embeddings.is_cuda else embeddings
-        return embeddings
-    except:
-        try:
-            embeddings = torch.load(
-                f"{emb_path}",
-                map_location=torch.device(device),
-            )
-            # embeddings = embeddings.numpy() if embeddings.is_cuda else embeddings
-            return embeddings
-        except:
-            return None
+    if os.path.isdir(emb_path) and read_shard_manifests(emb_path):
+        # Shards stay memory-mapped and are read lazily by the data loaders
+        return load_embedding_shards(emb_path, device=device)
+
+    name = f"{data_type}_{model}_embs_{layer}_{reduction}"
+    candidates = [
+        f"{emb_path}/{name}/{name}.emb",
+        f"{emb_path}/{name}/{name}.pt",
+        emb_path,
+    ]
+    for path in candidates:
+        if not os.path.isfile(path):
+            continue
+        # Embedding stores stay memory-mapped and are read lazily by the data loaders
+        if EmbeddingStore.is_store(path):
+            return EmbeddingStore(path)
+        return torch.load(path, map_location=torch.device(device))
+
+    raise FileNotFoundError(
+        f"Couldn't find embeddings in any of {candidates}, use the full path of the embeddings file "
+        "or use the extract_embeddings function to create and save them."
+    )
+
+
+def read_shard_manifests(shard_dir, return_num_samples=False):
+    """
+    List the completed shards recorded in the manifests of a sharded embeddings directory.
+
+    Parameters:
+        shard_dir (str): Directory written by ShardedPredictionWriter.
+        return_num_samples (bool): Also return the number of samples of the extraction.
+
+    Returns:
+        list: Manifest entries of all ranks, each with the shard file, its indices file and row count.
+        int: If return_num_samples, the number of samples recorded in the manifests, None if
+            they predate it.
+    """
+    shards = []
+    num_samples = None
+    for file_name in sorted(os.listdir(shard_dir)):
+        if file_name.startswith("manifest_") and file_name.endswith(".json"):
+            with open(os.path.join(shard_dir, file_name), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            shards.extend(manifest["shards"])
+            num_samples = manifest.get("num_samples", num_samples)
+    if return_num_samples:
+        return shards, num_samples
+    return shards
+
+
+def load_embedding_shards(shard_dir, device="cpu", materialize=False):
+    """
+    Open the shards of a sharded embeddings directory as one matrix ordered by sample index.
+
+    Parameters:
+        shard_dir (str): Directory written by ShardedPredictionWriter.
+        device (str): Device to load the embeddings on, if materialized.
+        materialize (bool): Read all the embeddings into a single tensor instead of a lazy view.
+
+    Returns:
+        ShardedEmbeddings or torch.Tensor: Embeddings of all the samples.
+
+    Raises:
+        ValueError: If the extraction is unfinished and some samples are in no shard.
+    """
+    shards, num_samples = read_shard_manifests(shard_dir, return_num_samples=True)
+    embeddings = ShardedEmbeddings(shard_dir, shards, num_samples=num_samples)
+    return embeddings.to_tensor(device) if materialize else embeddings
 
 
 def create_data_loaders(
@@ -125,12 +267,17 @@ def create_data_loaders(
     weights=None,
     sampler=False,
     dataset_type="tensor",
+    pad_token=None,
 ):
     """
     Create DataLoader objects for training, validation, and testing.
 
+    The splits are IndexedDataset views of a single base tensor (or of the
+    EmbeddingStore), so the features are never copied per split. Scaling and
+    the dtype conversion are applied per batch.
+
     Parameters:
-        dataset (numpy.ndarray): Input dataset.
+        dataset (numpy.ndarray): Input dataset, or an EmbeddingStore or ShardedEmbeddings that is read lazily.
         scores (numpy.ndarray): Scores aligned with dataset.
         split (numpy.ndarray): Array indicating the split for each sample (train, test, validation).
                                 If provided, test_size and validation_size are ignored.
@@ -138,121 +285,135 @@ def create_data_loaders(
         validation_size (float): Fraction of the training data to be used as the validation set (default is 0.1).
         batch_size (int): Batch size for DataLoader (default is 64).
         scaler (bool): If to use feature scaling with a standard scaler.
+        dtype (torch.dtype): Data type of the batched features.
+        pad_token (int): Padding token of tokenized inputs. If provided, batches group
+                         sequences of similar length and are trimmed to their longest sequence.
 
     Returns:
         dict: Dictionary containing DataLoader objects for train, validation, and test.
     """
-    random_state = get_random_state()
-    if split is None:
-        random_state = get_numpy_random_state()
-        X_train, X_test, y_train, y_test = train_test_split(
-            dataset, scores, test_size=test_size, random_state=random_state
-        )
-        X_train, X_val, y_train, y_val = train_test_split(
-            X_train,
-            y_train,
-            test_size=validation_size / (1 - test_size),
-            random_state=random_state,
-        )
+    datasets = split_datasets(
+        dataset,
+        scores,
+        split=split,
+        test_size=test_size,
+        validation_size=validation_size,
+        scaler=scaler,
+        dtype=dtype,
+        weights=weights,
+        sampler=sampler,
+        dataset_type=dataset_type,
+    )
+    return build_data_loaders(
+        **datasets,
+        batch_size=batch_size,
+        sampler=sampler,
+        num_workers=num_workers,
+        pad_token=pad_token,
+    )
 
-        if weights is not None:
-            # Splitting with weights for the initial train-test split
-            X_train, X_test, y_train, y_test, weights_train, weights_test = (
-                train_test_split(
-                    dataset,
-                    scores,
-                    weights,
-                    test_size=test_size,
-                    random_state=random_state,
-                )
-            )
 
-            # Splitting with weights for the train-validation split
-            X_train, X_val, y_train, y_val, weights_train, weights_val = (
-                train_test_split(
-                    X_train,
-                    y_train,
-                    weights_train,
-                    test_size=validation_size / (1 - test_size),
-                    random_state=random_state,
-                )
-            )
+def split_datasets(
+    dataset,
+    scores,
+    split=None,
+    test_size=0.2,
+    validation_size=0.1,
+    scaler=None,
+    dtype=torch.float16,
+    weights=None,
+    sampler=False,
+    dataset_type="tensor",
+):
+    """
+    Split a dataset into its train, validation and test IndexedDatasets, with
+    the arguments of `create_data_loaders` that do not depend on the batch size.
 
-    else:
-        # Use the provided split
-        X_train, X_val, X_test = (
-            dataset[split == "train"],
-            dataset[split == "validation"],
-            dataset[split == "test"],
-        )
-        y_train, y_val, y_test = (
-            scores[split == "train"],
-            scores[split == "validation"],
-            scores[split == "test"],
-        )
-        if weights is not None:
-            weights_train, weights_val, weights_test = (
-                weights[split == "train"],
-                weights[split == "validation"],
-                weights[split == "test"],
-            )
+    The result only holds read-only views, so it can be built once and passed
+    to `build_data_loaders` for every batch size, e.g. by all the trials of
+    an Optuna study.
 
-        # Check if the validation set is empty and split the training data if necessary
-        if X_val.shape[0] == 0 or y_val.shape[0] == 0:
-            X_train, X_val, y_train, y_val = train_test_split(
-                X_train, y_train, test_size=validation_size, random_state=random_state
-            )
-            if weights is not None:
-                X_train, X_val, y_train, y_val, weights_train, weights_val = (
-                    train_test_split(
-                        X_train,
-                        y_train,
-                        weights_train,
-                        test_size=validation_size,
-                        random_state=random_state,
-                    )
-                )
+    Returns:
+        dict: The keyword arguments of `build_data_loaders` for the datasets and sample weights.
+    """
+    if dataset_type != "tensor":
+        raise ValueError(
+            "dataset_type must be 'tensor', one-hot inputs are expanded by the heads (see OneHotLinear)"
+        )
 
-    # Scale the features if scaler is provided
-    if scaler:
-        scaler = StandardScaler()
-        X_train = scaler.fit_transform(X_train)
-        X_val = scaler.transform(X_val)
-        X_test = scaler.transform(X_test)
+    # Arrays and tensors are shared as they are, not cloned or cast
+    if isinstance(dataset, np.ndarray):
+        dataset = torch.from_numpy(dataset)
+    elif isinstance(dataset, (list, pd.Series)):
+        dataset = convert_or_clone_to_tensor(dataset, dtype=dtype)
 
-    # Assuming X_train, X_val, X_test, y_train, y_val, y_test could be either NumPy arrays or PyTorch tensors
-    X_train = convert_or_clone_to_tensor(X_train, dtype=dtype)
-    X_val = convert_or_clone_to_tensor(X_val, dtype=dtype)
-    X_test = convert_or_clone_to_tensor(X_test, dtype=dtype)
-    # Add to X_test an identifier
-    test_ids = torch.arange(X_test.size(0))
+    train_idx, val_idx, test_idx = split_indices(
+        len(dataset), split, test_size=test_size, validation_size=validation_size
+    )
 
-    y_train = convert_or_clone_to_tensor(y_train, dtype=torch.float16)
-    y_val = convert_or_clone_to_tensor(y_val, dtype=torch.float16)
-    y_test = convert_or_clone_to_tensor(y_test, dtype=torch.float16)
+    mean, scale = fit_standard_scaler(dataset, train_idx) if scaler else (None, None)
 
+    scores = convert_or_clone_to_tensor(scores, dtype=torch.float16)
     if weights is not None:
-        weights_train = convert_or_clone_to_tensor(weights_train, dtype=torch.float16)
-        weights_val = convert_or_clone_to_tensor(weights_val, dtype=torch.float16)
-        weights_test = convert_or_clone_to_tensor(weights_test, dtype=torch.float16)
-
-    if dataset_type == "tensor":
-        Dataset = TensorDataset
-    elif dataset_type == "one_hot":
-        Dataset = OneHotDataset
-    else:
-        raise ValueError("dataset_type must be either 'tensor' or 'one_hot'")
+        weights = convert_or_clone_to_tensor(weights, dtype=torch.float16)
+
+    def view(indices, *tensors):
+        return IndexedDataset(
+            dataset,
+            indices,
+            scores[indices],
+            *tensors,
+            dtype=dtype,
+            mean=mean,
+            scale=scale,
+        )
 
-    # Create DataLoader for training, validation, and testing
+    # Add to the test set an identifier
+    test_ids = torch.arange(len(test_idx))
     if weights is not None and sampler is False:
-        train_dataset = Dataset(X_train, y_train, weights_train)
-        val_dataset = Dataset(X_val, y_val, weights_val)
-        test_dataset = Dataset(X_test, y_test, test_ids, weights_test)
+        train_dataset = view(train_idx, weights[train_idx])
+        val_dataset = view(val_idx, weights[val_idx])
+        test_dataset = view(test_idx, test_ids, weights[test_idx])
     else:
-        train_dataset = Dataset(X_train, y_train)
-        val_dataset = Dataset(X_val, y_val)
-        test_dataset = Dataset(X_test, y_test, test_ids)
+        train_dataset = view(train_idx)
+        val_dataset = view(val_idx)
+        test_dataset = view(test_idx, test_ids)
+
+    return {
+        "train_dataset": train_dataset,
+        "val_dataset": val_dataset,
+        "test_dataset": test_dataset,
+        "weights_train": weights[train_idx] if weights is not None else None,
+        "weights_val": weights[val_idx] if weights is not None else None,
+    }
+
+
+def build_data_loaders(
+    train_dataset,
+    val_dataset,
+    test_dataset,
+    weights_train=None,
+    weights_val=None,
+    batch_size=64,
+    sampler=False,
+    num_workers=0,
+    pad_token=None,
+):
+    """
+    Create the train, validation and test DataLoaders over already split datasets.
+
+    Parameters:
+        train_dataset, val_dataset, test_dataset (Dataset): The split datasets.
+        weights_train, weights_val (torch.Tensor): Sample weights used by the weighted samplers.
+        batch_size (int): Batch size for DataLoader (default is 64).
+        sampler (bool or str): If to sample the train and validation sets by their weights.
+        pad_token (int): Padding token of tokenized inputs. If provided, batches group
+                         sequences of similar length and are trimmed to their longest sequence.
 
+    Returns:
+        dict: Dictionary containing DataLoader objects for train, validation, and test.
+    """
+    random_state = get_random_state()
     if sampler:
         train_sampler = init_weighted_sampler(
             train_dataset,
@@ -272,24 +433,68 @@ def create_data_loaders(
         val_sampler = None
         test_sampler = None
 
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=sampler == False,  # If sampler is used, shuffle is not needed
-        num_workers=num_workers,
-        pin_memory=num_workers > 0,
-        sampler=train_sampler,
-        generator=random_state,
-    )
-    val_loader = DataLoader(
-        val_dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=num_workers,
-        pin_memory=num_workers > 0,
-        sampler=val_sampler,
-        generator=random_state,
-    )
+    if pad_token is not None:
+        return {
+            "train": length_bucketed_data_loader(
+                train_dataset,
+                pad_token,
+                batch_size=batch_size,
+                sampler=(
+                    train_sampler
+                    if train_sampler is not None
+                    else RandomSampler(train_dataset, generator=random_state)
+                ),
+                shuffle=True,
+                num_workers=num_workers,
+            ),
+            "val": length_bucketed_data_loader(
+                val_dataset,
+                pad_token,
+                batch_size=batch_size,
+                sampler=val_sampler,
+                num_workers=num_workers,
+            ),
+            "test": length_bucketed_data_loader(
+                test_dataset,
+                pad_token,
+                batch_size=batch_size,
+                num_workers=num_workers,
+            ),
+        }
+
+    if isinstance(train_sampler, LabelWeightedSampler):
+        # Draw whole batches of indices at once
+        train_loader = DataLoader(
+            train_dataset,
+            batch_sampler=LabelWeightedBatchSampler(train_sampler, batch_size),
+            num_workers=num_workers,
+            pin_memory=num_workers > 0,
+        )
+        val_loader = DataLoader(
+            val_dataset,
+            batch_sampler=LabelWeightedBatchSampler(val_sampler, batch_size),
+            num_workers=num_workers,
+            pin_memory=num_workers > 0,
+        )
+    else:
+        train_loader = DataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=sampler == False,  # If sampler is used, shuffle is not needed
+            num_workers=num_workers,
+            pin_memory=num_workers > 0,
+            sampler=train_sampler,
+            generator=random_state,
+        )
+        val_loader = DataLoader(
+            val_dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            pin_memory=num_workers > 0,
+            sampler=val_sampler,
+            generator=random_state,
+        )
     test_loader = DataLoader(
         test_dataset,
         batch_size=batch_size,
@@ -302,12 +507,75 @@ def create_data_loaders(
 
     return {"train": train_loader, "val": val_loader, "test": test_loader}
 
+
+def split_indices(num_samples, split=None, test_size=0.2, validation_size=0.1):
+    """
+    Compute the train, validation and test indices of a dataset.
+
+    Parameters:
+        num_samples (int): Number of samples in the dataset.
+        split (numpy.ndarray): Array indicating the split for each sample (train, test, validation).
+                               If provided, test_size and validation_size are ignored, unless
+                               the validation split is empty.
+        test_size (float): Fraction of the data to be used as the test set (default is 0.2).
+        validation_size (float): Fraction of the training data to be used as the validation set (default is 0.1).
+
+    Returns:
+        tuple: Train, validation and test index tensors.
+    """
+    from sklearn.model_selection import train_test_split
+
+    random_state = get_numpy_random_state()
+    indices = np.arange(num_samples)
+    if split is None:
+        train_idx, test_idx = train_test_split(
+            indices, test_size=test_size, random_state=random_state
+        )
+        train_idx, val_idx = train_test_split(
+            train_idx,
+            test_size=validation_size / (1 - test_size),
+            random_state=random_state,
+        )
+    else:
+        split = np.asarray(split)
+        train_idx = indices[split == "train"]
+        val_idx = indices[split == "validation"]
+        test_idx = indices[split == "test"]
+        if len(val_idx) == 0:
+            train_idx, val_idx = train_test_split(
+                train_idx, test_size=validation_size, random_state=random_state
+            )
+    return tuple(torch.from_numpy(idx) for idx in (train_idx, val_idx, test_idx))
+
+
+def fit_standard_scaler(features, indices, chunk_size=100000):
+    """
+    Fit a standard scaler on the rows `indices` of `features`, reading them in chunks.
+
+    Returns:
+        tuple: Mean and scale tensors of the features.
+    """
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler()
+    indices = torch.sort(torch.as_tensor(indices)).values
+    for chunk in indices.split(chunk_size):
+        rows = features[chunk] if torch.is_tensor(features) else features[chunk.numpy()]
+        scaler.partial_fit(np.asarray(rows, dtype=np.float64))
+    return (
+        torch.tensor(scaler.mean_, dtype=torch.float32),
+        torch.tensor(scaler.scale_, dtype=torch.float32),
+    )
+
+
 def create_predict_data_loader(
     dataset,
     batch_size=64,
     dtype=torch.int8,
     num_workers=0,
     dataset_type="tensor",
+    pad_token=None,
+    indices=None,
 ):
     """
     Create DataLoader objects for prediction.
@@ -315,6 +583,9 @@ def create_predict_data_loader(
     Parameters:
         dataset (numpy.ndarray): Input dataset.
         batch_size (int): Batch size for DataLoader (default is 64).
+        pad_token (int): Padding token of tokenized inputs. If provided, batches group
+                         sequences of similar length and are trimmed to their longest sequence.
+        indices (Sequence[int]): Dataset indices to predict, all of them if None.
 
     Returns:
         DataLoader: DataLoader object for prediction.
@@ -330,15 +601,87 @@ def create_predict_data_loader(
 
     dataset = Dataset(X)
 
+    if pad_token is not None:
+        return length_bucketed_data_loader(
+            dataset,
+            pad_token,
+            batch_size=batch_size,
+            sampler=indices,
+            num_workers=num_workers,
+        )
+
     return DataLoader(
         dataset,
         batch_size=batch_size,
+        sampler=indices,
         shuffle=False,
         num_workers=num_workers,
         pin_memory=num_workers > 0,
     )
 
 
+def length_bucketed_data_loader(
+    dataset, pad_token, batch_size=64, sampler=None, shuffle=False, num_workers=0
+):
+    """
+    Create a DataLoader over a tokenized TensorDataset that batches sequences
+    of similar length and trims each batch to its longest sequence.
+
+    Parameters:
+        dataset (TensorDataset or IndexedDataset): Dataset with the padded tokens as first tensor.
+        pad_token (int): Padding token of the tokens.
+        batch_size (int): Batch size for DataLoader (default is 64).
+        sampler (Sampler): Sampler of the dataset indices, sequential if None.
+        shuffle (bool): If to shuffle the order of the batches.
+
+    Returns:
+        DataLoader: DataLoader with a LengthBucketSampler.
+    """
+    if isinstance(dataset, IndexedDataset):
+        lengths = dataset.sequence_lengths(pad_token)
+    else:
+        lengths = (dataset.tensors[0] != pad_token).sum(dim=1)
+    length_sampler = LengthBucketSampler(
+        lengths,
+        batch_size,
+        sampler=sampler,
+        shuffle=shuffle,
+        generator=get_random_state() if shuffle else None,
+    )
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=length_sampler,
+        collate_fn=TrimPaddingCollator(pad_token),
+        num_workers=num_workers,
+        pin_memory=num_workers > 0,
+    )
+
+
+class TrimPaddingCollator:
+    """
+    Collates a batch of padded token tensors and removes the padding columns
+    shared by all of its sequences. Labels padded per token to the same width
+    as the tokens (token classification) are trimmed along with them.
+    """
+
+    def __init__(self, pad_token):
+        self.pad_token = pad_token
+
+    def __call__(self, batch):
+        batch = default_collate(batch)
+        tokens = batch[0]
+        width = max(int((tokens != self.pad_token).sum(dim=1).max()), 1)
+        if width == tokens.shape[1]:
+            return batch
+        return [tokens[:, :width]] + [
+            tensor[:, :width]
+            if tensor.dim() > 1 and tensor.shape[1] == tokens.shape[1]
+            else tensor
+            for tensor in batch[1:]
+        ]
+
+
 class OneHotDataset(TensorDataset):
     """
     A custom dataset class that one-hot encodes the first tensor in the dataset.
@@ -366,6 +709,64 @@ class OneHotDataset(TensorDataset):
         )
 
 
+class IndexedDataset(Dataset):
+    """
+    A dataset over the rows `indices` of a base feature matrix (tensor, array,
+    EmbeddingStore or ShardedEmbeddings), so that splits are views of one base instead of copies.
+    Features are cast to `dtype`, and standardized with `mean` and `scale` if
+    given, only when they are fetched. `tensors` are aligned with `indices`.
+    """
+
+    def __init__(self, features, indices, *tensors, dtype=torch.float16, mean=None, scale=None):
+        self.features = features
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+        assert all(
+            len(self.indices) == tensor.size(0) for tensor in tensors
+        ), "Size mismatch between tensors"
+        self.tensors = tensors
+        self.dtype = dtype
+        self.mean = mean
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.indices)
+
+    def fetch(self, index):
+        rows = self.indices[index]
+        if torch.is_tensor(self.features):
+            features = self.features[rows]
+        else:
+            # Sorted unique rows turn memory-mapped reads into forward scans
+            unique_rows, inverse = torch.unique(rows, return_inverse=True)
+            features = torch.from_numpy(
+                np.asarray(self.features[unique_rows.numpy()])
+            )[inverse]
+        if self.mean is not None:
+            features = (features.float() - self.mean) / self.scale
+        return features.to(self.dtype)
+
+    def sequence_lengths(self, pad_token, chunk_size=65536):
+        """Number of non-padding tokens of each row, computed in chunks of rows."""
+        if len(self) == 0:
+            return torch.zeros(0, dtype=torch.long)
+        return torch.cat(
+            [
+                (self.fetch(chunk) != pad_token).sum(dim=1)
+                for chunk in torch.arange(len(self)).split(chunk_size)
+            ]
+        )
+
+    def __getitem__(self, index):
+        features = self.fetch(torch.tensor([index]))[0]
+        return (features,) + tuple(tensor[index] for tensor in self.tensors)
+
+    def __getitems__(self, indices):
+        # Batched fetch used by the DataLoader, one read for the whole batch
+        index = torch.as_tensor(indices, dtype=torch.long)
+        columns = [self.fetch(index)] + [tensor[index] for tensor in self.tensors]
+        return list(zip(*columns))
+
+
 def one_hot_encode(seqs, num_classes, flatten=True):
     # get dtype and save it
     dtype = seqs.dtype
@@ -379,45 +780,45 @@ def one_hot_encode(seqs, num_classes, flatten=True):
     return encs.flatten() if flatten else encs
 
 
+# Label index tables of recently seen sample weights, keyed by their digest, so
+# that Optuna trials over the same split do not rebuild them
+_label_tables = {}
+
+
+def label_index_table(weights, max_cached=4):
+    """
+    Return the LabelIndexTable over the unique values of `weights` and those
+    values, reusing the table of identical weights seen before.
+    """
+    weights = torch.as_tensor(weights).contiguous()
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str(weights.dtype).encode())
+    digest.update(weights.numpy().tobytes())
+    digest = digest.hexdigest()
+    if digest not in _label_tables:
+        if len(_label_tables) >= max_cached:
+            _label_tables.pop(next(iter(_label_tables)))
+        _label_tables[digest] = LabelIndexTable.from_values(weights)
+    return _label_tables[digest]
+
+
 def init_weighted_sampler(dataset, weights, num_samples_method="min", sampler="weighted_random"):
     if num_samples_method == "min":
         # Count the occurrences of each class in the dataset
-        labels = dataset.tensors[1].numpy()  # Assuming that labels are in the second tensor
-        class_counts = Counter(labels)
-        # Find the class with the least count
-        min_class_count = min(class_counts.values())
-        # Calculate the number of unique classes
-        num_unique_classes = len(class_counts)
-
-        # Set num_samples to the product of the least count and the number of unique classes
-        num_samples = min_class_count * num_unique_classes
-    elif num_samples_method == "min_weighted":
-        value_counts = pd.Series(weights.numpy()).value_counts()
-        # Find the class with the least count
-        min_class_count = value_counts.min()
-        # Calculate the number of unique classes
-        num_unique_classes = len(value_counts)
-
-        # Set num_samples to the product of the least count and the number of unique classes
-        num_samples = int(min_class_count * num_unique_classes)
-
-        ## -----------------------------------------------------------
-        # Map each unique weight value to an integer label: 0 .. N-1
-        # -----------------------------------------------------------
-        # 1) Collect the unique weight values from the Series index
-        unique_weight_values = value_counts.index.tolist()  # e.g., [0.1, 0.3, 1.0, ...]
-
-        # 2) Create a dictionary mapping each weight value -> new label index
-        weight_to_label = {w: i for i, w in enumerate(unique_weight_values)}
-
-        # 3) Convert the original `weights` (one weight per sample) into integer "labels"
-        labels = torch.tensor(
-            [weight_to_label[w.item()] for w in weights],
-            dtype=torch.int16
+        # Labels are the second tensor, or the first one of an IndexedDataset
+        labels = (
+            dataset.tensors[0] if isinstance(dataset, IndexedDataset) else dataset.tensors[1]
         )
+        table, unique_weight_values = label_index_table(labels)
+    elif num_samples_method == "min_weighted":
+        # Each unique weight value is a class of its own
+        table, unique_weight_values = label_index_table(weights)
     else:
         raise ValueError("num_samples_method must be 'min'")
 
+    # Set num_samples to the product of the least count and the number of unique classes
+    num_samples = int(table.counts.min()) * len(table)
+
     if sampler == "weighted_random":
         # Create the WeightedRandomSampler using these weights
         return WeightedRandomSampler(
@@ -429,10 +830,10 @@ def init_weighted_sampler(dataset, weights, num_samples_method="min", sampler="w
     elif sampler == "label_weighted":
         return LabelWeightedSampler(
             label_weights=unique_weight_values,
-            labels=labels,
             num_samples=num_samples,
             replacement=True,  # To allow resampling
-            generator=get_random_state()
+            generator=get_random_state(),
+            table=table,
         )
 
 
@@ -633,6 +1034,8 @@ def load_tokenizer(model_name):
 
 
 def load_transformer_tokenizer(model_name, tokenizer):
+    from transformers import PreTrainedTokenizerFast
+
     if "progen2" in model_name:
         tokenizer.post_processor = TemplateProcessing(
             single="<|bos|> $A <|eos|>",
@@ -673,49 +1076,108 @@ def load_transformer_tokenizer(model_name, tokenizer):
         raise "Transformer tokenizer not supported (yet)"
 
 
-def blosum62_encode(sequences, pad_to_length, logger=None):
-    # Load the BLOSUM62 matrix from your custom library
+BLOSUM62_PROFILE_RESIDUES = "ARNDCQEGHILKMFPSTWYV"
+
+def blosum62_table():
+    """
+    Returns the BLOSUM62 scores as an int8 matrix and a 256-entry table
+    mapping a byte to its row. The last row and column are all zeros and
+    are used for padding and residues missing from the matrix.
+    """
+    import blosum as bl
+
     BLOSUM62 = bl.BLOSUM(62)
-    encoded_sequences = []
-    i = 0
-    for seq in sequences:
-        i += 1
-        encoded_seq = []
-        for acid in seq:
-            # Fetch the BLOSUM62 row for the current amino acid
-            row = BLOSUM62[acid]
-            # Extract scores for the sequence from the row corresponding to each amino acid
-            encoded_row = [
-                row.get(aa, 0) for aa in seq
-            ]  # default to 0 if pair not found
-
-            # Convert list to torch tensor and pad the encoded row to ensure all rows have the same number of columns
-            encoded_row = torch.tensor(encoded_row, dtype=torch.int8)
-            if encoded_row.size(0) < pad_to_length:
-                encoded_row = torch.nn.functional.pad(
-                    encoded_row,
-                    (0, pad_to_length - encoded_row.size(0)),
-                    mode="constant",
-                    value=0,
-                )
+    residues = list(BLOSUM62.keys())
+    matrix = np.zeros((len(residues) + 1, len(residues) + 1), dtype=np.int8)
+    for i, a in enumerate(residues):
+        row = BLOSUM62[a]
+        for j, b in enumerate(residues):
+            matrix[i, j] = row.get(b, 0)
+    byte_index = np.full(256, len(residues), dtype=np.int64)
+    for i, a in enumerate(residues):
+        byte_index[ord(a)] = i
+    return matrix, byte_index
+
+def blosum62_indices(sequences, pad_to_length, byte_index):
+    """Maps sequences to a (N, pad_to_length) array of BLOSUM62 row indices."""
+    flat, lengths, rows, cols = sequence_bytes(sequences)
+    # Padding uses the all-zero row, the largest index in the table
+    indices = np.full((len(lengths), pad_to_length), byte_index.max(), dtype=np.int64)
+    kept = cols < pad_to_length
+    indices[rows[kept], cols[kept]] = byte_index[flat[kept]]
+    return indices
+
+def blosum62_encode(
+    sequences, pad_to_length, logger=None, out=None, chunk_size=1000
+):
+    """
+    Encodes each sequence as the (pad_to_length, pad_to_length) matrix of
+    BLOSUM62 scores between all of its residue pairs, zero padded.
 
-            encoded_seq.append(encoded_row)
+    Args:
+        sequences (List[str]): The sequences to encode.
+        pad_to_length (int): Length sequences are padded or truncated to.
+        logger (Optional): If provided, used for logging progress.
+        out (Optional): Preallocated (N, pad_to_length, pad_to_length) array
+            or tensor to write into, or the path of a .npy file to create as
+            a memory map. Chunks are written into it one at a time.
+        chunk_size (int): Number of sequences encoded per chunk.
 
-        # Stack all rows to create a 2D tensor for each sequence
-        encoded_seq = torch.stack(encoded_seq)
+    Returns:
+        torch.Tensor: int8 tensor of shape (N, pad_to_length, pad_to_length).
+    """
+    matrix, byte_index = blosum62_table()
+    shape = (len(sequences), pad_to_length, pad_to_length)
+    if out is None:
+        out = np.empty(shape, dtype=np.int8)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=np.int8, shape=shape)
+    target = out.numpy() if isinstance(out, torch.Tensor) else out
+
+    for start, chunk in chunkify(sequences, chunk_size):
+        idx = blosum62_indices(chunk, pad_to_length, byte_index)
+        target[start : start + len(idx)] = matrix[idx[:, :, None], idx[:, None, :]]
+        if logger is not None:
+            logger.log(f"Encoded sequence {start + len(idx)}")
 
-        # Pad the encoded sequence if it has fewer rows than `pad_to_length`
-        if encoded_seq.size(0) < pad_to_length:
-            padding = torch.zeros((pad_to_length - encoded_seq.size(0), pad_to_length))
-            encoded_seq = torch.cat((encoded_seq, padding), dim=0)
+    if isinstance(target, np.memmap):
+        target.flush()
+    return out if isinstance(out, torch.Tensor) else torch.from_numpy(target)
 
-        if logger is not None and i % 1000 == 0:
-            logger.log(f"Encoded sequence {i}")
+def blosum62_profile_encode(sequences, pad_to_length, logger=None, chunk_size=10000):
+    """
+    Encodes each residue by its BLOSUM62 row over the 20 standard amino
+    acids, a compact (pad_to_length, 20) alternative to `blosum62_encode`.
 
-        encoded_sequences.append(encoded_seq)
+    Returns:
+        torch.Tensor: int8 tensor of shape (N, pad_to_length, 20).
+    """
+    matrix, byte_index = blosum62_table()
+    profile = matrix[:, byte_index[[ord(a) for a in BLOSUM62_PROFILE_RESIDUES]]]
+    out = np.empty((len(sequences), pad_to_length, profile.shape[1]), dtype=np.int8)
 
-    # Stack all sequence tensors to create a 3D tensor for the batch
-    return torch.stack(encoded_sequences)
+    for start, chunk in chunkify(sequences, chunk_size):
+        idx = blosum62_indices(chunk, pad_to_length, byte_index)
+        out[start : start + len(idx)] = profile[idx]
+        if logger is not None:
+            logger.log(f"Encoded sequence {start + len(idx)}")
+
+    return torch.from_numpy(out)
+
+def sequence_bytes(seqs):
+    """
+    Returns a flat uint8 view of the concatenated sequences together with
+    the sequence lengths and the (row, column) position of every byte.
+    Non-ASCII characters are replaced by '?' so that each character is one
+    byte.
+    """
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    flat = np.frombuffer(
+        "".join(seqs).encode("ascii", errors="replace"), dtype=np.uint8
+    )
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(flat.size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return flat, lengths, rows, cols
 
 def categorical_encode(
     seqs,
@@ -726,10 +1188,18 @@ def categorical_encode(
     logger=None,
     model_name="progen2",
     progress_interval=100000,
+    chunk_size=10000,
+    num_workers=0,
 ):
     """
     Encodes a list of sequences in chunks to avoid high memory usage.
-    
+
+    Residues are mapped to token ids through a 256-entry byte lookup table
+    built from the tokenizer, so whole chunks are encoded with NumPy instead
+    of one tokenizer call per sequence. Sequences containing characters that
+    do not map to exactly one known token are encoded with `encode_sequence`,
+    keeping the output identical to the tokenizer's.
+
     Args:
         seqs (List[str]): The sequences to encode.
         tokenizer: The tokenizer object with `encode` and `get_vocab` methods.
@@ -739,7 +1209,9 @@ def categorical_encode(
         logger (Optional): If provided, used for logging messages.
         model_name (str): Name of the model ("progen2", "bert", "esm", ...).
         progress_interval (int): How often to log the progress in each chunk.
-        chunk_size (int): Number of sequences to process in one parallel chunk.
+        chunk_size (int): Number of sequences to process in one chunk.
+        num_workers (int): If greater than 1, chunks are encoded by a pool of
+            worker processes writing into one shared tensor.
 
     Returns:
         torch.Tensor: A tensor of shape (len(seqs), internal_max_len).
@@ -757,43 +1229,58 @@ def categorical_encode(
     else:
         internal_max_len = max_len + int(add_bos) + int(add_eos)
 
-    # Identify the correct padding token
-    if "progen2" in model_name:
-        pad_token = tokenizer.get_vocab()["<|pad|>"]
-    elif "bert" in model_name:
-        pad_token = tokenizer.get_vocab()["<pad>"]
-    elif "esm2" in model_name:
-        pad_token = tokenizer.get_vocab()["<pad>"]
-    elif "esmc" in model_name:
-        pad_token = tokenizer.pad_token_id
-    else:
-        raise ValueError("Model tokenizer not defined")
+    pad_token, bos_token, eos_token = special_token_ids(tokenizer, model_name)
+    byte_table = byte_token_table(tokenizer, model_name)
 
     # Pre-allocate the final tensor
-    seq_tokens = pad_token * torch.ones((total_seqs, internal_max_len), dtype=torch.int8)
-
-    # Decide whether to run in parallel
-    n_cpus = os.cpu_count() or 1
-    use_parallel = False # TODO enable parallel encoding
+    seq_tokens = torch.full((total_seqs, internal_max_len), pad_token, dtype=torch.int8)
+
+    encode_args = (
+        seq_tokens,
+        byte_table,
+        tokenizer,
+        max_len,
+        add_bos,
+        add_eos,
+        model_name,
+        bos_token,
+        eos_token,
+    )
+    chunks = chunkify(seqs, chunk_size)
+    use_parallel = num_workers > 1 and total_seqs > chunk_size
     if logger is not None:
         if use_parallel:
-            logger.log(f"Running parallel encoding with up to {n_cpus} workers.")
+            logger.log(f"Running parallel encoding with up to {num_workers} workers.")
         else:
-            logger.log("Only 1 CPU core detected. Will run in serial mode.")
+            logger.log("Running vectorized encoding in serial mode.")
 
     # Track how many sequences have been processed so far
     processed_so_far = 0
-
-    # --- Serial Mode ---
-    for local_i, seq in enumerate(seqs):
-        idx = local_i
-        encoded_seq = encode_sequence(seq, tokenizer, max_len, add_bos, add_eos, model_name)
-        seq_len = len(encoded_seq)
-        seq_tokens[idx, :seq_len] = encoded_seq
-
-        processed_so_far += 1
-        if logger is not None and processed_so_far % progress_interval == 0:
-            logger.log(f"Encoded {processed_so_far}/{total_seqs} sequences...")
+    next_report = progress_interval
+
+    if use_parallel:
+        seq_tokens.share_memory_()
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_encode_worker,
+            initargs=encode_args,
+        ) as executor:
+            futures = [
+                executor.submit(_encode_chunk_in_worker, start, chunk)
+                for start, chunk in chunks
+            ]
+            for future in as_completed(futures):
+                processed_so_far += future.result()
+                if logger is not None and processed_so_far >= next_report:
+                    logger.log(f"Encoded {processed_so_far}/{total_seqs} sequences...")
+                    next_report += progress_interval
+    else:
+        for start, chunk in chunks:
+            encode_chunk(start, chunk, *encode_args)
+            processed_so_far += len(chunk)
+            if logger is not None and processed_so_far >= next_report:
+                logger.log(f"Encoded {processed_so_far}/{total_seqs} sequences...")
+                next_report += progress_interval
 
     # --- Final Logging ---
     if logger is not None and total_seqs > 0:
@@ -807,6 +1294,253 @@ def chunkify(data, chunk_size):
     for i in range(0, len(data), chunk_size):
         yield i, data[i : i + chunk_size]
 
+def special_token_ids(tokenizer, model_name):
+    """Returns the (pad, bos, eos) token ids used by `encode_sequence`."""
+    if "progen2" in model_name:
+        vocab = tokenizer.get_vocab()
+        return vocab["<|pad|>"], vocab["<|bos|>"], vocab["<|eos|>"]
+    elif "bert" in model_name:
+        vocab = tokenizer.get_vocab()
+        return vocab["<pad>"], vocab["<cls>"], vocab["<sep>"]
+    elif "esm2" in model_name:
+        return (
+            tokenizer.get_vocab()["<pad>"],
+            tokenizer.cls_token_id,
+            tokenizer.eos_token_id,
+        )
+    elif "esmc" in model_name:
+        return tokenizer.pad_token_id, tokenizer.cls_token_id, tokenizer.eos_token_id
+    else:
+        raise ValueError("Model tokenizer not defined")
+
+def byte_token_table(tokenizer, model_name):
+    """
+    Builds a 256-entry lookup table mapping a byte to the token id of the
+    corresponding character. Bytes that do not encode to exactly one known
+    token on their own (unknown, dropped or non-ASCII characters) map to -1.
+    """
+    if isinstance(tokenizer, Tokenizer):
+        unk_token = tokenizer.token_to_id("<unk>")
+    else:
+        unk_token = tokenizer.unk_token_id
+
+    table = np.full(256, -1, dtype=np.int16)
+    for byte in range(128):
+        char = chr(byte)
+        if "progen2" in model_name or "bert" in model_name:
+            ids = tokenizer.encode(char, add_special_tokens=False).ids
+        elif "esm2" in model_name:
+            ids = tokenizer.encode(char, add_special_tokens=False)
+        elif "esmc" in model_name:
+            from esm.utils import encoding
+
+            ids = encoding.tokenize_sequence(
+                char, tokenizer, add_special_tokens=False
+            ).tolist()
+        else:
+            raise ValueError("Model tokenizer not defined")
+        if len(ids) == 1 and ids[0] != unk_token:
+            table[byte] = ids[0]
+    return table
+
+def encode_chunk(
+    start,
+    seqs,
+    seq_tokens,
+    byte_table,
+    tokenizer,
+    max_len,
+    add_bos,
+    add_eos,
+    model_name,
+    bos_token,
+    eos_token,
+):
+    """
+    Encodes `seqs` into rows `start:start + len(seqs)` of the pre-padded
+    `seq_tokens` tensor, reproducing `encode_sequence` row for row.
+    """
+    seqs = list(seqs)
+    n = len(seqs)
+    if n == 0:
+        return 0
+    out = seq_tokens[start : start + n].numpy()
+
+    # Non-ASCII characters become '?' and the affected sequences are sent
+    # to the tokenizer below
+    flat, lengths, rows, cols = sequence_bytes(seqs)
+    ids = byte_table[flat]
+
+    if "esm" in model_name:
+        # <cls> is always prepended and the sequence is cut at max_len + 2,
+        # so <eos> only survives when the residues fit within max_len
+        offset, keep = 1, max_len + 1
+        prepend = True
+        has_eos = lengths <= max_len
+    else:
+        offset, keep = int(add_bos), max_len
+        prepend = add_bos
+        has_eos = np.full(n, add_eos)
+
+    fallback = ~np.fromiter(map(str.isascii, seqs), dtype=bool, count=n)
+    fallback[rows[ids < 0]] = True
+
+    kept = (cols < keep) & ~fallback[rows]
+    out[rows[kept], cols[kept] + offset] = ids[kept]
+    if prepend:
+        out[~fallback, 0] = bos_token
+    eos_rows = np.flatnonzero(has_eos & ~fallback)
+    out[eos_rows, offset + np.minimum(lengths[eos_rows], keep)] = eos_token
+
+    for i in np.flatnonzero(fallback):
+        encoded_seq = encode_sequence(
+            seqs[i], tokenizer, max_len, add_bos, add_eos, model_name
+        )
+        seq_tokens[start + i, : len(encoded_seq)] = encoded_seq
+    return n
+
+_encode_worker_args = None
+
+def _init_encode_worker(*args):
+    global _encode_worker_args
+    _encode_worker_args = args
+
+def _encode_chunk_in_worker(start, seqs):
+    return encode_chunk(start, seqs, *_encode_worker_args)
+
+def get_token_cache_dir():
+    """
+    Directory of the tokenized dataset cache, empty if caching is disabled.
+    Entries are never evicted, the directory can be deleted to clear it.
+    """
+    return os.getenv("TOKEN_CACHE_DIR", os.path.join(data_dir, ".token_cache"))
+
+def tokenizer_fingerprint(tokenizer):
+    """Returns a string identifying the vocabulary and type of a tokenizer."""
+    if isinstance(tokenizer, Tokenizer):
+        return tokenizer.to_str()
+    return json.dumps(
+        [type(tokenizer).__name__, sorted(tokenizer.get_vocab().items())]
+    )
+
+def token_cache_key(seqs, tokenizer, max_len, add_bos, add_eos, model_name):
+    """
+    Content address of an encoded dataset: a digest of the sequences
+    together with everything that changes their encoding.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(
+        json.dumps(
+            [model_name, int(max_len), bool(add_bos), bool(add_eos)]
+        ).encode()
+    )
+    digest.update(tokenizer_fingerprint(tokenizer).encode())
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    digest.update(lengths.tobytes())
+    for _, chunk in chunkify(seqs, 100000):
+        digest.update("".join(chunk).encode("utf-8"))
+    return digest.hexdigest()
+
+def cached_categorical_encode(
+    seqs,
+    tokenizer,
+    max_len,
+    add_bos=False,
+    add_eos=False,
+    logger=None,
+    model_name="progen2",
+    return_lengths=False,
+    **kwargs,
+):
+    """
+    `categorical_encode` backed by an on-disk cache of tokenized datasets.
+
+    Encodings are stored under `TOKEN_CACHE_DIR` (default
+    `{DATA_DIR}/.token_cache`) as an int8 token matrix and the number of
+    non-padding tokens per row, keyed by `token_cache_key`. Cache hits are
+    memory-mapped copy-on-write, so they can be shared across functions and
+    Optuna trials. Setting `TOKEN_CACHE_DIR` to an empty string disables
+    the cache.
+
+    Args:
+        return_lengths (bool): If True, also return the lengths array.
+        **kwargs: Passed on to `categorical_encode`.
+
+    Returns:
+        torch.Tensor or (torch.Tensor, torch.Tensor): The encoded sequences
+        and, optionally, their lengths.
+    """
+    cache_dir = get_token_cache_dir()
+    if not cache_dir:
+        seq_tokens = categorical_encode(
+            seqs, tokenizer, max_len, add_bos, add_eos, logger, model_name, **kwargs
+        )
+        if return_lengths:
+            pad_token = special_token_ids(tokenizer, model_name)[0]
+            return seq_tokens, (seq_tokens != pad_token).sum(dim=1, dtype=torch.int32)
+        return seq_tokens
+
+    key = token_cache_key(seqs, tokenizer, max_len, add_bos, add_eos, model_name)
+    entry = os.path.join(cache_dir, key)
+
+    if os.path.exists(os.path.join(entry, "meta.json")):
+        if logger is not None:
+            logger.log(f"Loading cached tokens from {entry}")
+        seq_tokens = torch.from_numpy(
+            np.load(os.path.join(entry, "tokens.npy"), mmap_mode="c")
+        )
+        if return_lengths:
+            return seq_tokens, torch.from_numpy(
+                np.load(os.path.join(entry, "lengths.npy"))
+            )
+        return seq_tokens
+
+    seq_tokens = categorical_encode(
+        seqs, tokenizer, max_len, add_bos, add_eos, logger, model_name, **kwargs
+    )
+    pad_token = special_token_ids(tokenizer, model_name)[0]
+    lengths = (seq_tokens != pad_token).sum(dim=1, dtype=torch.int32)
+
+    # Write to a private directory first and move it into place, so that
+    # concurrent runs never read a partially written entry
+    tmp_entry = f"{entry}.tmp-{os.getpid()}"
+    try:
+        os.makedirs(tmp_entry, exist_ok=True)
+        tokens_file = np.lib.format.open_memmap(
+            os.path.join(tmp_entry, "tokens.npy"),
+            mode="w+",
+            dtype=np.int8,
+            shape=tuple(seq_tokens.shape),
+        )
+        tokens_file[:] = seq_tokens.numpy()
+        tokens_file.flush()
+        del tokens_file
+        np.save(os.path.join(tmp_entry, "lengths.npy"), lengths.numpy())
+        with open(os.path.join(tmp_entry, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "model_name": model_name,
+                    "max_len": int(max_len),
+                    "add_bos": bool(add_bos),
+                    "add_eos": bool(add_eos),
+                    "shape": list(seq_tokens.shape),
+                },
+                f,
+            )
+        os.rename(tmp_entry, entry)
+        if logger is not None:
+            logger.log(f"Cached tokens at {entry}")
+    except OSError as e:
+        # Either another run cached the same entry first or the cache
+        # directory is not writable; the encoding is valid either way
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        if logger is not None and not os.path.exists(entry):
+            logger.log(f"Could not cache tokens at {entry}: {e}")
+
+    if return_lengths:
+        return seq_tokens, lengths
+    return seq_tokens
+
 def encode_sequence(seq, tokenizer, max_len, add_bos, add_eos, model_name):
     """Helper function to process encoding of a single sequence."""
     if "progen2" in model_name:
@@ -845,6 +1579,8 @@ def encode_sequence(seq, tokenizer, max_len, add_bos, add_eos, model_name):
     elif "esmc" in model_name:
         # ESMTokenizer automatically adds <cls> and <eos> tokens
         # We'll ensure the final tensor doesn't exceed max_len+2
+        from esm.utils import encoding
+
         tok_seq = encoding.tokenize_sequence(seq, tokenizer, add_special_tokens=True).type(torch.int8)
         return tok_seq[: max_len + 2]
     else:
@@ -1062,6 +1798,12 @@ def convert_to_number(s):
 
 def print_gpu_utilization(memory_usage, device="cuda"):
     if "cuda" in device:
+        from pynvml import (
+            nvmlDeviceGetHandleByIndex,
+            nvmlDeviceGetMemoryInfo,
+            nvmlInit,
+        )
+
         nvmlInit()
         handle = nvmlDeviceGetHandleByIndex(0)
         info = nvmlDeviceGetMemoryInfo(handle)
@@ -1135,7 +1877,14 @@ def find_mutation_positions(seq, ref, padding_id=None):
     return [i for i, (s, r) in enumerate(zip(seq, ref)) if s != r]
 
 
-def init_plm(model_name, logger, task="regression"):
+def init_plm(model_name, logger, task="regression", layers=None):
+    from plmfit.models.pretrained_models import (
+        ESMCFamily,
+        ESMFamily,
+        ProGenFamily,
+        ProteinBERTFamily,
+    )
+
     model = None
     supported_progen2 = ["progen2-small", "progen2-medium", "progen2-xlarge"]
     supported_ESM = [
@@ -1155,11 +1904,11 @@ def init_plm(model_name, logger, task="regression"):
 
     if "progen" in model_name:
         assert model_name in supported_progen2, "Progen version is not supported"
-        model = ProGenFamily(model_name, logger, task)
+        model = ProGenFamily(model_name, logger, task, layers=layers)
 
     elif "esm2" in model_name:
         assert model_name in supported_ESM, "ESM version is not supported"
-        model = ESMFamily(model_name, logger, task)
+        model = ESMFamily(model_name, logger, task, layers=layers)
     # elif "ankh" in model_name:
     #     assert model_name in supported_Ankh, "Ankh version is not supported"
     #     model = AnkhFamily(model_name)
@@ -1169,10 +1918,10 @@ def init_plm(model_name, logger, task="regression"):
         assert (
             model_name in supported_Proteinbert
         ), "ProteinBERT version is not supported"
-        model = ProteinBERTFamily(logger, task)
+        model = ProteinBERTFamily(logger, task, layers=layers)
     elif "esmc" in model_name:
         assert model_name in supported_ESMC, "ESMC version is not supported"
-        model = ESMCFamily(model_name, logger, task)
+        model = ESMCFamily(model_name, logger, task, layers=layers)
     else:
         raise "PLM not supported"
 
@@ -1186,6 +1935,8 @@ def masking_collator(
     """
     Create masked inputs for MLM from tokenized data, with boosted masking probability for specified mutations.
 
+    Works on a single sequence or on a whole padded batch, on whichever device the inputs live.
+
     Args:
     - tokenizer: The tokenizer used for tokenizing the data.
     - features (dict): A dictionary containing the encoded sequences.
@@ -1196,55 +1947,48 @@ def masking_collator(
     - dict: A dictionary containing the masked input_ids, attention_masks, and labels for MLM.
     """
     input_ids = features["input_ids"]
+    device = input_ids.device
 
     labels = input_ids.clone()  # Prepare labels for MLM
 
     # Base probability matrix for masking
-    probability_matrix = torch.full(labels.shape, mlm_probability)
+    probability_matrix = torch.full(labels.shape, mlm_probability, device=device)
 
-    # TODO fix for mut mask
     if "mutation_mask" in features:
         probability_matrix += features["mutation_mask"] * (
             mlm_probability * (mutation_boost_factor - 1)
         )
+        probability_matrix.clamp_(max=1.0)
 
     # Set probability for special tokens to 0 to avoid masking
-    special_tokens_mask = features.get(
-        "special_tokens_mask", torch.zeros_like(input_ids).bool()
-    )
-    if (
-        isinstance(special_tokens_mask, torch.Tensor)
-        and special_tokens_mask.dtype != torch.bool
-    ):
-        special_tokens_mask = special_tokens_mask.bool()
-    probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
-    random_state = get_random_state()
+    special_tokens_mask = features.get("special_tokens_mask")
+    if special_tokens_mask is not None:
+        probability_matrix.masked_fill_(special_tokens_mask.bool(), value=0.0)
+
+    # The global generator lives on the CPU, other devices use their default one
+    random_state = get_random_state() if device.type == "cpu" else None
 
     # Create mask array
     masked_indices = torch.bernoulli(probability_matrix, generator=random_state).bool()
 
-    # Apply 80-10-10 masking strategy:
-    # 80% MASK
-    indices_replaced_with_mask = (
-        torch.bernoulli(torch.full(labels.shape, 0.8), generator=random_state).bool()
-        & masked_indices
-    )
-    input_ids[indices_replaced_with_mask] = tokenizer.mask_token_id
-
-    # 10% random token
-    indices_replaced_with_random = (
-        torch.bernoulli(torch.full(labels.shape, 0.1), generator=random_state).bool()
-        & masked_indices
-        & ~indices_replaced_with_mask
+    # Apply 80-10-10 masking strategy with a single draw per position:
+    # 80% MASK, 10% random token, 10% unchanged
+    strategy = torch.rand(labels.shape, device=device, generator=random_state)
+    indices_replaced_with_mask = masked_indices & (strategy < 0.8)
+    indices_replaced_with_random = masked_indices & (strategy >= 0.8) & (strategy < 0.9)
+
+    input_ids = input_ids.masked_fill(indices_replaced_with_mask, tokenizer.mask_token_id)
+    random_tokens = torch.randint(
+        low=0,
+        high=tokenizer.vocab_size,
+        size=labels.shape,
+        device=device,
+        generator=random_state,
+        dtype=input_ids.dtype,
     )
-    random_tokens = torch.randint(low=0, high=tokenizer.vocab_size, size=labels.shape, generator=random_state)
-    input_ids[indices_replaced_with_random] = random_tokens[
-        indices_replaced_with_random
-    ]
-
-    # 10% unchanged - no action needed since indices are not masked
+    input_ids = torch.where(indices_replaced_with_random, random_tokens, input_ids)
 
-    labels[~masked_indices] = -100
+    labels.masked_fill_(~masked_indices, -100)
 
     return {
         "input_ids": input_ids,
@@ -1253,6 +1997,38 @@ def masking_collator(
     }
 
 
+class MaskedLMCollator:
+    """
+    Collates encoded sequences into a padded batch and masks the whole batch at once.
+
+    With ``on_device`` the batch is returned unmasked and ``mask`` is applied
+    after it has been moved to the accelerator (see ``LightningModel.on_after_batch_transfer``).
+    """
+
+    def __init__(
+        self, tokenizer, mlm_probability=0.15, mutation_boost_factor=6.66, on_device=False
+    ):
+        self.tokenizer = tokenizer
+        self.mlm_probability = mlm_probability
+        self.mutation_boost_factor = mutation_boost_factor
+        self.on_device = on_device
+
+    def __call__(self, items):
+        # Datasets with __getitems__ already return a stacked batch
+        if isinstance(items, dict):
+            batch = items
+        else:
+            batch = {key: torch.stack([item[key] for item in items]) for key in items[0]}
+        if self.on_device:
+            return batch
+        return self.mask(batch)
+
+    def mask(self, batch):
+        return masking_collator(
+            self.tokenizer, batch, self.mlm_probability, self.mutation_boost_factor
+        )
+
+
 class MaskedLMDataset(Dataset):
     def __init__(
         self, encodings, tokenizer, mlm_probability, mutation_boost_factor=6.66
@@ -1265,12 +2041,13 @@ class MaskedLMDataset(Dataset):
     def __len__(self):
         return len(self.encodings["input_ids"])
 
+    # Masking is left to MaskedLMCollator, which handles a whole batch at once
     def __getitem__(self, idx):
-        item = {key: val[idx].clone().detach() for key, val in self.encodings.items()}
-        masked_inputs = masking_collator(
-            self.tokenizer, item, self.mlm_probability, self.mutation_boost_factor
-        )
-        return masked_inputs
+        return {key: val[idx] for key, val in self.encodings.items()}
+
+    def __getitems__(self, indices):
+        indices = torch.as_tensor(indices)
+        return {key: val[indices] for key, val in self.encodings.items()}
 
 
 def create_mlm_data_loaders(
@@ -1280,8 +2057,12 @@ def create_mlm_data_loaders(
     mlm_probability=0.15,
     mutation_boost_factor=6.66,
     split_ratios=(0.7, 0.15, 0.15),
+    mask_on_device=False,
 ):
     dataset = MaskedLMDataset(data, tokenizer, mlm_probability, mutation_boost_factor)
+    collator = MaskedLMCollator(
+        tokenizer, mlm_probability, mutation_boost_factor, on_device=mask_on_device
+    )
 
     # Determine split sizes
     train_size = int(len(dataset) * split_ratios[0])
@@ -1297,21 +2078,39 @@ def create_mlm_data_loaders(
 
     # Create data loaders for each split
     train_loader = DataLoader(
-        train_dataset, batch_size=batch_size, shuffle=True, generator=random_state
+        train_dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        generator=random_state,
+        collate_fn=collator,
+    )
+    val_loader = DataLoader(
+        val_dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        generator=random_state,
+        collate_fn=collator,
+    )
+    test_loader = DataLoader(
+        test_dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        generator=random_state,
+        collate_fn=collator,
     )
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, generator=random_state)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, generator=random_state)
 
     return {"train": train_loader, "val": val_loader, "test": test_loader}
 
 
-def data_pipeline(dataset, split=None, weights=None, sampler=None, dev=False):
-    # Load dataset
-    dataset = load_dataset(dataset)
+def data_pipeline(
+    dataset, split=None, weights=None, sampler=None, dev=False, columns=DATASET_COLUMNS
+):
+    # Load only the needed columns, the split and weights columns included
+    if columns is not None:
+        columns = list(columns) + [name for name in [split, weights] if name is not None]
 
     # For development purposes, we can sample the dataset to speed up the process
-    if dev:
-        dataset = dataset[:100000]
+    dataset = load_dataset(dataset, columns=columns, nrows=100000 if dev else None)
 
     # This checks if args.split is set to 'sampled' and if 'sampled' is not in data, or if args.split is not a key in data.
     split = (
@@ -1326,10 +2125,25 @@ def data_pipeline(dataset, split=None, weights=None, sampler=None, dev=False):
 
     return dataset, split, weights, sampler
 
-def suggest_number_of_type(trial: Trial, name, min, max, type):
+def suggest_number_of_type(trial: "Trial", name, min, max, type):
     if type == "int":
         return trial.suggest_int(name, min, max)
     elif type == "float":
         return trial.suggest_float(name, min, max)
     else:
         raise ValueError("Type of hyperparameter not supported")
+
+
+def load_pred_data(metrics_path, report=None):
+    """
+    Load the predictions, labels and ids of a metrics report, from its `.npz`
+    sidecar or from the lists inlined by older reports.
+    """
+    if report is None:
+        with open(metrics_path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+    pred_data = report["pred_data"]
+    if "file" not in pred_data:
+        return {key: np.asarray(pred_data[key]) for key in ["preds", "actual", "ids"]}
+    with np.load(os.path.join(os.path.dirname(metrics_path), pred_data["file"])) as arrays:
+        return {key: arrays[key] for key in arrays.files}
@@ -0,0 +1,55 @@
+import copy
+import unittest
+
+import torch
+
+import plmfit.models.downstream_heads as heads
+import plmfit.shared_utils.utils as utils
+from plmfit.shared_utils.random_state import set_seed
+
+
+class TestOneHotHeads(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        self.num_classes = 21
+        self.tokens = torch.randint(0, self.num_classes, (4, 6), dtype=torch.int8)
+
+    def head_config(self, network_type, task):
+        return {
+            "architecture_parameters": {
+                "network_type": network_type,
+                "task": task,
+                "output_dim": 3,
+                "hidden_dim": 8,
+                "hidden_dropout": 0.0,
+                "hidden_activation": "relu",
+                "one_hot_classes": self.num_classes,
+                "num_layers": 1,
+                "dropout": 0.0,
+                "bidirectional": False,
+            }
+        }
+
+    def test_token_ids_match_dense_one_hot(self):
+        for network_type in ["linear", "mlp", "rnn"]:
+            for task in ["regression", "token_classification"]:
+                flatten = task != "token_classification"
+                input_dim = (
+                    self.tokens.shape[1] * self.num_classes if flatten else self.num_classes
+                )
+                model = heads.init_head(
+                    copy.deepcopy(self.head_config(network_type, task)), input_dim
+                )
+                dense = torch.stack(
+                    [
+                        utils.one_hot_encode(seq.float(), self.num_classes, flatten)
+                        for seq in self.tokens
+                    ]
+                )
+                output = model(self.tokens)
+                self.assertEqual(output.shape[-1], 3)
+                self.assertTrue(torch.allclose(output, model(dense), atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
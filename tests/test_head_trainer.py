@@ -0,0 +1,147 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import optuna
+import torch
+
+import plmfit.models.downstream_heads as heads
+import plmfit.shared_utils.utils as utils
+from plmfit.models.head_trainer import HeadTrainer
+from plmfit.models.lightning_model import LightningModel
+from plmfit.models.trial_batching import optimize_in_batches
+from plmfit.shared_utils.random_state import set_seed
+
+
+class TestHeadTrainer(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        saved = {}
+        self.logger = SimpleNamespace(
+            base_dir=self.tmp_dir.name,
+            experiment_name="test",
+            log=lambda text: None,
+            save_data=lambda data, name: saved.__setitem__(name, data),
+        )
+        self.saved = saved
+        features = torch.randn(400, 8)
+        scores = features @ torch.linspace(-1, 1, 8) + 0.5 + 0.01 * torch.randn(400)
+        self.data_loaders = utils.create_data_loaders(
+            features, scores, batch_size=32, validation_size=0.2, test_size=0.2
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def lightning_model(self, **training_params):
+        head = heads.LinearHead(
+            {"input_dim": 8, "output_dim": 1, "task": "regression", "network_type": "linear"}
+        )
+        training_params = {
+            "loss_f": "mse",
+            "learning_rate": 0.05,
+            "weight_decay": 0.0,
+            "gradient_accumulation": False,
+            "gradient_clipping": False,
+            **training_params,
+        }
+        return LightningModel(head, training_params, plmfit_logger=self.logger)
+
+    def test_ridge_matches_closed_form(self):
+        model = self.lightning_model(optimizer="ridge", weight_decay=0.02)
+        HeadTrainer(max_epochs=1).fit(model, self.data_loaders["train"], self.data_loaders["val"])
+
+        dataset = self.data_loaders["train"].dataset
+        x = dataset.fetch(torch.arange(len(dataset))).double()
+        y = dataset.tensors[0].double()
+        x = torch.cat([x, torch.ones(len(x), 1, dtype=torch.float64)], dim=1)
+        # Mean squared error plus weight_decay / 2 * |w|^2, the bias is not penalized
+        penalty = torch.eye(9, dtype=torch.float64) * 0.01
+        penalty[-1, -1] = 0
+        solution = torch.linalg.solve(x.T @ x / len(x) + penalty, x.T @ y / len(x))
+        linear = model.model.linear
+        self.assertTrue(torch.allclose(linear.weight[0].double(), solution[:-1], atol=1e-4))
+        self.assertAlmostEqual(linear.bias.item(), solution[-1].item(), places=4)
+
+    def test_fit_and_test_write_lightning_artifacts(self):
+        model = self.lightning_model(optimizer="adam", early_stopping=False)
+        trainer = HeadTrainer(max_epochs=15)
+        trainer.fit(model, self.data_loaders["train"], self.data_loaders["val"])
+
+        with open(f"{self.tmp_dir.name}/test_loss.json") as f:
+            losses = json.load(f)
+        self.assertEqual(len(losses["epoch_train_loss"]), 15)
+        self.assertLess(losses["epoch_val_loss"][-1], losses["epoch_val_loss"][0])
+        self.assertIn("report", self.saved)
+
+        ckpt_path = f"{self.tmp_dir.name}/lightning_logs/best_model.ckpt"
+        self.assertTrue(os.path.isfile(ckpt_path))
+        trainer.test(model, ckpt_path=ckpt_path, dataloaders=self.data_loaders["test"])
+        self.assertIn("rmse", self.saved["metrics"])
+        pred_data = utils.load_pred_data(f"{self.tmp_dir.name}/test_metrics.json")
+        self.assertEqual(len(pred_data["ids"]), len(self.data_loaders["test"].dataset))
+
+    def test_batched_trials_report_to_their_own_trials(self):
+        study = optuna.create_study(
+            direction="minimize",
+            pruner=optuna.pruners.NopPruner(),
+            sampler=optuna.samplers.RandomSampler(seed=0),
+        )
+        finished = []
+
+        def build_trial(trial):
+            learning_rate = trial.suggest_float("learning_rate", 1e-4, 1e-1, log=True)
+            return {
+                "model": self.lightning_model(optimizer="adam", learning_rate=learning_rate),
+                "data_loaders": self.data_loaders,
+                "epochs": 10,
+                "epoch_sizing": 1.0,
+                "patience": -1,
+            }
+
+        optimize_in_batches(
+            study,
+            build_trial,
+            n_trials=6,
+            trials_per_batch=3,
+            callbacks=[lambda study, trial: finished.append(trial.number)],
+        )
+        self.assertEqual(finished, list(range(6)))
+        trials = study.get_trials(states=(optuna.trial.TrialState.COMPLETE,))
+        self.assertEqual(len(trials), 6)
+        for trial in trials:
+            self.assertEqual(len(trial.intermediate_values), 10)
+        # Each trial follows its own learning rate, the fastest one fits best
+        fastest = max(trials, key=lambda trial: trial.params["learning_rate"])
+        self.assertEqual(study.best_trial.number, fastest.number)
+
+    def test_batched_trials_are_pruned_individually(self):
+        study = optuna.create_study(
+            direction="minimize",
+            pruner=optuna.pruners.ThresholdPruner(upper=0.5),
+        )
+
+        def build_trial(trial):
+            learning_rate = trial.suggest_categorical("learning_rate", [1e-5, 1e-1])
+            return {
+                "model": self.lightning_model(optimizer="adam", learning_rate=learning_rate),
+                "data_loaders": self.data_loaders,
+                "epochs": 10,
+                "epoch_sizing": 1.0,
+                "patience": -1,
+            }
+
+        study.enqueue_trial({"learning_rate": 1e-5})
+        study.enqueue_trial({"learning_rate": 1e-1})
+        optimize_in_batches(study, build_trial, n_trials=2, trials_per_batch=2)
+        slow, fast = study.trials
+        self.assertEqual(slow.state, optuna.trial.TrialState.PRUNED)
+        self.assertEqual(fast.state, optuna.trial.TrialState.COMPLETE)
+        self.assertEqual(len(fast.intermediate_values), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import pickle
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+
+import plmfit.shared_utils.utils as utils
+from plmfit.models.lightning_model import LightningModel, Metrics, ShardedPredictionWriter
+
+
+class TestShardedPredictionWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.logger = SimpleNamespace(
+            base_dir=self.tmp_dir.name, experiment_name="test", log=lambda text: None
+        )
+        self.trainer = SimpleNamespace(global_rank=0)
+        self.embeddings = torch.randn(10, 3)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, writer, indices, batch_size=3):
+        for i in range(0, len(indices), batch_size):
+            batch_indices = indices[i : i + batch_size]
+            writer.write_on_batch_end(
+                self.trainer, None, self.embeddings[batch_indices], batch_indices, None, i, 0
+            )
+
+    def test_resume_skips_completed_shards(self):
+        writer = ShardedPredictionWriter(self.logger, shard_size=4)
+        # Interrupted run: one complete shard and an unfinished one
+        self.write(writer, [7, 2, 9, 0, 5, 1])
+
+        writer = ShardedPredictionWriter(self.logger, shard_size=4)
+        pending = writer.pending_indices(10)
+        self.assertEqual(pending, [1, 3, 4, 5, 6, 8])
+        self.write(writer, pending)
+        writer.on_predict_epoch_end(self.trainer, None)
+
+        self.assertEqual(writer.pending_indices(10), [])
+        self.assertEqual(
+            [shard["rows"] for shard in utils.read_shard_manifests(writer.output_dir)],
+            [4, 4, 2],
+        )
+        embeddings = utils.load_embedding_shards(writer.output_dir)
+        self.assertNotIsInstance(embeddings, torch.Tensor)
+        self.assertEqual(embeddings.shape, (10, 3))
+        self.assertTrue(torch.equal(torch.from_numpy(embeddings[:]), self.embeddings))
+        self.assertTrue(
+            torch.equal(
+                utils.load_embedding_shards(writer.output_dir, materialize=True), self.embeddings
+            )
+        )
+
+    def test_unfinished_extraction_does_not_load(self):
+        writer = ShardedPredictionWriter(self.logger, shard_size=4)
+        writer.pending_indices(10)
+        # Every sample but the last one, whose absence the written indices cannot show
+        self.write(writer, [0, 1, 2, 3, 4, 5, 6, 7, 8])
+        writer.on_predict_epoch_end(self.trainer, None)
+        with self.assertRaisesRegex(ValueError, "1 of 10 samples are missing"):
+            utils.load_embedding_shards(writer.output_dir)
+
+        writer = ShardedPredictionWriter(self.logger, shard_size=4)
+        self.write(writer, writer.pending_indices(10))
+        writer.on_predict_epoch_end(self.trainer, None)
+        self.assertEqual(len(utils.load_embedding_shards(writer.output_dir)), 10)
+
+    def test_shards_are_read_lazily_by_the_datasets(self):
+        writer = ShardedPredictionWriter(self.logger, shard_size=4)
+        self.write(writer, [7, 2, 9, 0, 5, 1, 3, 4, 6, 8])
+        writer.on_predict_epoch_end(self.trainer, None)
+        embeddings = pickle.loads(pickle.dumps(utils.load_embedding_shards(writer.output_dir)))
+
+        rows = [8, 0, 7, 0]
+        self.assertTrue(torch.equal(torch.from_numpy(embeddings[rows]), self.embeddings[rows]))
+        for index in [-1, 3, slice(1, None, 3), slice(-4, -1), [-2, 1]]:
+            self.assertTrue(
+                torch.equal(torch.from_numpy(embeddings[index]), self.embeddings[index])
+            )
+        with self.assertRaises(IndexError):
+            embeddings[[10]]
+        dataset = utils.IndexedDataset(embeddings, rows, dtype=torch.float32)
+        self.assertTrue(torch.equal(dataset.fetch(torch.arange(4)), self.embeddings[rows]))
+
+
+class TestSharedStep(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.input = torch.randn(8, 4)
+
+    def lightning_model(self, task, out_features, **training_config):
+        head = torch.nn.Linear(4, out_features)
+        head.task = task
+        return LightningModel(head, training_config)
+
+    def test_multiclass_uses_class_indices(self):
+        model = self.lightning_model("classification", 3, loss_f="cross_entropy", no_classes=3)
+        labels = torch.randint(0, 3, (8,)).half()
+        loss, outputs, step_labels = model.shared_step((self.input, labels))
+
+        one_hot = F.one_hot(labels.long(), num_classes=3).float()
+        self.assertTrue(torch.allclose(loss, F.cross_entropy(model.model(self.input), one_hot)))
+        self.assertTrue(torch.equal(step_labels, labels.long()))
+        self.assertTrue(
+            torch.equal(model.metric_outputs(outputs), model.model(self.input).argmax(dim=1))
+        )
+
+    def test_regression_squeezes_outputs(self):
+        model = self.lightning_model("regression", 1, loss_f="mse")
+        labels = torch.randn(8)
+        loss, outputs, _ = model.shared_step((self.input, labels, torch.arange(8)))
+        self.assertEqual(outputs.shape, labels.shape)
+        self.assertTrue(torch.allclose(loss, F.mse_loss(model.model(self.input).squeeze(1), labels)))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = f"{self.tmp_dir.name}/test"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_token_classification_batches_of_different_widths(self):
+        metrics = Metrics("token_classification", no_classes=3)
+        metrics.add(torch.tensor([[0, 1, 2]]), torch.tensor([[0, 1, 1]]), torch.tensor([4]))
+        metrics.add(
+            torch.tensor([[2, 2], [1, 0]]), torch.tensor([[2, -100], [1, 0]]), torch.tensor([7, 9])
+        )
+        report = metrics.get_metrics()
+        # 5 of the 6 labelled tokens are right
+        self.assertAlmostEqual(report["main"]["micro_accuracy"], 5 / 6, places=5)
+        metrics.save_metrics(self.path)
+
+        pred_data = utils.load_pred_data(f"{self.path}_metrics.json")
+        self.assertEqual(pred_data["ids"].tolist(), [4, 7, 9])
+        self.assertEqual(pred_data["actual"].tolist(), [[0, 1, 1], [2, -100, -100], [1, 0, -100]])
+
+    def test_reports_are_appended(self):
+        for ids in [torch.tensor([0, 1]), torch.tensor([2, 3])]:
+            metrics = Metrics("regression")
+            metrics.add(ids.float(), ids.float() * 2, ids)
+            metrics.get_metrics()
+            metrics.save_metrics(self.path)
+
+        pred_data = utils.load_pred_data(f"{self.path}_metrics.json")
+        self.assertEqual(pred_data["ids"].tolist(), [0, 1, 2, 3])
+        self.assertEqual(pred_data["actual"].tolist(), [0.0, 2.0, 4.0, 6.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 from unittest.mock import patch, mock_open, MagicMock
+import subprocess
 import sys
 
 import plmfit.__main__ as plmfit_main
@@ -58,7 +59,40 @@ class TestPLMFitMainInvocation(unittest.TestCase):
             mock_run.assert_called_once()
             self.mock_makedirs.assert_any_call('/fake/dir', exist_ok=True)
 
-    
+
+
+# Imported by the entry point and by utils only when a function needs them
+HEAVY_MODULES = [
+    'antiberty', 'blosum', 'deepspeed', 'esm', 'lightning', 'matplotlib',
+    'optuna', 'seaborn', 'sklearn', 'transformers',
+]
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = {heavy}
+print(elapsed, ','.join(m for m in heavy if m in sys.modules))
+"""
+
+class TestStartup(unittest.TestCase):
+    def import_in_subprocess(self, module, heavy=HEAVY_MODULES):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT.format(module=module, heavy=heavy)],
+            capture_output=True, text=True, check=True,
+        ).stdout.split()
+        return float(output[0]), output[1].split(',') if len(output) > 1 else []
+
+    def test_entry_point_starts_under_a_second(self):
+        # Every job of a SLURM array pays this before parsing its arguments
+        elapsed, loaded = self.import_in_subprocess('plmfit.__main__', HEAVY_MODULES + ['torch'])
+        self.assertEqual(loaded, [])
+        self.assertLess(elapsed, 1.0)
+
+    def test_utils_does_not_import_backends(self):
+        _, loaded = self.import_in_subprocess('plmfit.shared_utils.utils')
+        self.assertEqual(loaded, [])
+
 
 if __name__ == '__main__':
     unittest.main()
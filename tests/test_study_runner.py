@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from functools import partial
+
+import numpy as np
+import optuna
+from optuna.storages import JournalStorage
+from optuna.storages.journal import JournalFileBackend
+
+from plmfit.shared_utils.embedding_store import EmbeddingStore
+from plmfit.shared_utils.study_runner import optimize_in_processes, worker_resources
+
+
+def quadratic_objective(trial, features):
+    x = trial.suggest_float("x", -1, 1)
+    trial.set_user_attr("pid", os.getpid())
+    trial.set_user_attr("store", isinstance(features, EmbeddingStore))
+    return float((x - features[0, 0]) ** 2)
+
+
+class TestStudyRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_worker_resources_split_the_cpus(self):
+        resources = worker_resources(2, devices=[0, 1, 2])
+        self.assertEqual([device for device, _ in resources], [0, 1])
+        cpus = [set(cpus) for _, cpus in resources]
+        if len(os.sched_getaffinity(0)) > 1:
+            self.assertFalse(cpus[0] & cpus[1])
+
+    def test_workers_share_the_journal(self):
+        features = EmbeddingStore.write(
+            f"{self.tmp_dir.name}/features.emb", np.full((4, 2), 0.5, dtype=np.float32)
+        )
+        storage = JournalStorage(JournalFileBackend(f"{self.tmp_dir.name}/journal.log"))
+        study = optuna.create_study(study_name="test", storage=storage)
+        optimize_in_processes(
+            study, partial(quadratic_objective, features=features), n_trials=5, n_processes=2
+        )
+
+        trials = study.get_trials(states=(optuna.trial.TrialState.COMPLETE,))
+        self.assertEqual(len(trials), 5)
+        self.assertEqual(len({trial.user_attrs["pid"] for trial in trials}), 2)
+        self.assertNotIn(os.getpid(), {trial.user_attrs["pid"] for trial in trials})
+        self.assertTrue(all(trial.user_attrs["store"] for trial in trials))
+        self.assertEqual(len({trial.params["x"] for trial in trials}), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,551 @@
+import copy
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import blosum as bl
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.preprocessing import StandardScaler
+from transformers import EsmConfig
+
+import plmfit.shared_utils.utils as utils
+from plmfit.language_models.esm.modeling_esm import PlmfitEsmForEmbdeddingsExtraction
+from plmfit.language_models.progen2.models.progen.configuration_progen import ProGenConfig
+from plmfit.language_models.progen2.models.progen.modeling_progen import (
+    ProGenForEmbeddingsExtraction,
+)
+from plmfit.shared_utils.embedding_store import EmbeddingStore
+from plmfit.shared_utils.poolers import GeneralPooler, masked_mean
+from plmfit.shared_utils.random_state import set_seed
+from plmfit.shared_utils.samplers import (
+    LabelWeightedBatchSampler,
+    LabelWeightedSampler,
+    LengthBucketSampler,
+)
+
+
+def serial_categorical_encode(seqs, tokenizer, max_len, add_bos, add_eos, model_name):
+    internal_max_len = max_len + int(add_bos) + int(add_eos)
+    pad_token = utils.special_token_ids(tokenizer, model_name)[0]
+    seq_tokens = torch.full((len(seqs), internal_max_len), pad_token, dtype=torch.int8)
+    for i, seq in enumerate(seqs):
+        encoded_seq = utils.encode_sequence(seq, tokenizer, max_len, add_bos, add_eos, model_name)
+        seq_tokens[i, : len(encoded_seq)] = encoded_seq
+    return seq_tokens
+
+
+class TestCategoricalEncode(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        aas = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+        self.seqs = [
+            "".join(rng.choice(aas, size=rng.integers(0, 30))) for _ in range(200)
+        ]
+        # Characters outside the vocabulary go through the tokenizer itself
+        self.seqs += ["ACJJD", "AC DE", "acd", "AÄC", "X" * 40, ""]
+
+    def test_matches_serial_encoding(self):
+        for model_name in ["progen2", "proteinbert"]:
+            tokenizer = utils.load_tokenizer(model_name)
+            for add_bos, add_eos in [(False, False), (True, True), (True, False)]:
+                expected = serial_categorical_encode(
+                    self.seqs, tokenizer, 25, add_bos, add_eos, model_name
+                )
+                encoded = utils.categorical_encode(
+                    np.array(self.seqs, dtype=object),
+                    tokenizer,
+                    25,
+                    add_bos=add_bos,
+                    add_eos=add_eos,
+                    model_name=model_name,
+                    chunk_size=64,
+                )
+                self.assertTrue(torch.equal(encoded, expected))
+
+    def test_parallel_matches_serial(self):
+        tokenizer = utils.load_tokenizer("progen2")
+        serial = utils.categorical_encode(
+            self.seqs, tokenizer, 25, add_bos=True, add_eos=True, chunk_size=64
+        )
+        parallel = utils.categorical_encode(
+            self.seqs, tokenizer, 25, add_bos=True, add_eos=True, chunk_size=64, num_workers=2
+        )
+        self.assertTrue(torch.equal(serial, parallel))
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.patcher_env = patch.dict(os.environ, {"TOKEN_CACHE_DIR": self.tmp_dir.name})
+        self.patcher_env.start()
+        self.tokenizer = utils.load_tokenizer("progen2")
+        self.seqs = ["ACDEFG", "MKV", "WYYWAAC"]
+
+    def tearDown(self):
+        self.patcher_env.stop()
+        self.tmp_dir.cleanup()
+
+    def test_cache_roundtrip(self):
+        tokens, lengths = utils.cached_categorical_encode(
+            self.seqs, self.tokenizer, 7, add_bos=True, add_eos=True, return_lengths=True
+        )
+        self.assertEqual(len(os.listdir(self.tmp_dir.name)), 1)
+        self.assertEqual(lengths.tolist(), [8, 5, 9])
+
+        with patch.object(utils, "categorical_encode") as mock_encode:
+            cached_tokens, cached_lengths = utils.cached_categorical_encode(
+                self.seqs, self.tokenizer, 7, add_bos=True, add_eos=True, return_lengths=True
+            )
+            mock_encode.assert_not_called()
+        self.assertTrue(torch.equal(tokens, cached_tokens))
+        self.assertTrue(torch.equal(lengths, cached_lengths))
+
+    def test_key_depends_on_encoding_options(self):
+        key = utils.token_cache_key(self.seqs, self.tokenizer, 7, True, True, "progen2")
+        self.assertNotEqual(
+            key, utils.token_cache_key(self.seqs, self.tokenizer, 7, True, False, "progen2")
+        )
+        self.assertNotEqual(
+            key, utils.token_cache_key(self.seqs, self.tokenizer, 8, True, True, "progen2")
+        )
+        self.assertNotEqual(
+            key, utils.token_cache_key(self.seqs[::-1], self.tokenizer, 7, True, True, "progen2")
+        )
+
+
+class TestBlosum62Encode(unittest.TestCase):
+    def setUp(self):
+        self.seqs = ["ACDW", "MKVJU*", "a"]
+        self.blosum62 = bl.BLOSUM(62)
+
+    def test_pairwise_scores(self):
+        encs = utils.blosum62_encode(self.seqs, pad_to_length=6, chunk_size=2)
+        self.assertEqual(encs.shape, (3, 6, 6))
+        for n, seq in enumerate(self.seqs):
+            for i in range(6):
+                for j in range(6):
+                    expected = (
+                        self.blosum62[seq[i]].get(seq[j], 0)
+                        if i < len(seq) and j < len(seq)
+                        else 0
+                    )
+                    self.assertEqual(encs[n, i, j].item(), expected)
+
+    def test_profile_scores(self):
+        encs = utils.blosum62_profile_encode(self.seqs, pad_to_length=6)
+        self.assertEqual(encs.shape, (3, 6, 20))
+        expected = [
+            self.blosum62["W"].get(aa, 0) for aa in utils.BLOSUM62_PROFILE_RESIDUES
+        ]
+        self.assertEqual(encs[0, 3].tolist(), expected)
+        self.assertFalse(encs[0, 4:].any())
+
+    def test_memory_mapped_output(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "blosum62.npy")
+            encs = utils.blosum62_encode(self.seqs, pad_to_length=6, out=path)
+            self.assertTrue(torch.equal(encs, utils.blosum62_encode(self.seqs, 6)))
+            self.assertEqual(np.load(path).shape, (3, 6, 6))
+
+    def test_embedding_store_output(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = EmbeddingStore.create(os.path.join(tmp_dir, "blosum62.emb"), (3, 36), np.int8)
+            utils.blosum62_encode(self.seqs, pad_to_length=6, out=store.array.reshape(3, 6, 6))
+            store.flush()
+            store = EmbeddingStore(store.path)
+            self.assertTrue(
+                torch.equal(
+                    torch.from_numpy(store[:]), utils.blosum62_encode(self.seqs, 6).reshape(3, -1)
+                )
+            )
+
+
+class TestEmbeddingStore(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "embs.emb")
+        self.embeddings = torch.randn(50, 8, dtype=torch.float16)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_roundtrip_keeps_dtype_and_metadata(self):
+        EmbeddingStore.write(self.path, self.embeddings, model="esm2_t6_8M_UR50D", layer="last")
+        store = utils.load_embeddings(emb_path=self.path)
+        self.assertIsInstance(store, EmbeddingStore)
+        self.assertEqual(store.shape, (50, 8))
+        self.assertEqual(store.dtype, np.float16)
+        self.assertEqual(store.metadata, {"model": "esm2_t6_8M_UR50D", "layer": "last"})
+        self.assertTrue(torch.equal(torch.from_numpy(np.array(store[:])), self.embeddings))
+
+    def test_loaders_index_into_store(self):
+        store = EmbeddingStore.write(self.path, self.embeddings)
+        scores = np.arange(50, dtype=np.float32)
+        split = np.array(["train"] * 30 + ["validation"] * 10 + ["test"] * 10)
+        data_loaders = utils.create_data_loaders(
+            store, scores, split=split, batch_size=7, scaler=True, dtype=torch.float32
+        )
+        train = data_loaders["train"].dataset
+        self.assertIs(train.features, store)
+        self.assertEqual(sorted(train.indices.tolist()), list(range(30)))
+
+        expected = self.embeddings.float()
+        expected = (expected - expected[:30].mean(dim=0)) / expected[:30].std(dim=0, unbiased=False)
+        for features, batch_scores, ids in data_loaders["test"]:
+            rows = batch_scores.long()
+            self.assertTrue(torch.allclose(features, expected[rows], atol=1e-4))
+
+    def test_missing_embeddings_raise(self):
+        with self.assertRaises(FileNotFoundError):
+            utils.load_embeddings(emb_path=os.path.join(self.tmp_dir.name, "missing.pt"))
+
+
+class TestIndexedSplits(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        self.features = torch.randn(40, 5)
+        self.scores = np.arange(40, dtype=np.float32)
+        self.weights = np.where(np.arange(40) % 4 == 0, 0.75, 0.25)
+
+    def test_splits_share_the_base_tensor(self):
+        data_loaders = utils.create_data_loaders(
+            self.features, self.scores, batch_size=8, weights=self.weights, dtype=torch.float32
+        )
+        datasets = [data_loaders[name].dataset for name in ["train", "val", "test"]]
+        for dataset in datasets:
+            self.assertIs(dataset.features, self.features)
+        indices = torch.cat([dataset.indices for dataset in datasets])
+        self.assertEqual(sorted(indices.tolist()), list(range(40)))
+
+        for features, scores, weights in data_loaders["train"]:
+            rows = scores.long()
+            self.assertTrue(torch.equal(features, self.features[rows]))
+            self.assertTrue(torch.equal(weights, torch.tensor(self.weights[rows.numpy()], dtype=torch.float16)))
+
+    def test_scaler_is_fitted_on_train_split(self):
+        split = np.array(["train"] * 30 + ["validation"] * 5 + ["test"] * 5)
+        data_loaders = utils.create_data_loaders(
+            self.features.numpy(), self.scores, split=split, scaler=True, dtype=torch.float32
+        )
+        scaler = StandardScaler().fit(self.features[:30].numpy())
+        expected = torch.tensor(scaler.transform(self.features.numpy()), dtype=torch.float32)
+        for features, scores in data_loaders["val"]:
+            self.assertTrue(torch.allclose(features, expected[scores.long()], atol=1e-5))
+
+    def test_split_datasets_are_shared_across_batch_sizes(self):
+        datasets = utils.split_datasets(
+            self.features, self.scores, scaler=True, weights=self.weights, sampler=True
+        )
+        with patch.object(utils, "fit_standard_scaler") as fit_standard_scaler:
+            for batch_size in [4, 8]:
+                data_loaders = utils.build_data_loaders(
+                    **datasets, batch_size=batch_size, sampler=True
+                )
+                self.assertIs(data_loaders["train"].dataset, datasets["train_dataset"])
+                self.assertEqual(data_loaders["val"].batch_sampler.batch_size, batch_size)
+        fit_standard_scaler.assert_not_called()
+
+
+class TestLoadDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "toy_data_full.csv")
+        pd.DataFrame(
+            {
+                "aa_seq": ["ACD", "MK", "WYV", "GG"],
+                "len": [3, 2, 3, 2],
+                "score": [0.1, 0.2, 0.3, 0.4],
+                "label_a": [0, 1, 0, 1],
+                "label_b": [1, 1, 0, 0],
+                "is_label_x": [1, 0, 0, 1],
+                "notes": ["x", "y", "z", "w"],
+                "mut_mask": ["[0]", "[]", "[1, 2]", "[]"],
+                "sampled": ["train", "train", "validation", "test"],
+            }
+        ).to_csv(self.path, index=False)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_column_projection_and_row_limit(self):
+        data = utils.load_dataset(self.path, columns=["aa_seq", "score", "label_*"], nrows=3)
+        self.assertEqual(list(data.columns), ["aa_seq", "score", "label_a", "label_b"])
+        self.assertEqual(data["aa_seq"].tolist(), ["ACD", "MK", "WYV"])
+
+    def test_label_columns_match_the_default_projection(self):
+        data, _, _, _ = utils.data_pipeline(self.path)
+        self.assertNotIn("is_label_x", data.columns)
+        # Multilabel scores are selected with the same prefix rule
+        self.assertEqual(
+            utils.select_columns(utils.load_dataset(self.path).columns, ["label_*"]),
+            ["label_a", "label_b"],
+        )
+
+    def test_data_pipeline_keeps_split_column(self):
+        data, split, weights, sampler = utils.data_pipeline(self.path, split="sampled")
+        self.assertNotIn("notes", data.columns)
+        self.assertEqual(data["mut_mask"].tolist(), ["[0]", "[]", "[1, 2]", "[]"])
+        self.assertEqual(split.tolist(), ["train", "train", "validation", "test"])
+
+    @unittest.skipIf(utils.pq is None, "pyarrow is not installed")
+    def test_parquet_cache(self):
+        utils.load_dataset(self.path)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir.name, "toy_data_full.parquet")))
+        data = utils.load_dataset(self.path, columns=["len"], nrows=2)
+        self.assertEqual(data["len"].tolist(), [3, 2])
+
+
+class TestMaskedLMCollator(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        self.tokenizer = SimpleNamespace(mask_token_id=32, vocab_size=33)
+        input_ids = torch.randint(4, 24, (64, 130))
+        special_tokens_mask = torch.zeros_like(input_ids)
+        special_tokens_mask[:, [0, -1]] = 1
+        mutation_mask = torch.zeros_like(input_ids)
+        mutation_mask[:, 5] = 1
+        self.encodings = {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "special_tokens_mask": special_tokens_mask,
+            "mutation_mask": mutation_mask,
+        }
+
+    def test_batch_masking_policy(self):
+        dataset = utils.MaskedLMDataset(self.encodings, self.tokenizer, 0.15)
+        collator = utils.MaskedLMCollator(self.tokenizer, 0.15, 1.0 / 0.15)
+        batch = collator(dataset.__getitems__(list(range(len(dataset)))))
+        original = self.encodings["input_ids"]
+
+        masked = batch["labels"] != -100
+        self.assertTrue(torch.equal(batch["labels"][masked], original[masked]))
+        self.assertFalse(masked[:, [0, -1]].any())
+        # Mutated positions are always masked
+        self.assertTrue(masked[:, 5].all())
+        self.assertTrue(torch.equal(batch["input_ids"][~masked], original[~masked]))
+
+        replaced = (batch["input_ids"] == self.tokenizer.mask_token_id)[masked].float().mean()
+        unchanged = (batch["input_ids"] == original)[masked].float().mean()
+        self.assertAlmostEqual(replaced.item(), 0.8, delta=0.05)
+        self.assertGreater(unchanged.item(), 0.05)
+        # Encodings are left untouched for the next epoch
+        self.assertFalse((original == self.tokenizer.mask_token_id).any())
+
+    def test_deferred_masking(self):
+        dataset = utils.MaskedLMDataset(self.encodings, self.tokenizer, 0.15)
+        collator = utils.MaskedLMCollator(self.tokenizer, 0.15, on_device=True)
+        batch = collator([dataset[i] for i in range(4)])
+        self.assertNotIn("labels", batch)
+        self.assertIn("labels", collator.mask(batch))
+
+
+class TestLabelWeightedSampler(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        # Imbalanced weights, one value per class
+        self.weights = torch.cat([torch.full((900,), 0.1), torch.full((100,), 0.9)])
+
+    def test_generator_is_honoured(self):
+        table, values = utils.label_index_table(self.weights)
+        draws = []
+        for _ in range(2):
+            torch.manual_seed(1)
+            sampler = LabelWeightedSampler(
+                values, num_samples=200, generator=torch.Generator().manual_seed(0), table=table
+            )
+            draws.append(sampler.draw())
+        self.assertTrue(torch.equal(draws[0], draws[1]))
+        self.assertIs(utils.label_index_table(self.weights.clone())[0], table)
+
+    def test_batches_follow_label_weights(self):
+        features = torch.arange(1000, dtype=torch.float32).unsqueeze(1)
+        dataset = utils.IndexedDataset(features, torch.arange(1000), self.weights)
+        sampler = utils.init_weighted_sampler(
+            dataset, self.weights, num_samples_method="min_weighted", sampler="label_weighted"
+        )
+        self.assertEqual(len(sampler), 200)
+        batches = list(LabelWeightedBatchSampler(sampler, batch_size=64))
+        self.assertEqual([len(batch) for batch in batches], [64, 64, 64, 8])
+        self.assertTrue(all(torch.is_tensor(batch) for batch in batches))
+        # Class probabilities follow the label weights: 0.1 / (0.1 + 0.9)
+        draws = torch.cat([sampler.draw() for _ in range(50)])
+        self.assertAlmostEqual((draws < 900).float().mean().item(), 0.1, delta=0.02)
+
+
+class TestLengthBucketing(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        self.lengths = torch.randint(1, 30, (103,))
+        self.tokens = torch.zeros((103, 31), dtype=torch.int8)
+        for i, length in enumerate(self.lengths):
+            self.tokens[i, :length] = torch.randint(5, 20, (length,))
+
+    def test_sampler_yields_every_index_once(self):
+        sampler = LengthBucketSampler(self.lengths, batch_size=8, bucket_size_multiplier=4, shuffle=True)
+        self.assertEqual(sorted(sampler), list(range(103)))
+
+    def test_batches_are_trimmed(self):
+        scores = torch.rand(103)
+        loader = utils.create_predict_data_loader(self.tokens, batch_size=8, pad_token=0)
+        seen = []
+        for (batch,) in loader:
+            self.assertEqual(batch.shape[1], (batch != 0).sum(dim=1).max().item())
+            seen.append(batch)
+        self.assertLess(sum(b.numel() for b in seen), self.tokens.numel())
+
+        data_loaders = utils.create_data_loaders(
+            self.tokens, scores, batch_size=8, dtype=torch.int8, pad_token=0
+        )
+        for tokens, batch_scores in data_loaders["train"]:
+            self.assertEqual(tokens.shape[1], (tokens != 0).sum(dim=1).max().item())
+            self.assertEqual(batch_scores.dim(), 1)
+
+
+class TestPooling(unittest.TestCase):
+    def test_mean_ignores_padding(self):
+        hidden_states = torch.randn(2, 5, 3)
+        attention_mask = torch.tensor([[1, 1, 1, 0, 0], [1, 1, 1, 1, 1]])
+        pooled = GeneralPooler()(hidden_states, "mean", attention_mask=attention_mask)
+        self.assertTrue(torch.allclose(pooled[0], hidden_states[0, :3].mean(dim=0)))
+        self.assertTrue(torch.allclose(pooled[1], hidden_states[1].mean(dim=0)))
+
+    def test_reductions_match_per_sequence_loop(self):
+        hidden_states = torch.randn(3, 6, 4)
+        lengths = [6, 2, 4]
+        attention_mask = torch.tensor([[1] * n + [0] * (6 - n) for n in lengths])
+        pooler = GeneralPooler()
+        for reduction, reduce in [
+            ("sum", lambda h: h.sum(dim=0)),
+            ("max", lambda h: h.max(dim=0).values),
+            ("eos", lambda h: h[-1]),
+            ("bos", lambda h: h[0]),
+            ("norm_weighted_mean", lambda h: (h * torch.softmax(h.norm(dim=-1), 0)[:, None]).sum(0)),
+            (1, lambda h: h[1]),
+        ]:
+            pooled = pooler(hidden_states, reduction, attention_mask=attention_mask)
+            for i, n in enumerate(lengths):
+                self.assertTrue(torch.allclose(pooled[i], reduce(hidden_states[i, :n]), atol=1e-6))
+
+    def test_eos_gathers_the_eos_token(self):
+        hidden_states = torch.randn(3, 6, 4)
+        # A padded row, a full row and a row truncated before its eos token (2)
+        input_ids = torch.tensor(
+            [[0, 5, 6, 2, 1, 1], [0, 5, 6, 7, 8, 2], [0, 5, 6, 7, 8, 9]]
+        )
+        pooler = GeneralPooler(eos_token_id=2)
+        pooled = pooler(
+            hidden_states, "eos", attention_mask=input_ids != 1, input_ids=input_ids
+        )
+        self.assertTrue(torch.equal(pooled[0], hidden_states[0, 3]))
+        self.assertTrue(torch.equal(pooled[1], hidden_states[1, 5]))
+        # Without an eos token the last token is taken
+        self.assertTrue(torch.equal(pooled[2], hidden_states[2, 5]))
+
+        input_ids[0, 4:] = 7  # Residues after the eos token are not taken
+        pooled = pooler(hidden_states, "eos", input_ids=input_ids)
+        self.assertTrue(torch.equal(pooled[0], hidden_states[0, 3]))
+
+    def test_multi_layer_matches_trimmed_models(self):
+        set_seed(0)
+        config = EsmConfig(
+            vocab_size=33,
+            hidden_size=16,
+            num_hidden_layers=3,
+            num_attention_heads=2,
+            intermediate_size=32,
+            pad_token_id=1,
+            position_embedding_type="rotary",
+            emb_layer_norm_before=False,
+        )
+        model = PlmfitEsmForEmbdeddingsExtraction(config).eval()
+        input_ids = torch.tensor([[0, 5, 6, 7, 2, 1], [0, 8, 9, 10, 11, 2]])
+        reductions = ["mean", "eos", 2]
+
+        multi = copy.deepcopy(model)
+        multi.layers = [0, 2]
+        multi.reduction = reductions
+        with torch.no_grad():
+            pooled = multi(input_ids).logits
+        self.assertEqual(pooled.shape, (2, 6, 16))
+
+        for i, layer in enumerate(multi.layers):
+            trimmed = copy.deepcopy(model)
+            trimmed.trim_model(layer)
+            for j, reduction in enumerate(reductions):
+                trimmed.reduction = reduction
+                with torch.no_grad():
+                    expected = trimmed(input_ids).logits
+                self.assertTrue(
+                    torch.allclose(pooled[:, i * len(reductions) + j], expected, atol=1e-6)
+                )
+
+    def test_progen_multi_layer_keeps_only_pooled_layers(self):
+        set_seed(0)
+        config = ProGenConfig(
+            vocab_size=32,
+            n_positions=16,
+            n_ctx=16,
+            n_embd=32,
+            n_layer=3,
+            n_head=8,
+            rotary_dim=4,
+            pad_token_id=0,
+        )
+        model = ProGenForEmbeddingsExtraction(config).eval()
+        input_ids = torch.tensor([[3, 5, 6, 7, 4, 0], [3, 8, 9, 10, 11, 4]])
+        with torch.no_grad():
+            expected = model(input_ids, output_hidden_states=True).hidden_states
+
+        model.layers = [0, 2]
+        model.reduction = ["mean"]
+        with torch.no_grad():
+            output = model(input_ids)
+        # Neither the hidden states of every layer nor the attentions are returned
+        self.assertIsNone(output.hidden_states)
+        self.assertIsNone(output.attentions)
+        self.assertIsNone(output.past_key_values)
+        attention_mask = input_ids != 0
+        for i, hidden_states in enumerate(
+            [model.transformer.ln_f(expected[1]), expected[3]]
+        ):
+            self.assertTrue(
+                torch.allclose(
+                    output.logits[:, i], masked_mean(hidden_states, attention_mask), atol=1e-5
+                )
+            )
+
+    def test_progen_partial_load_matches_trimmed_model(self):
+        set_seed(0)
+        config = ProGenConfig(
+            vocab_size=32,
+            n_positions=16,
+            n_ctx=16,
+            n_embd=32,
+            n_layer=4,
+            n_head=8,
+            rotary_dim=4,
+            pad_token_id=0,
+        )
+        model = ProGenForEmbeddingsExtraction(config).eval()
+        input_ids = torch.tensor([[3, 5, 6, 7, 4, 0], [3, 8, 9, 10, 11, 4]])
+        with tempfile.TemporaryDirectory() as checkpoint:
+            model.save_pretrained(checkpoint)
+            partial = ProGenForEmbeddingsExtraction.from_pretrained(
+                checkpoint, n_layer=2, low_cpu_mem_usage=True
+            ).eval()
+        self.assertEqual(len(partial.transformer.h), 2)
+
+        model.trim_model(1)
+        for name, parameter in model.state_dict().items():
+            self.assertTrue(torch.equal(partial.state_dict()[name], parameter))
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(partial(input_ids).logits, model(input_ids).logits))
+
+
+if __name__ == "__main__":
+    unittest.main()
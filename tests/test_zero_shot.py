@@ -0,0 +1,229 @@
+import io
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+
+import plmfit.shared_utils.utils as utils
+from transformers import EsmConfig, EsmTokenizer
+
+from plmfit.functions.zero_shot import score_likelihoods, score_masked_marginals, score_variants
+from plmfit.language_models.esm.modeling_esm import PlmfitEsmForMaskedLM
+from plmfit.language_models.progen2.models.progen.configuration_progen import ProGenConfig
+from plmfit.language_models.progen2.models.progen.modeling_progen import ProGenForCausalLM
+from plmfit.models.zero_shot import (
+    MASKED_MARGINAL_RESIDUES,
+    WildTypePrefixScorer,
+    encode_progen,
+    masked_marginal_log_odds,
+    masked_marginal_scores,
+    mutated_positions,
+    sequence_log_likelihoods,
+    shared_prefix_lengths,
+)
+from plmfit.shared_utils.random_state import set_seed
+
+
+class TestProGenZeroShot(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        config = ProGenConfig(
+            vocab_size=32,
+            n_positions=64,
+            n_ctx=64,
+            n_embd=32,
+            n_layer=2,
+            n_head=8,
+            rotary_dim=4,
+        )
+        self.model = ProGenForCausalLM(config).eval()
+        self.tokenizer = utils.load_tokenizer("progen2-small")
+        self.wild_type = "MKTAYIAKQRQISFVKSHFSRQ"
+        self.variants = np.array(
+            [
+                self.wild_type,
+                "MKTAYIAKQRQISFVKSHFSRA",
+                "AKTAYIAKQRQISFVKSHFSRQ",
+                "MKTAYIAKQRWISFVKSHFSRQ",
+                "MKTAYIAKCRWISFVKSHFSRQ",
+                "MKTAYIAKQRQISFV",
+            ]
+        )
+
+    def unbatched_log_likelihood(self, sequence, reverse=False):
+        input_ids = encode_progen(self.tokenizer, [sequence], reverse=reverse)
+        return sequence_log_likelihoods(self.model, input_ids)[0].item()
+
+    def test_padded_batch_matches_single_sequences(self):
+        input_ids = encode_progen(self.tokenizer, self.variants)
+        log_likelihoods, residues = sequence_log_likelihoods(self.model, input_ids)
+        self.assertEqual(residues.tolist(), [len(sequence) for sequence in self.variants])
+        for sequence, log_likelihood in zip(self.variants, log_likelihoods):
+            self.assertAlmostEqual(
+                log_likelihood.item(), self.unbatched_log_likelihood(sequence), places=3
+            )
+
+    def test_cached_prefix_matches_full_forward(self):
+        for reverse in (False, True):
+            wild_type = self.wild_type[::-1] if reverse else self.wild_type
+            variants = [variant[::-1] if reverse else variant for variant in self.variants]
+            scorer = WildTypePrefixScorer(
+                self.model, encode_progen(self.tokenizer, [self.wild_type], reverse=reverse)[0]
+            )
+            self.assertAlmostEqual(
+                scorer.log_likelihood,
+                self.unbatched_log_likelihood(self.wild_type, reverse=reverse),
+                places=3,
+            )
+            prefix_lengths = shared_prefix_lengths(variants, wild_type)
+            self.assertGreater(prefix_lengths.max(), 10)
+            # Each variant from its own prefix, then all together from the shortest one
+            for sequence, prefix_length in zip(self.variants, prefix_lengths):
+                log_likelihood, residues = scorer(
+                    encode_progen(self.tokenizer, [sequence], reverse=reverse),
+                    int(prefix_length),
+                )
+                self.assertEqual(residues.item(), len(sequence))
+                self.assertAlmostEqual(
+                    log_likelihood.item(),
+                    self.unbatched_log_likelihood(sequence, reverse=reverse),
+                    places=3,
+                )
+            log_likelihoods, _ = scorer(
+                encode_progen(self.tokenizer, self.variants, reverse=reverse),
+                int(prefix_lengths.min()),
+            )
+            for sequence, log_likelihood in zip(self.variants, log_likelihoods):
+                self.assertAlmostEqual(
+                    log_likelihood.item(),
+                    self.unbatched_log_likelihood(sequence, reverse=reverse),
+                    places=3,
+                )
+
+    def test_scores_are_streamed_for_every_row(self):
+        model = SimpleNamespace(py_model=self.model, get_tokenizer=lambda: self.tokenizer)
+        logger = SimpleNamespace(log=lambda text: None)
+
+        output = io.StringIO()
+        score_likelihoods(model, self.variants, 2, torch.device("cpu"), output, logger)
+        likelihoods = pd.read_csv(io.StringIO(output.getvalue())).set_index("index")
+
+        output = io.StringIO()
+        score_variants(
+            model, self.variants, self.wild_type, 2, torch.device("cpu"), output, logger
+        )
+        variants = pd.read_csv(io.StringIO(output.getvalue())).set_index("index")
+
+        self.assertEqual(sorted(variants.index), list(range(len(self.variants))))
+        for i, sequence in enumerate(self.variants):
+            expected = (
+                self.unbatched_log_likelihood(sequence)
+                + self.unbatched_log_likelihood(sequence, reverse=True)
+            ) / 2
+            self.assertAlmostEqual(likelihoods.loc[i, "log_likelihood"], expected, places=3)
+            self.assertAlmostEqual(variants.loc[i, "log_likelihood"], expected, places=3)
+        self.assertAlmostEqual(variants.loc[0, "score"], 0, places=3)
+
+
+ESM_VOCAB = [
+    "<cls>", "<pad>", "<eos>", "<unk>", *"LAGVSERTIDPKQNFYMHWCXBUZO.-", "<null_1>", "<mask>"
+]
+
+
+class TestEsmMaskedMarginals(unittest.TestCase):
+    def setUp(self):
+        set_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        vocab_file = f"{self.tmp_dir.name}/vocab.txt"
+        with open(vocab_file, "w") as f:
+            f.write("\n".join(ESM_VOCAB))
+        self.tokenizer = EsmTokenizer(vocab_file)
+        config = EsmConfig(
+            vocab_size=len(ESM_VOCAB),
+            mask_token_id=self.tokenizer.mask_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=64,
+            max_position_embeddings=64,
+            position_embedding_type="rotary",
+        )
+        self.model = PlmfitEsmForMaskedLM(config).eval()
+        self.wild_type = "MKTAYIAKQRQISFVKSHFSRQ"
+        self.variants = [
+            self.wild_type,
+            "MKTAYIAKQRQISFVKSHFSRA",
+            "AKTAYIAKQRQISFVKSHFSRQ",
+            "MKTAYIAKCRWISFVKSHFSRQ",
+            "MKTAYIAKQRQISFV",
+            "MKTAYIAKQRXISFVKSHFSRQ",
+        ]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_batched_table_matches_single_forwards(self):
+        positions = np.array([0, 3, 8, 10, 21])
+        log_odds = masked_marginal_log_odds(
+            self.model, self.tokenizer, self.wild_type, positions, batch_size=3
+        )
+        self.assertEqual(log_odds.shape, (len(positions), len(MASKED_MARGINAL_RESIDUES)))
+        residue_ids = self.tokenizer.convert_tokens_to_ids(list(MASKED_MARGINAL_RESIDUES))
+        for row, position in enumerate(positions):
+            input_ids = torch.tensor([self.tokenizer.encode(self.wild_type)])
+            input_ids[0, position + 1] = self.tokenizer.mask_token_id
+            with torch.no_grad():
+                logits = self.model(input_ids).logits[0, position + 1, residue_ids]
+            log_probs = torch.log_softmax(logits, dim=-1).numpy()
+            wild_type_column = MASKED_MARGINAL_RESIDUES.index(self.wild_type[position])
+            np.testing.assert_allclose(
+                log_odds[row], log_probs - log_probs[wild_type_column], atol=1e-5
+            )
+
+    def test_variants_are_scored_by_table_lookup(self):
+        self.assertEqual(mutated_positions(self.variants, self.wild_type).tolist(), [0, 8, 10, 21])
+        log_odds = np.random.default_rng(0).normal(
+            size=(len(self.wild_type), len(MASKED_MARGINAL_RESIDUES))
+        )
+        column = MASKED_MARGINAL_RESIDUES.index
+        scores = masked_marginal_scores(log_odds, self.variants, self.wild_type)
+        self.assertEqual(scores[0], 0)
+        self.assertAlmostEqual(scores[1], log_odds[21, column("A")])
+        self.assertAlmostEqual(scores[3], log_odds[8, column("C")] + log_odds[10, column("W")])
+        # Not a substitution variant, or a non canonical mutation
+        self.assertTrue(np.isnan(scores[4]))
+        self.assertTrue(np.isnan(scores[5]))
+
+    def test_table_is_cached_for_the_mutated_positions(self):
+        model = SimpleNamespace(py_model=self.model, get_tokenizer=lambda: self.tokenizer)
+        logs = []
+        logger = SimpleNamespace(log=logs.append)
+        cache_path = f"{self.tmp_dir.name}/zero_shot/masked_marginals.npz"
+
+        output = io.StringIO()
+        score_masked_marginals(
+            model, self.variants[:4], self.wild_type, 2, cache_path, output, logger
+        )
+        first = pd.read_csv(io.StringIO(output.getvalue())).set_index("index")
+        self.assertTrue(os.path.isfile(cache_path))
+        self.assertEqual(np.load(cache_path)["computed"].sum(), 4)
+
+        # Cached positions are not run through the model again
+        model.py_model = None
+        output = io.StringIO()
+        score_masked_marginals(
+            model, self.variants[:4], self.wild_type, 2, cache_path, output, logger
+        )
+        second = pd.read_csv(io.StringIO(output.getvalue())).set_index("index")
+        pd.testing.assert_frame_equal(first, second)
+        self.assertIn("computing the masked marginals of 0", logs[-1])
+        self.assertEqual(first.loc[0, "score"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()